@@ -0,0 +1,165 @@
+"""Vectorized astrometry of a block of heliocentric states seen from several observatories.
+
+The states of a block of epochs of a simulation, (n_epochs, n_objects) per component,
+are turned into RA/Dec for every observatory at once: the light-time correction and the
+ecliptic to equatorial rotation are whole-array operations on (n_sites, n_epochs,
+n_objects) blocks, so a multi-site cadence costs no Python iteration per site or epoch.
+The caller integrates a few epochs at a time (EPOCH_BLOCK) and passes the same
+`observe_buffers` for every block, which bounds the working set by the block instead of
+the whole cadence.
+
+Only the observer position enters the astrometry: like the spacerocks light-time
+correction that create_observations_spacerocks used before (correct_for_ltt_destnosim),
+no aberration is applied and the observer velocity is not used. `observe_reference`
+is a port of that former path, the kernel agrees with it to within the 1e-6 day light-time
+tolerance of the former path (a few mas for the fastest nearby objects).
+"""
+import numpy as np
+
+# 299792.458 km/s in au/day (IAU 2012 au)
+SPEED_OF_LIGHT_AU_PER_DAY = 299792.458 * 86400 / 149597870.7
+LTT_ITERATIONS = 3
+# epochs integrated and observed together by create_observations_spacerocks
+EPOCH_BLOCK = 4
+# GM of the solar system barycenter in au^3/day^2, spacerocks.constants.mu_bary
+MU_BARY = 0.00029630927493457475
+
+
+def ecliptic_to_equatorial(epsilon: float) -> np.ndarray:
+    """Rotation matrix from ecliptic to equatorial coordinates for the obliquity `epsilon` (radians or an angle Quantity)."""
+    c, s = float(np.cos(epsilon)), float(np.sin(epsilon))
+    return np.array([[1, 0, 0],
+                     [0, c, -s],
+                     [0, s, c]], dtype=np.double)
+
+
+def observe_buffers(n_sites: int, n_epochs: int, n_objects: int) -> tuple[np.ndarray, ...]:
+    """Work buffers of `observe` for blocks of up to `n_epochs` epochs: five (n_sites, n_epochs, n_objects)
+    arrays and one (n_epochs, n_objects) array."""
+    shape = (n_sites, n_epochs, n_objects)
+    return tuple(np.empty(shape) for _ in range(5)) + (np.empty(shape[1:]),)
+
+
+def observe(x, y, z, vx, vy, vz, observer: np.ndarray, rotation: np.ndarray,
+            ltt_iterations: int = LTT_ITERATIONS, ra_wrap: float = 180.0, buffers: tuple = None):
+    """
+    RA and Dec in degrees of every object at every epoch seen from every observatory.
+
+    The object is moved back along its velocity and its solar acceleration by the light travel
+    time to the observer, iterated `ltt_iterations` times from the geometric distance, and the
+    topocentric vector is rotated by `rotation` (see `ecliptic_to_equatorial`).
+
+    Parameters:
+    - x, y, z, vx, vy, vz (np.ndarray): (n_epochs, n_objects) heliocentric positions (au) and velocities (au/day).
+    - observer (np.ndarray): (n_sites, n_epochs, 3) heliocentric observer positions (au), e.g. `Ephemeris.observer_positions`;
+      no aberration is applied, so no observer velocity is needed.
+    - rotation (np.ndarray): 3x3 rotation from the frame of the states to equatorial, a rotation about x.
+    - ltt_iterations (int): Number of light-time iterations, 0 for geometric positions.
+    - ra_wrap (float): RA is returned in [ra_wrap - 360, ra_wrap), the catalog uses 180.
+    - buffers (tuple): `observe_buffers` for at least these sites, epochs and objects, allocated if None.
+
+    Returns:
+    - ra, dec (np.ndarray): (n_sites, n_epochs, n_objects) arrays, views of `buffers` that the next call overwrites.
+    """
+    observer = np.asarray(observer, dtype=np.double)
+    shape = (observer.shape[0],) + np.shape(x)
+    ox, oy, oz = (observer[..., k, None] for k in range(3))
+
+    if buffers is None:
+        buffers = observe_buffers(*shape)
+    tx, ty, tz, ltt, tmp = (b[:shape[0], :shape[1], :shape[2]] for b in buffers[:5])
+    xi = buffers[5][:shape[1], :shape[2]]
+    ltt[:] = 0
+
+    # solar acceleration over the light time is -xi * r
+    np.square(x, out=xi)
+    xi += np.square(y, out=tmp[0])
+    xi += np.square(z, out=tmp[0])
+    np.power(xi, 1.5, out=xi)
+    np.divide(MU_BARY, xi, out=xi)
+
+    def topocentric():
+        # t = r - (v + xi * ltt / 2 * r) * ltt - o, in place
+        np.multiply(ltt, xi, out=tmp)
+        np.multiply(tmp, 0.5, out=tmp)
+        for t, r, v, o in ((tx, x, vx, ox), (ty, y, vy, oy), (tz, z, vz, oz)):
+            np.multiply(tmp, r, out=t)
+            t += v
+            t *= ltt
+            np.subtract(r, t, out=t)
+            t -= o
+
+    if not np.allclose(rotation[0], [1, 0, 0]) or not np.allclose(rotation[:, 0], [1, 0, 0]):
+        raise ValueError("Only rotations about the x axis are supported")
+
+    topocentric()
+    for _ in range(ltt_iterations):
+        np.multiply(tx, tx, out=ltt)
+        ltt += np.multiply(ty, ty, out=tmp)
+        ltt += np.multiply(tz, tz, out=tmp)
+        np.sqrt(ltt, out=ltt)
+        ltt /= SPEED_OF_LIGHT_AU_PER_DAY
+        topocentric()
+
+    # y' = r11 y + r12 z into tmp and z' = r21 y + r22 z into tz, ltt is the scratch buffer
+    np.multiply(ty, rotation[1, 1], out=tmp)
+    tmp += np.multiply(tz, rotation[1, 2], out=ltt)
+    np.multiply(ty, rotation[2, 1], out=ltt)
+    tz *= rotation[2, 2]
+    tz += ltt
+    ty, yq = tmp, ty
+
+    ra = np.arctan2(ty, tx, out=yq)
+    np.degrees(ra, out=ra)
+    # wrap into [ra_wrap - 360, ra_wrap)
+    ra -= ra_wrap - 360
+    np.mod(ra, 360, out=ra)
+    ra += ra_wrap - 360
+
+    np.hypot(tx, ty, out=tx)
+    dec = np.arctan2(tz, tx, out=tz)
+    np.degrees(dec, out=dec)
+    return ra, dec
+
+
+def correct_for_ltt_reference(x, y, z, vx, vy, vz, ox: float, oy: float, oz: float):
+    """Light-time corrected topocentric positions of one epoch, ported from spacerocks' C++
+    correct_for_ltt behind correct_for_ltt_destnosim: at most 3 iterations that move the object
+    back along v and the solar acceleration, stopping once the light time changes by less than
+    1e-6 day, and the offset of the last iteration's starting position is returned."""
+    r = np.sqrt(x * x + y * y + z * z)
+    xi = MU_BARY / r**3
+    tx, ty, tz = x.copy(), y.copy(), z.copy()
+    dx, dy, dz = np.empty_like(x), np.empty_like(y), np.empty_like(z)
+    ltt0 = np.zeros_like(x)
+    active = np.ones(np.shape(x), dtype=bool)
+    for _ in range(3):
+        dx[active] = tx[active] - ox
+        dy[active] = ty[active] - oy
+        dz[active] = tz[active] - oz
+        ltt = np.sqrt(dx * dx + dy * dy + dz * dz) / SPEED_OF_LIGHT_AU_PER_DAY
+        active &= np.abs(ltt - ltt0) >= 1e-6
+        acc = xi * ltt
+        tx = np.where(active, x - (0.5 * acc * x + vx) * ltt, tx)
+        ty = np.where(active, y - (0.5 * acc * y + vy) * ltt, ty)
+        tz = np.where(active, z - (0.5 * acc * z + vz) * ltt, tz)
+        ltt0 = np.where(active, ltt, ltt0)
+    return dx, dy, dz
+
+
+def observe_reference(x, y, z, vx, vy, vz, observer: np.ndarray, epsilon: float):
+    """Reference for `observe`: the former create_observations_spacerocks astrometry, one observatory
+    and epoch at a time with `correct_for_ltt_reference` and its ecliptic longitude/latitude expressions."""
+    ra = np.empty((len(observer),) + np.shape(x))
+    dec = np.empty_like(ra)
+    for k in range(len(observer)):
+        for i in range(np.shape(x)[0]):
+            ox, oy, oz = observer[k, i, :3]
+            xt, yt, zt = correct_for_ltt_reference(x[i], y[i], z[i], vx[i], vy[i], vz[i], ox, oy, oz)
+            lon = np.arctan2(yt, xt)
+            lat = np.arcsin(zt / np.sqrt(xt**2 + yt**2 + zt**2))
+            dec[k, i] = np.degrees(np.arcsin(np.sin(lat) * np.cos(epsilon) +
+                                   np.cos(lat) * np.sin(lon) * np.sin(epsilon)))
+            ra[k, i] = np.degrees(np.arctan2((np.cos(lat) * np.cos(epsilon) * np.sin(lon) -
+                                  np.sin(lat) * np.sin(epsilon)), np.cos(lon) * np.cos(lat)))
+    return ra, dec
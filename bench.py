@@ -0,0 +1,434 @@
+"""Benchmarks for the Python side of the pipeline.
+
+The pipeline benchmark runs every HelioManager stage, combine_output and the plot.py
+aggregation on synthetic detections, with make_tracklets/heliolinc replaced by the
+stand-ins in benchmarks/heliolinc2/src. Each population size runs in its own process so
+that peak RSS is per size, and results are appended to a CSV tagged with the commit.
+
+Usage:
+    python bench.py truth --sizes 1000 10000 100000
+    python bench.py pipeline --sizes 1000 10000 100000 1000000 --chunks 4
+    python bench.py imports --workers 4
+    python bench.py memory --size 1000000
+    python bench.py astrometry --objects 1000 100000 --sites 1 4 --epochs 30
+    python bench.py pairing --sizes 1000 10000 100000
+    python bench.py queue --size 40000 --chunks 8 --workers 1 2 4
+"""
+from utils import DetectionBuilder, DetectionWriter, extract_object_truth_values, extract_object_truth_values_polyfit
+from manager import HelioManager
+from config import *
+from timeit import default_timer as time
+import argparse
+import datetime
+import math
+import shutil
+import subprocess
+import sys
+import warnings
+import numpy as np
+import pandas as pd
+import helio
+import perf
+import workers
+
+STANDIN_HELIO_PATH = Path(__file__).resolve().parent / "benchmarks" / "heliolinc2"
+
+
+MJD_LIST = [t + 60676 + 25 for t in [0.5, 0.6, 7.5, 7.6, 13.5, 13.6]]
+
+
+def make_synthetic_dets(size: int, mjd_list: list[float] = MJD_LIST, drop_fraction: float = 0.0, seed=0, startOidIndex: int = 0,
+                        truth_dtype=np.double) -> pd.DataFrame:
+    """Creates a detection frame with the schema of `create_observations_spacerocks`.
+
+    Objects move on straight lines in the sky at up to 0.5 deg/day and have quadratic
+    heliocentric distances. A `drop_fraction` of the detections is removed at random to
+    produce ragged epoch counts.
+    """
+    rng = np.random.default_rng(seed)
+    r = rng.uniform(1.1, 50, size)
+    rdot = rng.uniform(-0.01, 0.01, size)
+    rdotdot = rng.uniform(-1e-5, 1e-5, size)
+    direction = rng.normal(size=(3, size))
+    direction /= np.linalg.norm(direction, axis=0)
+    ra0 = rng.uniform(-180, 180, size)
+    dec0 = np.degrees(np.arcsin(rng.uniform(-1, 1, size)))
+    ra_rate, dec_rate = rng.uniform(-0.5, 0.5, (2, size))
+
+    builder = DetectionBuilder(len(mjd_list), size, startOidIndex=startOidIndex, truth_dtype=truth_dtype)
+    for i, mjd in enumerate(mjd_list):
+        dt = mjd - mjd_list[0]
+        d = r + rdot * dt + rdotdot * dt ** 2
+        ra = (ra0 + ra_rate * dt + 180) % 360 - 180
+        dec = np.clip(dec0 + dec_rate * dt, -90, 90)
+        builder.add_epoch(i, mjd, ra, dec, *(direction * d))
+    dets = builder.to_pandas()
+    if drop_fraction > 0:
+        dets = dets[rng.uniform(size=len(dets)) >= drop_fraction].reset_index(drop=True)
+    return dets
+
+
+def run_timed(func, *args, **kwargs):
+    start = time()
+    res = func(*args, **kwargs)
+    return res, time() - start
+
+
+def bench_truth_fit(sizes: list[int], drop_fraction: float = 0.0, max_polyfit_size: int = 100_000):
+    """Compares the batched truth fit against the per-object np.polyfit implementation."""
+    mjd_ref = MJD_LIST[len(MJD_LIST) // 2]
+    rows = []
+    for size in sizes:
+        dets = make_synthetic_dets(size, drop_fraction=drop_fraction)
+        batched, t_batched = run_timed(
+            extract_object_truth_values, dets, mjd_ref, len(MJD_LIST))
+        row = {'size': size, 'batched_s': t_batched,
+               'polyfit_s': np.nan, 'speedup': np.nan, 'max_abs_diff': np.nan}
+        if size <= max_polyfit_size:
+            with warnings.catch_warnings():
+                # objects left with fewer than 3 detections make np.polyfit warn
+                warnings.simplefilter("ignore")
+                reference, t_reference = run_timed(
+                    extract_object_truth_values_polyfit, dets, mjd_ref, len(MJD_LIST))
+            row['polyfit_s'] = t_reference
+            row['speedup'] = t_reference / t_batched
+            # compare the fitted curves at the reference epoch, the raw coefficients are ill conditioned
+            fitted = np.polyval(batched[['helioAcc', 'helioVel', 'helioDist']].to_numpy().T, mjd_ref)
+            expected = np.polyval(reference[['helioAcc', 'helioVel', 'helioDist']].to_numpy().T, mjd_ref)
+            row['max_abs_diff'] = np.nanmax(np.abs(fitted - expected))
+        rows.append(row)
+        print(row)
+    return pd.DataFrame(rows)
+
+
+class SyntheticHelioManager(HelioManager):
+    """HelioManager whose detections come from `make_synthetic_dets` instead of spacerocks."""
+
+    def create_dets(self, writer: DetectionWriter = None, start: int = 0, size: int = None) -> pd.DataFrame:
+        startOidIndex = self.outputConfig.startOidIndex + start
+        dets = make_synthetic_dets(self.size if size is None else size, self.sharedConfig.mjd_list,
+                                   seed=[self.sharedConfig.seed or 0, startOidIndex], startOidIndex=startOidIndex,
+                                   truth_dtype=self.truth_dtype())
+        if writer is not None:
+            # one block per epoch, like create_observations_spacerocks
+            for _, epoch in dets.groupby('FieldMJD', sort=True):
+                writer.write_frame(epoch)
+        return dets
+
+
+def synthetic_chunk_task(shared_config: HelioSharedConfig, output_config: HelioOutputConfig, i: int) -> None:
+    """`start.chunck_task` with synthetic detections and the stand-in executables, run by the queue workers."""
+    helio.HELIO_PATH = STANDIN_HELIO_PATH
+    output_config.create_output_dir()
+    m = SyntheticHelioManager(shared_config, output_config)
+    m.generate_dets()
+    m.run_helio()
+    m.diagnose_pairs()
+    m.extract_helio_results()
+
+
+def bench_pipeline_size(size: int, n_chunks: int, workdir: Path) -> None:
+    """Runs the whole pipeline for one population size, records go to `workdir`."""
+    from start import generate_helio_output_config_list, combine_output, combine_histograms
+    from plot import separate_linked, plot_hist2d, plot_linked_fraction
+    from histogram import HIST_FILE_NAME, LinkedHistogram
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    helio.HELIO_PATH = STANDIN_HELIO_PATH
+    workdir.mkdir(parents=True, exist_ok=True)
+    chunk_size = math.ceil(size / n_chunks)
+    shared = HelioSharedConfig(
+        size=chunk_size, t=25, mjd_list=MJD_LIST, seed=0,
+        guess_file=workdir / "hypo.csv",
+        earth_file=STANDIN_HELIO_PATH / "tests/Earth1day2020s_02a.txt",
+        obs_file=STANDIN_HELIO_PATH / "tests/ObsCodes.txt",
+        colformat_file=Path(__file__).resolve().parent / "colformat.txt")
+    output_configs = generate_helio_output_config_list(workdir, n_chunks, chunk_size)
+
+    for i, output_config in enumerate(output_configs):
+        output_config.create_output_dir()
+        m = SyntheticHelioManager(shared, output_config)
+        if i == 0:
+            m.generate_guess_grid()
+        m.generate_dets()
+        m.run_helio()
+        m.diagnose_pairs()
+        m.extract_helio_results()
+
+    with perf.chunk_context("all", workdir):
+        with perf.measure("combine_output"):
+            combine_output(shared, output_configs, workdir)
+        with perf.measure("plot_aggregation"):
+            helio_extracted = pd.read_feather(workdir / "extracted_output.feather")
+            obj_table = pd.read_feather(workdir / "obj_table.feather")
+            perf.annotate(rows_in=len(helio_extracted) + len(obj_table))
+            linked, not_linked = separate_linked(set(helio_extracted['ObjID'].unique()), obj_table)
+            with warnings.catch_warnings():
+                # fig.show() warns on the non-interactive backend
+                warnings.simplefilter("ignore")
+                plot_hist2d(linked, not_linked)
+            plt.close("all")
+        with perf.measure("plot_histogram"):
+            combine_histograms(output_configs, workdir)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                plot_linked_fraction(LinkedHistogram.load(workdir / HIST_FILE_NAME))
+            plt.close("all")
+
+
+def current_commit() -> str:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_pipeline(sizes: list[int], n_chunks: int, workdir: Path, results_file: Path) -> pd.DataFrame:
+    """Benchmarks the pipeline for every size in a fresh process and appends the per-stage
+    wall time, CPU time, peak RSS and throughput to `results_file`.
+    """
+    commit = current_commit()
+    date = datetime.datetime.now().isoformat(timespec="seconds")
+    reports = []
+    for size in sizes:
+        size_dir = workdir / str(size)
+        shutil.rmtree(size_dir, ignore_errors=True)
+        subprocess.run([sys.executable, __file__, "pipeline-size", "--size", str(size),
+                        "--chunks", str(n_chunks), "--workdir", str(size_dir)], check=True)
+        records = perf.load_records(sorted(size_dir.glob(f"**/{perf.PERF_FILE_NAME}")))
+        res = perf.report(records).reset_index()
+        res.insert(0, 'size', size)
+        res['objects_per_s'] = size / res['wall_s']
+        reports.append(res)
+    res = pd.concat(reports, ignore_index=True)
+    res.insert(0, 'date', date)
+    res.insert(0, 'commit', commit)
+    results_file.parent.mkdir(parents=True, exist_ok=True)
+    res.to_csv(results_file, mode='a', header=not results_file.exists(), index=False)
+    print(f"Appended results to {results_file}")
+    return res
+
+
+IMPORT_MODULES = ["utils", "manager", "start", "sweep", "linkage", "histogram", "ephemeris", "destnosim", "spacerocks"]
+
+
+def bench_imports(modules: list[str] = IMPORT_MODULES, n_workers: int = 4) -> pd.DataFrame:
+    """Import time of each module in a fresh interpreter, and time to first result of new worker pools.
+
+    The pools compare the spawn and fork start methods with the preloaded forkserver of workers.py.
+    """
+    rows = []
+    for module in modules:
+        try:
+            total, packages = workers.import_times(module)
+        except subprocess.CalledProcessError:
+            print(f"{module}: import failed")
+            continue
+        top = ", ".join(f"{p} {t:.3f}s" for p, t in list(packages.items())[:4])
+        rows.append({'bench': 'import', 'name': module, 'seconds': total, 'detail': top})
+
+    import multiprocessing
+    import concurrent.futures
+    pools = {
+        method: lambda method=method: concurrent.futures.ProcessPoolExecutor(
+            n_workers, mp_context=multiprocessing.get_context(method))
+        for method in ['spawn', 'fork'] if method in multiprocessing.get_all_start_methods()
+    }
+    pools['forkserver-preloaded'] = lambda: workers.process_pool(n_workers)
+    for name, make_pool in pools.items():
+        # the second pool shows a restart, the forkserver is already up by then
+        for attempt in ['first pool', 'second pool']:
+            with make_pool() as executor:
+                startup = workers.worker_startup(executor, n_workers)
+            rows.append({'bench': 'pool', 'name': name, 'seconds': startup, 'detail': attempt})
+    return pd.DataFrame(rows)
+
+
+def bench_astrometry(objects: list[int], sites: list[int], n_epochs: int = 30, seed=0) -> pd.DataFrame:
+    """`astrometry.observe` on whole (sites x epochs x objects) blocks against the per-site,
+    per-epoch port of the former spacerocks path, on random heliocentric states; `max_diff_mas`
+    is the largest on-sky difference of their positions."""
+    from astrometry import ecliptic_to_equatorial, observe, observe_reference
+    epsilon = 0.4090926
+    rng = np.random.default_rng(seed)
+    rows = []
+    for n_objects in objects:
+        for n_sites in sites:
+            state = rng.normal(size=(6, n_epochs, n_objects))
+            state[:3] *= 20
+            state[3:] *= 0.01
+            observer = rng.normal(size=(n_sites, n_epochs, 3))
+            (ra, dec), t_kernel = run_timed(observe, *state, observer, ecliptic_to_equatorial(epsilon))
+            (ra_ref, dec_ref), t_ref = run_timed(observe_reference, *state, observer, epsilon)
+            # on-sky difference, RA scaled by cos(Dec)
+            diff = max((np.abs((ra - ra_ref + 180) % 360 - 180) * np.cos(np.radians(dec_ref))).max(),
+                       np.abs(dec - dec_ref).max())
+            row = {'objects': n_objects, 'sites': n_sites, 'epochs': n_epochs, 'detections': ra.size,
+                   'reference_s': t_ref, 'kernel_s': t_kernel, 'speedup': t_ref / t_kernel,
+                   'max_diff_mas': diff * 3.6e6}
+            print(row)
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def bench_memory(size: int, clusters_per_object: int = 3, seed=0) -> pd.DataFrame:
+    """In-memory size of the per-stage tables of `size` objects, before and after the compact schema.
+
+    "legacy" rebuilds the former layout: Band/ObsCode as one string per row and the extracted
+    results keyed by an idstring column; "compact" is the current schema and "float32" adds
+    `derived_float32`. The linked lookup times the plot.py membership test of every layout.
+    """
+    from utils import extracted_schema
+    rng = np.random.default_rng(seed)
+    dets = {'compact': make_synthetic_dets(size, seed=seed),
+            'float32': make_synthetic_dets(size, seed=seed, truth_dtype=np.float32)}
+    dets['legacy'] = dets['compact'].assign(Band=np.full(len(dets['compact']), 'r'),
+                                            ObsCode=np.full(len(dets['compact']), 'W84'))
+    obj_table = extract_object_truth_values(dets['compact'], MJD_LIST[3], len(MJD_LIST))
+
+    n = size * clusters_per_object
+    grid = np.round(rng.uniform(1.1, 50, n), 3)
+    extracted = pd.DataFrame({'ObjID': rng.integers(0, size, n), 'clusternum': np.arange(n),
+                              'pure': np.ones(n, dtype=bool), 'heliodist': grid,
+                              'heliovel': np.round(rng.uniform(-30, 30, n), 3), 'helioacc': np.zeros(n)})
+    extracted = {
+        'compact': extracted,
+        'float32': extracted_schema(True).empty_table().to_pandas().pipe(
+            lambda empty: extracted.astype(empty.dtypes.to_dict())),
+        'legacy': extracted.rename(columns={'ObjID': 'idstring'}).assign(idstring=lambda e: e['idstring'].astype(str)),
+    }
+
+    def linked(layout):
+        ids = extracted[layout]['idstring'].astype(np.int64) if layout == 'legacy' else extracted[layout]['ObjID']
+        return obj_table['ObjID'].isin(set(ids.unique()) if layout == 'legacy' else ids.unique())
+
+    layouts = ['legacy', 'compact', 'float32']
+    rows = [{'stage': 'generate_dets', 'table': 'dets',
+             **{layout: perf.table_bytes(dets[layout]) / 2**20 for layout in layouts}},
+            {'stage': 'generate_dets', 'table': 'obj_table',
+             **{layout: perf.table_bytes(obj_table) / 2**20 for layout in layouts}},
+            {'stage': 'extract_helio_results', 'table': 'hl_extracted',
+             **{layout: perf.table_bytes(extracted[layout]) / 2**20 for layout in layouts}}]
+    rows.append({'stage': 'plot_aggregation', 'table': 'linked lookup (s)',
+                 **{layout: run_timed(linked, layout)[1] for layout in layouts}})
+    return pd.DataFrame(rows)
+
+
+def bench_pairing(sizes: list[int], workdir: Path, maxvel: float = 2, maxtime: float = 5) -> pd.DataFrame:
+    """The in-process KD-tree pairing against make_tracklets (the stand-in) on synthetic detections,
+    including the diff of their pairs."""
+    from pairing import diff_pairs, run_kdtree_pairing
+    from tiling import read_dets
+
+    helio.HELIO_PATH = STANDIN_HELIO_PATH
+    colformat = Path(__file__).resolve().parent / "colformat.txt"
+    rows = []
+    for size in sizes:
+        path = workdir / f"{size}"
+        path.mkdir(parents=True, exist_ok=True)
+        with DetectionWriter(path / "dets.csv", colformat) as writer:
+            writer.write_frame(make_synthetic_dets(size))
+        native = (path / "pairdets.csv", path / "pairs.csv")
+        inprocess = (path / "kdtree_pairdets.csv", path / "kdtree_pairs.csv")
+        _, t_native = run_timed(helio.run_make_tracklets, path / "dets.csv", STANDIN_HELIO_PATH / "tests/Earth1day2020s_02a.txt",
+                                STANDIN_HELIO_PATH / "tests/ObsCodes.txt", colformat, maxvel, maxtime, *native,
+                                stdout_file=path / "make_tracklets_stdout.txt")
+        (_, n_pairs), t_kdtree = run_timed(lambda: run_kdtree_pairing(read_dets(path / "dets.csv", colformat),
+                                                                      maxvel, maxtime, *inprocess))
+        diff = diff_pairs(native, inprocess)
+        row = {'size': size, 'make_tracklets_s': t_native, 'kdtree_s': t_kdtree, 'kdtree_pairs': n_pairs,
+               **{k: v for k, v in diff.items() if not k.endswith('examples')}}
+        print(row)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def bench_queue(size: int, n_chunks: int, workers: list[int], workdir: Path) -> pd.DataFrame:
+    """Runs `n_chunks` synthetic chunks through a work queue with each number of local worker processes,
+    every worker standing in for a node."""
+    from start import generate_helio_output_config_list
+    from workqueue import run_distributed
+
+    rows = []
+    for n in workers:
+        path = workdir / f"{n}"
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir(parents=True)
+        chunk_size = math.ceil(size / n_chunks)
+        shared = HelioSharedConfig(
+            size=chunk_size, t=25, mjd_list=MJD_LIST, seed=0, guess_file=path / "hypo.csv",
+            earth_file=STANDIN_HELIO_PATH / "tests/Earth1day2020s_02a.txt",
+            obs_file=STANDIN_HELIO_PATH / "tests/ObsCodes.txt",
+            colformat_file=Path(__file__).resolve().parent / "colformat.txt")
+        output_configs = generate_helio_output_config_list(path, n_chunks, chunk_size)
+        output_configs[0].create_output_dir()
+        SyntheticHelioManager(shared, output_configs[0]).generate_guess_grid()
+        results, wall = run_timed(run_distributed, shared, output_configs, path / "queue", local_workers=n,
+                                  task="bench:synthetic_chunk_task")
+        row = {'workers': n, 'chunks': n_chunks, 'objects': size, 'wall_s': wall,
+               'chunk_s': sum(res['seconds'] for res in results),
+               'succeeded': sum(res['status'] == 'succeeded' for res in results),
+               'workers_used': len({res['worker'] for res in results})}
+        print(row)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+    truth = sub.add_parser("truth", help="batched vs per-object truth fitting")
+    truth.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    truth.add_argument("--drop-fraction", type=float, default=0.0)
+    truth.add_argument("--max-polyfit-size", type=int, default=100_000)
+    pipeline = sub.add_parser("pipeline", help="all stages with stand-in executables")
+    pipeline.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    pipeline.add_argument("--chunks", type=int, default=4)
+    pipeline.add_argument("--workdir", type=Path, default=Path("./temp/bench"))
+    pipeline.add_argument("--results", type=Path, default=Path("./temp/bench/results.csv"))
+    pipeline_size = sub.add_parser("pipeline-size", help=argparse.SUPPRESS)
+    pipeline_size.add_argument("--size", type=int, required=True)
+    pipeline_size.add_argument("--chunks", type=int, required=True)
+    pipeline_size.add_argument("--workdir", type=Path, required=True)
+    imports = sub.add_parser("imports", help="module import times and worker pool startup")
+    imports.add_argument("--modules", nargs="+", default=IMPORT_MODULES)
+    imports.add_argument("--workers", type=int, default=4)
+    memory = sub.add_parser("memory", help="per-stage table footprint before and after the compact schema")
+    memory.add_argument("--size", type=int, default=1_000_000)
+    astrometry = sub.add_parser("astrometry", help="vectorized multi-site astrometry vs per-epoch reference")
+    astrometry.add_argument("--objects", type=int, nargs="+", default=[1_000, 100_000])
+    astrometry.add_argument("--sites", type=int, nargs="+", default=[1, 4])
+    astrometry.add_argument("--epochs", type=int, default=30)
+    pairing = sub.add_parser("pairing", help="in-process KD-tree pairing vs make_tracklets")
+    pairing.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    pairing.add_argument("--workdir", type=Path, default=Path("./temp/bench/pairing"))
+    queue = sub.add_parser("queue", help="chunks run by local work-queue workers")
+    queue.add_argument("--size", type=int, default=40_000)
+    queue.add_argument("--chunks", type=int, default=8)
+    queue.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    queue.add_argument("--workdir", type=Path, default=Path("./temp/bench/queue"))
+    args = parser.parse_args()
+
+    if args.bench == "truth":
+        print(bench_truth_fit(args.sizes, args.drop_fraction, args.max_polyfit_size).to_string(index=False))
+    elif args.bench == "pipeline":
+        res = bench_pipeline(args.sizes, args.chunks, args.workdir, args.results)
+        print(res.drop(columns=['commit', 'date']).to_string(index=False))
+    elif args.bench == "astrometry":
+        print(bench_astrometry(args.objects, args.sites, args.epochs).to_string(index=False))
+    elif args.bench == "pairing":
+        print(bench_pairing(args.sizes, args.workdir).to_string(index=False))
+    elif args.bench == "queue":
+        print(bench_queue(args.size, args.chunks, args.workers, args.workdir).to_string(index=False))
+    elif args.bench == "memory":
+        print(bench_memory(args.size).to_string(index=False, float_format="{:.3f}".format))
+    elif args.bench == "imports":
+        print(bench_imports(args.modules, args.workers).to_string(index=False))
+    elif args.bench == "pipeline-size":
+        bench_pipeline_size(args.size, args.chunks, args.workdir)
@@ -0,0 +1,113 @@
+from functools import lru_cache
+from pathlib import Path
+import hashlib
+import json
+import os
+import shutil
+
+
+@lru_cache(maxsize=1024)
+def _content_hash(path: str, mtime_ns: int, size: int) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_hash(path) -> str:
+    """sha256 of a file's content, memoized per (path, mtime, size) within the process."""
+    st = os.stat(path)
+    return _content_hash(str(path), st.st_mtime_ns, st.st_size)
+
+
+class ArtifactCache:
+    """Content-addressed store for stage outputs.
+
+    Each entry is a directory named after the hash of the inputs that produced it and
+    holds copies of the output files. Entries are published with an atomic rename, so
+    several workers can share one cache, and the least recently used entries are evicted
+    once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 20 * 1024**3) -> None:
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(stage: str, inputs: dict) -> str:
+        """Hash of a stage name and its JSON-serializable inputs; Paths are hashed by content."""
+        def encode(o):
+            if isinstance(o, Path):
+                return {'file': file_hash(o)}
+            raise TypeError(f"Cannot hash {type(o).__name__} as a cache input")
+        payload = json.dumps({'stage': stage, 'inputs': inputs}, sort_keys=True, default=encode)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def entry_dir(self, key: str) -> Path:
+        return self.root / key
+
+    def restore(self, key: str, files: list[Path]) -> bool:
+        """Copies the cached artifacts of `key` to `files`. Returns False on a cache miss."""
+        entry = self.entry_dir(key)
+        if not all((entry / Path(f).name).is_file() for f in files):
+            return False
+        try:
+            for f in files:
+                shutil.copyfile(entry / Path(f).name, f)
+            os.utime(entry)
+        except FileNotFoundError:
+            # another worker evicted the entry after the check, the caller produces the files again
+            return False
+        return True
+
+    def store(self, key: str, files: list[Path]) -> None:
+        """Adds the artifacts `files` under `key` and evicts old entries if needed."""
+        entry = self.entry_dir(key)
+        if entry.exists():
+            os.utime(entry)
+            return
+        tmp = self.root / f".{key}.{os.getpid()}.tmp"
+        tmp.mkdir()
+        try:
+            for f in files:
+                shutil.copyfile(f, tmp / Path(f).name)
+            os.rename(tmp, entry)
+        except OSError:
+            # another worker published the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not entry.exists():
+                raise
+        self.evict()
+
+    def entries(self) -> list[tuple[float, int, Path]]:
+        """(last use, size in bytes, path) of every entry, least recently used first."""
+        res = []
+        for entry in self.root.iterdir():
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                res.append((entry.stat().st_mtime, size, entry))
+            except FileNotFoundError:
+                continue
+        return sorted(res)
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self) -> None:
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            print(f"Evicted cache entry {entry.name[:12]} ({size / 1024**2:.1f} MiB)")
+
+    def clear(self) -> None:
+        for _, _, entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
@@ -0,0 +1,74 @@
+"""Per-chunk record of finished stages, used to resume interrupted runs.
+
+`<chunk output_dir>/stages.json` holds one entry per finished HelioManager stage with
+the size and sha256 of the files it read and wrote. On resume a stage is skipped only if
+its outputs still match the recorded checksums and its inputs are the ones it was run on,
+so partial or corrupt outputs and stages downstream of a redone stage are run again.
+"""
+from pathlib import Path
+import json
+import os
+import time
+from cache import file_hash
+
+STAGE_MANIFEST_FILE_NAME = "stages.json"
+
+
+def describe_files(files: list[Path]) -> dict:
+    return {Path(f).name: {'bytes': os.path.getsize(f), 'sha256': file_hash(f)} for f in files}
+
+
+def normalize(params: dict) -> dict:
+    """`params` as they read back from JSON, so that Paths and tuples compare equal."""
+    return json.loads(json.dumps(params or {}, sort_keys=True, default=str))
+
+
+def files_match(files: list[Path], described: dict) -> bool:
+    """True if every file exists with the size and checksum recorded in `described`."""
+    if set(described) != {Path(f).name for f in files}:
+        return False
+    for f in files:
+        entry = described[Path(f).name]
+        # the size check catches truncated files without reading them
+        if not os.path.isfile(f) or os.path.getsize(f) != entry['bytes'] or file_hash(f) != entry['sha256']:
+            return False
+    return True
+
+
+class StageManifest:
+    """The stages.json of one chunk output dir."""
+
+    def __init__(self, output_dir: Path) -> None:
+        self.path = Path(output_dir) / STAGE_MANIFEST_FILE_NAME
+
+    def load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save(self, stages: dict) -> None:
+        # written to a temporary file and renamed, an interrupted write leaves the old manifest
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(stages, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def is_complete(self, stage: str, inputs: list[Path], outputs: list[Path], params: dict = None) -> bool:
+        """True if `stage` finished with the same `params` and `inputs` and its outputs are intact."""
+        entry = self.load().get(stage)
+        if entry is None or entry.get('params') != normalize(params):
+            return False
+        return files_match(inputs, entry['inputs']) and files_match(outputs, entry['outputs'])
+
+    def record(self, stage: str, inputs: list[Path], outputs: list[Path], params: dict = None) -> None:
+        stages = self.load()
+        stages[stage] = {'finished': time.time(), 'params': normalize(params),
+                         'inputs': describe_files(inputs), 'outputs': describe_files(outputs)}
+        self.save(stages)
+
+    def invalidate(self, stage: str) -> None:
+        stages = self.load()
+        if stages.pop(stage, None) is not None:
+            self.save(stages)
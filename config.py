@@ -1,8 +1,10 @@
 from pydantic import BaseModel
 from pathlib import Path
+import os
 import time
 
-HELIO_PATH = Path("./heliolinc2")
+# directory of the heliolinc2 checkout, HELIO_PATH=benchmarks/heliolinc2 selects the stand-ins
+HELIO_PATH = Path(os.environ.get("HELIO_PATH", "./heliolinc2"))
 
 
 def insert_postfix_to_filepath(filepath: str, p: str):
@@ -10,6 +12,14 @@ def insert_postfix_to_filepath(filepath: str, p: str):
     return '.'.join(a) + f"-{p}." + b
 
 
+class NativeBudget(BaseModel):
+    """Resource limits of one make_tracklets or heliolinc run, see helio.run_native. None is no limit."""
+    cpu_seconds: float | None = None
+    memory_bytes: int | None = None
+    # bytes written to the output files and the captured stdout together
+    output_bytes: int | None = None
+
+
 class HelioSharedConfig(BaseModel):
     size: int
     t: int
@@ -18,6 +28,41 @@ class HelioSharedConfig(BaseModel):
     earth_file: Path
     obs_file: Path
     colformat_file: Path
+    seed: int | None = None
+    # observatories that all observe every epoch of mjd_list, one detection each
+    obscodes: list[str] = ['W84']
+    guess_grid_options: dict = {}
+    # options of run_make_tracklets, also used by the kdtree backend and the tile margins:
+    # maxvel in deg/day and maxtime in days, the units of make_tracklets' -maxvel/-maxtime
+    make_tracklets_options: dict = {}
+    # sky tile size in degrees, make_tracklets runs once per tile when set (see tiling.py)
+    tile_deg: float | None = None
+    # "make_tracklets" runs the executable, "kdtree" pairs the detections in process (see pairing.py),
+    # "validate" runs both, keeps the make_tracklets output and writes their diff to pairing_diff.json
+    pairing_backend: str = "make_tracklets"
+    # per-chunk pair counts, true vs cross-object pairs and growth with maxvel (see pairstats.py)
+    pair_diagnostics: bool = True
+    # per-run limits of the native binaries by name ('make_tracklets', 'heliolinc'); a run over
+    # its budget is killed and its chunk fails without retries
+    native_budgets: dict[str, NativeBudget] = {}
+    # number of guess-grid shards linked by parallel heliolinc runs (see sharding.py)
+    heliolinc_shards: int | None = None
+    # fixed bins of the per-chunk (r, rdot) histograms of linked objects (see histogram.py)
+    hist_bins: int = 120
+    hist_r_range: tuple[float, float] = (0, 100)
+    hist_rdot_range: tuple[float, float] = (-0.05, 0.05)
+    # sub-batches of objects generated one after the other within a chunk, at most
+    # dets_batch_size objects and an estimated dets_memory_bytes each (see utils.plan_dets_batches)
+    dets_batch_size: int | None = None
+    dets_memory_bytes: int | None = None
+    # float32 instead of float64 for the derived truth columns d/x/y/z of the detections and
+    # heliodist/heliovel/helioacc of the extracted results; the truth fit stays float64
+    derived_float32: bool = False
+    cache_dir: Path | None = None
+    cache_max_bytes: int = 20 * 1024**3
+    ephemeris_dir: Path | None = None
+    # skip the chunk stages that stages.json records as finished, see checkpoint.py
+    resume: bool = False
 
     @property
     def mjd_ref(self):
@@ -32,6 +77,8 @@ class HelioOutputConfig(BaseModel):
 
     startOidIndex: int
     output_dir: Path
+    # number of objects in this chunk, HelioSharedConfig.size if None
+    size: int | None = None
 
     def create_output_dir(self):
         self.output_dir.mkdir(parents=True, exist_ok=True)
@@ -53,6 +100,22 @@ class HelioOutputConfig(BaseModel):
     def out_pairs_file(self):
         return self.output_dir / "pairs.csv"
 
+    @property
+    def kdtree_pairdets_file(self):
+        return self.output_dir / "kdtree_pairdets.csv"
+
+    @property
+    def kdtree_pairs_file(self):
+        return self.output_dir / "kdtree_pairs.csv"
+
+    @property
+    def pairing_diff_file(self):
+        return self.output_dir / "pairing_diff.json"
+
+    @property
+    def pair_stats_file(self):
+        return self.output_dir / "pair_stats.json"
+
     @property
     def out_hl_file(self):
         return self.output_dir / "hl_out.csv"
@@ -61,6 +124,34 @@ class HelioOutputConfig(BaseModel):
     def out_hlsum_file(self):
         return self.output_dir / "hl_outsum.csv"
 
+    @property
+    def batches_dir(self):
+        return self.output_dir / "batches"
+
+    @property
+    def tiles_dir(self):
+        return self.output_dir / "tiles"
+
+    @property
+    def shards_dir(self):
+        return self.output_dir / "shards"
+
     @property
     def out_hl_extracted_file(self):
         return self.output_dir / "hl_extracted.feather"
+
+    @property
+    def hist_file(self):
+        return self.output_dir / "hist.npz"
+
+
+class SweepConfig(BaseModel):
+    """Parameter grids of a sweep, see sweep.py.
+
+    Each grid maps an option name to the list of its values, every combination is run:
+    - make_tracklets_grid: options of run_make_tracklets, e.g. {'maxvel': [1, 2], 'maxtime': [1.5, 5]}
+    - guess_grid_grid: options of create_helio_guess_grid, e.g. {'ns': [(50, 5, 1), (100, 10, 1)]}
+    """
+    output_dir: Path
+    make_tracklets_grid: dict[str, list] = {}
+    guess_grid_grid: dict[str, list] = {}
@@ -0,0 +1,86 @@
+"""Combined chunk outputs as Arrow tables and partitioned datasets.
+
+The per-chunk feather files are memory-mapped, so combining them costs one pass over
+the data. A partitioned dataset is described by a manifest that lists one file per
+chunk with its row count and size; it can be queried lazily with pyarrow.dataset
+without materializing the combined table.
+"""
+from pathlib import Path
+import json
+import os
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+def read_feather_mmap(path: Path) -> pa.Table:
+    """Reads a feather file through a memory map, zero-copy when it is uncompressed."""
+    return feather.read_table(str(path), memory_map=True)
+
+
+def concat_feather(paths: list[Path]) -> pa.Table:
+    """Concatenates feather files in a single pass; the result references the mapped chunks."""
+    tables = [read_feather_mmap(p) for p in paths]
+    if not tables:
+        raise ValueError("No feather files to concatenate")
+    # pandas metadata describes the index of the first chunk only
+    return pa.concat_tables(tables).replace_schema_metadata(None)
+
+
+def write_manifest(output_dir: Path, tables: dict[str, list[tuple[str, Path]]]) -> Path:
+    """Writes `output_dir`/manifest.json for `tables`, a mapping from table name to (chunk, file) pairs.
+
+    Paths are stored relative to `output_dir` so the run directory can be moved as a whole.
+    """
+    output_dir = Path(output_dir)
+    manifest = {'tables': {}}
+    for name, parts in tables.items():
+        entries = []
+        schema = None
+        for chunk, path in parts:
+            path = Path(path)
+            with pa.memory_map(str(path)) as source:
+                reader = pa.ipc.open_file(source)
+                rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+                schema = schema or reader.schema.remove_metadata()
+            entries.append({'chunk': chunk, 'path': os.path.relpath(path, output_dir),
+                            'rows': rows, 'bytes': path.stat().st_size})
+        manifest['tables'][name] = {
+            'schema': {f.name: str(f.type) for f in schema} if schema is not None else {},
+            'rows': sum(e['rows'] for e in entries),
+            'parts': entries,
+        }
+    path = output_dir / MANIFEST_FILE_NAME
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return path
+
+
+def read_manifest(output_dir: Path) -> dict:
+    with open(Path(output_dir) / MANIFEST_FILE_NAME) as f:
+        return json.load(f)
+
+
+def open_dataset(output_dir: Path, name: str) -> ds.Dataset:
+    """Lazy pyarrow dataset over the chunk files of table `name` listed in the manifest."""
+    output_dir = Path(output_dir)
+    parts = read_manifest(output_dir)['tables'][name]['parts']
+    return ds.dataset([str(output_dir / p['path']) for p in parts], format='ipc')
+
+
+def read_combined(output_dir: Path, name: str, columns: list[str] = None, filter=None):
+    """Reads table `name` of a run as a pandas frame, from the partitioned dataset if the
+    run has a manifest and from the combined `<name>.feather` otherwise.
+    """
+    output_dir = Path(output_dir)
+    if (output_dir / MANIFEST_FILE_NAME).exists():
+        table = open_dataset(output_dir, name).to_table(columns=columns, filter=filter)
+    else:
+        table = read_feather_mmap(output_dir / f"{name}.feather")
+        if filter is not None:
+            table = table.filter(filter)
+        if columns is not None:
+            table = table.select(columns)
+    return table.to_pandas()
@@ -0,0 +1,108 @@
+from pathlib import Path
+import json
+import numpy as np
+from astropy.time import Time
+from astropy import units as u
+
+from spacerocks.units import Units
+from spacerocks.simulation import Simulation
+from spacerocks.model import PerturberModel, builtin_models
+from spacerocks.observer import Observer
+from spacerocks.spacerock import SpaceRock
+
+
+def simulation_units() -> Units:
+    units = Units()
+    units.timescale = 'utc'
+    units.timeformat = 'jd'
+    units.mass = u.M_sun
+    return units
+
+
+def observatory_positions(jd: np.ndarray, obscodes: list[str]) -> np.ndarray:
+    """(n_obscodes, n_epochs, 3) heliocentric x, y, z (au) of every observatory at `jd`.
+
+    Velocities are not kept, the astrometry applies no aberration (see astrometry.py)."""
+    observer = np.empty((len(obscodes), len(jd), 3), dtype=np.double)
+    for k, obscode in enumerate(obscodes):
+        o = Observer.from_obscode(obscode).at(jd)
+        observer[k] = np.array([o.x.au, o.y.au, o.z.au], dtype=np.double).T
+    return observer
+
+
+class Ephemeris:
+    """Observer and perturber states shared by every chunk of a run.
+
+    - jd: (n_epochs,) julian dates of the observations
+    - observer: (n_obscodes, n_epochs, 3) observer x, y, z (au) per epoch
+    - perturbers: (n_perturbers, 7) x, y, z, vx, vy, vz, m of the perturbers at jd[0], in simulation units
+
+    Saved as plain .npy files so that every worker process can memory-map them.
+    """
+
+    def __init__(self, jd: np.ndarray, obscodes: list[str], observer: np.ndarray,
+                 perturber_names: list[str], perturbers: np.ndarray) -> None:
+        self.jd = jd
+        self.obscodes = obscodes
+        self.observer = observer
+        self.perturber_names = perturber_names
+        self.perturbers = perturbers
+
+    @classmethod
+    def compute(cls, mjd_list: list[float], obscodes: list[str] = ('W84',), model: str = 'ORBITSPP') -> "Ephemeris":
+        times = Time(mjd_list, format='mjd', scale='utc')
+        jd = np.asarray(times.jd, dtype=np.double)
+
+        observer = observatory_positions(jd, obscodes)
+
+        # let spacerocks place the perturbers at the first epoch once, then keep their states
+        spiceids, kernel, masses = builtin_models[model]
+        sim = Simulation(model=PerturberModel(spiceids=spiceids, masses=masses),
+                         epoch=jd[0], units=simulation_units())
+        xyz = np.zeros((sim.N, 3), dtype=np.double)
+        vxvyvz = np.zeros((sim.N, 3), dtype=np.double)
+        sim.serialize_particle_data(xyz=xyz, vxvyvz=vxvyvz)
+        m = np.array([sim.particles[i].m for i in range(sim.N)], dtype=np.double)
+        perturbers = np.column_stack([xyz, vxvyvz, m])
+
+        return cls(jd, list(obscodes), observer, list(sim.perturber_names), perturbers)
+
+    def save(self, path: Path) -> None:
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / "jd.npy", self.jd)
+        np.save(path / "observer.npy", self.observer)
+        np.save(path / "perturbers.npy", self.perturbers)
+        with open(path / "meta.json", "w") as f:
+            json.dump({'obscodes': self.obscodes,
+                      'perturber_names': self.perturber_names}, f)
+        print(f"Saved ephemeris to {path}")
+
+    @classmethod
+    def load(cls, path: Path) -> "Ephemeris":
+        """Memory-maps a saved ephemeris, the pages are shared between all processes reading it."""
+        path = Path(path)
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+        return cls(np.load(path / "jd.npy", mmap_mode='r'), meta['obscodes'],
+                   np.load(path / "observer.npy", mmap_mode='r'),
+                   meta['perturber_names'], np.load(path / "perturbers.npy", mmap_mode='r'))
+
+    def observer_positions(self, obscodes: list[str]) -> np.ndarray:
+        """(len(obscodes), n_epochs, 3) observer positions, for `astrometry.observe`."""
+        missing = [code for code in obscodes if code not in self.obscodes]
+        if missing:
+            raise KeyError(f"The ephemeris has no states for the observatories {missing}")
+        return self.observer[[self.obscodes.index(code) for code in obscodes]]
+
+    def create_simulation(self, units: Units = None) -> Simulation:
+        """A Simulation at jd[0] seeded with the stored perturber states instead of SPICE lookups.
+
+        Every perturber is added to the model as a SpaceRock without an epoch, which Simulation
+        places at its stored state as is, like the SPICE bodies of `compute`.
+        """
+        units = units or simulation_units()
+        model = PerturberModel()
+        for name, (x, y, z, vx, vy, vz, m) in zip(self.perturber_names, self.perturbers):
+            model.add(SpaceRock(x=[x], y=[y], z=[z], vx=[vx], vy=[vy], vz=[vz], mass=[m], name=[name], units=units))
+        return Simulation(model=model, epoch=float(self.jd[0]), units=units)
@@ -1,6 +1,207 @@
+import asyncio
+import contextvars
+import functools
 import os
+import re
 import subprocess
-from config import HELIO_PATH
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from config import HELIO_PATH, NativeBudget
+import perf
+
+
+def native_executable(name: str) -> Path:
+    """Path of the `name` executable ("make_tracklets" or "heliolinc") of the HELIO_PATH checkout."""
+    return HELIO_PATH / 'src' / name
+
+
+def make_tracklets_argv(
+    dets: str, earth: str,
+    obscode: str,
+    colformat: str,
+    maxvel: float = 2,
+    maxtime: float = 5,
+    out_pairdets: str = "pairdetfile.csv",
+    out_pairs: str = "outpairfile",
+) -> list[str]:
+    """Command line of the make_tracklets executable, see `run_make_tracklets` for the parameters."""
+    return [str(native_executable('make_tracklets')), '-dets', str(dets), '-pairdets', str(out_pairdets),
+            '-pairs', str(out_pairs), '-earth', str(earth), '-obscode', str(obscode),
+            '-colformat', str(colformat), '-maxvel', str(maxvel), '-maxtime', str(maxtime)]
+
+
+def heliolinc_argv(
+        dets: str,
+        pairs: str,
+        mjd: int,
+        obspos: str,
+        heliodist: str,
+        out: str,
+        outsum: str,
+) -> list[str]:
+    """Command line of the heliolinc executable, see `run_heliolinc` for the parameters."""
+    return [str(native_executable('heliolinc')), '-dets', str(dets), '-pairs', str(pairs), '-mjd', str(mjd),
+            '-obspos', str(obspos), '-heliodist', str(heliodist), '-out', str(out), '-outsum', str(outsum)]
+
+
+# "<n> <what>" counts in the output of make_tracklets and heliolinc, the last value of each is kept
+COUNT_PATTERN = re.compile(
+    rb"(\d+) (paired detections|detections|pairs|tracklets|hypotheses|clusters|cluster rows|cluster summaries)\b")
+# "<i> of <n>" progress lines
+PROGRESS_PATTERN = re.compile(rb"(\d+) of (\d+)")
+MONITOR_INTERVAL = 0.5
+PROGRESS_INTERVAL = 30.0
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+class NativeRunAborted(subprocess.SubprocessError):
+    """A native run killed for going over its NativeBudget or by its caller, `kind` is 'cpu',
+    'memory', 'output' or 'cancelled'."""
+
+    def __init__(self, argv: list[str], kind: str, reason: str) -> None:
+        super().__init__(argv, kind, reason)
+        self.argv = argv
+        self.kind = kind
+        self.reason = reason
+
+    def __str__(self) -> str:
+        return f"{Path(self.argv[0]).name} aborted: {self.reason}"
+
+
+def process_usage(pid: int) -> tuple[float, int] | None:
+    """CPU seconds and resident bytes of a running process from /proc, None where it is unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat", 'rb') as f:
+            # fields after the parenthesized command name, utime/stime are the 14th/15th, rss the 24th
+            fields = f.read().rsplit(b")", 1)[1].split()
+    except (FileNotFoundError, ProcessLookupError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, int(fields[21]) * PAGE_SIZE
+
+
+class RunMonitor:
+    """Live state of one native run: output counts parsed from its stdout and the reason it was killed."""
+
+    def __init__(self, proc: subprocess.Popen, budget: NativeBudget, timeout: float | None, outputs: list,
+                 stop: threading.Event = None) -> None:
+        self.proc = proc
+        self.budget = budget
+        self.timeout = timeout
+        self.outputs = list(outputs)
+        self.name = Path(proc.args[0]).name
+        self.start = time.perf_counter()
+        self.counts = {}
+        self.log_bytes = 0
+        self.usage = None
+        self.abort = None  # (kind, reason)
+        # set when the child exited, or by the caller to kill it; `finished` tells the two apart
+        self.stop = stop or threading.Event()
+        self.finished = False
+
+    def copy_output(self, log) -> None:
+        """Copies the child's output to `log` line by line and keeps the counts it reports."""
+        for line in iter(self.proc.stdout.readline, b''):
+            log.write(line)
+            self.log_bytes += len(line)
+            for match in COUNT_PATTERN.finditer(line):
+                self.counts[match.group(2).decode().replace(' ', '_')] = int(match.group(1))
+            match = PROGRESS_PATTERN.search(line)
+            if match is not None:
+                self.counts['progress'] = f"{int(match.group(1))}/{int(match.group(2))}"
+
+    def output_bytes(self) -> int:
+        return self.log_bytes + sum(os.path.getsize(p) for p in self.outputs if os.path.exists(p))
+
+    def over_budget(self, elapsed: float) -> tuple[str, str] | None:
+        if self.timeout is not None and elapsed > self.timeout:
+            return 'timeout', f"timed out after {self.timeout}s"
+        if self.usage is not None:
+            cpu, rss = self.usage
+            if self.budget.cpu_seconds is not None and cpu > self.budget.cpu_seconds:
+                return 'cpu', f"{cpu:.0f}s cpu over the budget of {self.budget.cpu_seconds}s"
+            if self.budget.memory_bytes is not None and rss > self.budget.memory_bytes:
+                return 'memory', f"{rss / 2**20:.0f} MiB resident over the budget of {self.budget.memory_bytes / 2**20:.0f} MiB"
+        if self.budget.output_bytes is not None:
+            written = self.output_bytes()
+            if written > self.budget.output_bytes:
+                return 'output', f"{written / 2**20:.0f} MiB written over the budget of {self.budget.output_bytes / 2**20:.0f} MiB"
+        return None
+
+    def watch(self) -> None:
+        """Samples the child every MONITOR_INTERVAL, kills it once it is over budget and prints
+        its progress every PROGRESS_INTERVAL. Kills it at once if `stop` is set before it exited."""
+        last_report = self.start
+        while not self.stop.wait(MONITOR_INTERVAL):
+            self.usage = process_usage(self.proc.pid) or self.usage
+            now = time.perf_counter()
+            self.abort = self.over_budget(now - self.start)
+            if self.abort is not None:
+                self.proc.kill()
+                return
+            if now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                usage = f", {self.usage[0]:.0f}s cpu, {self.usage[1] / 2**20:.0f} MiB" if self.usage else ""
+                print(f"{self.name} [{self.proc.pid}]: {now - self.start:.0f}s{usage}, {self.counts}", flush=True)
+        if not self.finished:
+            self.abort = 'cancelled', "cancelled by the caller"
+            self.proc.kill()
+
+
+def run_native(argv: list[str], stdout_file: str, timeout: float = None, inputs: list = (), outputs: list = (),
+               budget: NativeBudget = None, extra_outputs: list = (), cancel: threading.Event = None) -> dict:
+    """Runs `argv` without a shell, copying stdout and stderr to `stdout_file` as they are written.
+
+    The output is parsed live for the counts the binaries report (detections, pairs, clusters, ...)
+    and the run is sampled every MONITOR_INTERVAL: it is killed once it takes longer than `timeout`
+    seconds or goes over the CPU time, resident memory or output size of `budget` (CPU and memory
+    are read from /proc, so they are only enforced on Linux). The child is reaped with os.wait4 so
+    that its own CPU time and peak RSS are recorded, together with the row counts of the `inputs`
+    and `outputs` files, the parsed counts and the abort reason (see perf.py). `extra_outputs` are
+    only counted toward the output size. Setting `cancel` from another thread kills the run; the
+    event is also set once the child exited.
+    Raises subprocess.CalledProcessError on a non-zero exit code, subprocess.TimeoutExpired if the
+    run took longer than `timeout` and NativeRunAborted if it went over its budget or was cancelled.
+    """
+    with open(stdout_file, 'wb') as log:
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        monitor = RunMonitor(proc, budget or NativeBudget(), timeout, [*outputs, *extra_outputs], cancel)
+        reader = threading.Thread(target=monitor.copy_output, args=(log,), daemon=True)
+        watcher = threading.Thread(target=monitor.watch, daemon=True)
+        reader.start()
+        watcher.start()
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+            monitor.finished = True
+        finally:
+            monitor.stop.set()
+            watcher.join()
+            reader.join()
+            proc.stdout.close()
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.perf_counter() - monitor.start
+        if monitor.abort is not None:
+            log.write(f"{monitor.name} killed: {monitor.abort[1]}\n".encode())
+
+    fields = {'returncode': proc.returncode,
+              'rows_in': sum(perf.count_rows(p) for p in inputs) if inputs else None,
+              'rows_out': sum(perf.count_rows(p) for p in outputs if os.path.exists(p)) if outputs else None,
+              'output_counts': monitor.counts}
+    if monitor.abort is not None:
+        fields['aborted'], fields['error'] = monitor.abort
+    elif proc.returncode != 0:
+        fields['error'] = f"exit code {proc.returncode}"
+    record = perf.record_child(Path(argv[0]).name, wall, rusage, **fields)
+
+    if monitor.abort is not None:
+        if monitor.abort[0] == 'timeout':
+            raise subprocess.TimeoutExpired(argv, timeout)
+        raise NativeRunAborted(argv, *monitor.abort)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, argv)
+    return record
 
 
 def run_make_tracklets(
@@ -12,6 +213,8 @@ def run_make_tracklets(
     out_pairdets: str = "pairdetfile.csv",
     out_pairs: str = "outpairfile",
     stdout_file: str = "./temp/make_tracklets_output.txt",
+    timeout: float = None,
+    budget: NativeBudget = None,
 ):
     """
     Runs the make_tracklets executable with the given parameters.
@@ -22,18 +225,16 @@ def run_make_tracklets(
     - earth (str): The name of the input file that contains the Earth's position and velocity as a function of time.
     - obscode (str): The name of the input file that contains the observatory codes and their geocentric positions.
     - colformat (str): The name of the input file that specifies the column format of the detection catalog file.
-    - maxvel (float): Maximum angular velocity for valid pairs or tracklets
-    - maxtime (float): Maximum time between detections in a pair
+    - maxvel (float): Maximum angular velocity for valid pairs or tracklets in deg/day
+    - maxtime (float): Maximum time between detections in a pair in days
     - out_pairdets (str): The name of the output paired detection file in CSV format.
     - out_pairs (str): The name of the output pair file that records the pairs and longer tracklets.
+    - timeout (float): Seconds after which the run is killed, no limit if None.
+    - budget (NativeBudget): CPU time, memory and output size over which the run is killed.
     """
-    # Construct the command string with the given parameters
-    cmd = f"{HELIO_PATH / 'src/make_tracklets'} -dets {dets} -pairdets {out_pairdets} -pairs {out_pairs} \
-        -earth {earth} -obscode {obscode} -colformat {colformat} -maxvel {maxvel} -maxtime {maxtime}"
-
-    # Execute the command using os.system
-    with open(stdout_file, 'w') as f:
-        subprocess.run(cmd, shell=True, stdout=f, stderr=f)
+    run_native(make_tracklets_argv(dets, earth, obscode, colformat, maxvel, maxtime, out_pairdets, out_pairs),
+               stdout_file, timeout, inputs=[dets], outputs=[out_pairdets], budget=budget,
+               extra_outputs=[out_pairs])
 
 
 def run_heliolinc(
@@ -44,7 +245,9 @@ def run_heliolinc(
         heliodist: str,
         out: str,
         outsum: str,
-        stdout_file: str
+        stdout_file: str,
+        timeout: float = None,
+        budget: NativeBudget = None,
 ):
     """
     Runs the heliolinc executable with the given parameters.
@@ -58,9 +261,100 @@ def run_heliolinc(
     - out (str): The name of the output file that contains the heliocentric orbital elements of the objects.
     - outsum (str): The name of the output file that contains the summary of the heliocentric orbital elements of the objects.
     - stdout_file (str): The name of the file to write the stdout and stderr to.
+    - timeout (float): Seconds after which the run is killed, no limit if None.
+    - budget (NativeBudget): CPU time, memory and output size over which the run is killed.
+    """
+    run_native(heliolinc_argv(dets, pairs, mjd, obspos, heliodist, out, outsum),
+               stdout_file, timeout, inputs=[dets], outputs=[outsum], budget=budget,
+               extra_outputs=[out])
+
+
+async def run_native_async(argv: list[str], stdout_file: str, timeout: float = None, inputs: list = (), outputs: list = (),
+                           budget: NativeBudget = None, extra_outputs: list = (), executor: Executor = None) -> dict:
+    """asyncio counterpart of `run_native`, the blocking wait happens in a thread of `executor`
+    (the loop's default one if None) so the event loop stays free while the binary runs.
+    Cancelling the coroutine kills the child and returns once it has been reaped.
     """
-    cmd = f"{HELIO_PATH / 'src/heliolinc'} -dets {dets} -pairs {pairs} -mjd {mjd} \
-            -obspos {obspos} -heliodist {heliodist} -out {out} -outsum {outsum}"
+    cancel = threading.Event()
+    # like asyncio.to_thread, the thread runs in a copy of the context so the perf records go to the chunk's sink
+    call = functools.partial(contextvars.copy_context().run, run_native, argv, stdout_file, timeout, inputs, outputs,
+                             budget, extra_outputs, cancel)
+    run = asyncio.get_running_loop().run_in_executor(executor, call)
+    try:
+        return await asyncio.shield(run)
+    except asyncio.CancelledError:
+        cancel.set()
+        # the thread's NativeRunAborted is not wanted, only the child being gone
+        await asyncio.wait([run])
+        if not run.cancelled():
+            run.exception()
+        raise
+
+
+async def gather_native(*runs) -> list:
+    """Awaits the native run coroutines `runs` together and returns their results. Once one of
+    them raises, the others are cancelled, which kills their children, and its exception is
+    raised as is rather than as an ExceptionGroup."""
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(run) for run in runs]
+    except BaseExceptionGroup as errors:
+        raise errors.exceptions[0] from None
+    return [task.result() for task in tasks]
+
+
+class NativeRunner:
+    """Runs make_tracklets and heliolinc from asyncio with a concurrency limit per binary.
+
+    The runs wait in threads of the runner's own pool, sized to the sum of the limits, so that
+    the limits are not capped by the event loop's default executor.
+
+    - limits: maximum number of simultaneous runs per binary name
+    - timeouts: per-invocation timeout in seconds per binary name, no limit if missing
+    - budgets: per-invocation NativeBudget per binary name, no limit if missing
+
+    `close` (or leaving a `with NativeRunner() as runner:` block) shuts the pool down.
+    """
+
+    def __init__(self, limits: dict[str, int] = None, timeouts: dict[str, float] = None,
+                 budgets: dict[str, NativeBudget] = None) -> None:
+        cpus = os.cpu_count() or 1
+        self.limits = {'make_tracklets': cpus, 'heliolinc': cpus, **(limits or {})}
+        self.timeouts = timeouts or {}
+        self.budgets = budgets or {}
+        self.semaphores = {}
+        self.executor = ThreadPoolExecutor(max_workers=sum(self.limits.values()), thread_name_prefix="native")
+
+    def close(self) -> None:
+        """Shuts the thread pool down once the runs in it are over."""
+        self.executor.shutdown()
+
+    def __enter__(self) -> "NativeRunner":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def semaphore(self, binary: str) -> asyncio.Semaphore:
+        # created lazily so that they belong to the running event loop
+        if binary not in self.semaphores:
+            self.semaphores[binary] = asyncio.Semaphore(self.limits[binary])
+        return self.semaphores[binary]
+
+    async def run(self, binary: str, argv: list[str], stdout_file: str, inputs: list = (), outputs: list = (),
+                  extra_outputs: list = ()) -> dict:
+        async with self.semaphore(binary):
+            return await run_native_async(argv, stdout_file, self.timeouts.get(binary), inputs, outputs,
+                                          self.budgets.get(binary), extra_outputs, self.executor)
+
+    async def make_tracklets(self, dets: str, earth: str, obscode: str, colformat: str,
+                             stdout_file: str = "./temp/make_tracklets_output.txt", **kwargs) -> dict:
+        argv = make_tracklets_argv(dets, earth, obscode, colformat, **kwargs)
+        return await self.run('make_tracklets', argv, stdout_file, inputs=[dets],
+                              outputs=[kwargs.get('out_pairdets', "pairdetfile.csv")],
+                              extra_outputs=[kwargs.get('out_pairs', "outpairfile")])
 
-    with open(stdout_file, 'w') as f:
-        subprocess.run(cmd, shell=True, stdout=f, stderr=f)
+    async def heliolinc(self, dets: str, pairs: str, mjd: int, obspos: str, heliodist: str,
+                        out: str, outsum: str, stdout_file: str) -> dict:
+        argv = heliolinc_argv(dets, pairs, mjd, obspos, heliodist, out, outsum)
+        return await self.run('heliolinc', argv, stdout_file, inputs=[dets], outputs=[outsum], extra_outputs=[out])
@@ -0,0 +1,95 @@
+"""Streaming (r, rdot) histograms of linked and all objects.
+
+Each chunk bins its objects on fixed edges right after its heliolinc results are
+extracted and saves the counts (a few hundred KiB) next to its outputs; the run's
+histogram is the sum of the chunk histograms, so the linked-fraction map is plotted
+without loading or combining the per-object tables.
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+HIST_FILE_NAME = "hist.npz"
+
+
+def truth_at(obj_table: pd.DataFrame, mjd: float) -> tuple[np.ndarray, np.ndarray]:
+    """Heliocentric distance (au) and radial velocity (au/day) of every object at `mjd`.
+
+    The truth fit coefficients of extract_object_truth_values are in raw MJD
+    (np.polyfit convention), so they are evaluated at the reference epoch.
+    """
+    a = obj_table['helioAcc'].to_numpy()
+    b = obj_table['helioVel'].to_numpy()
+    c = obj_table['helioDist'].to_numpy()
+    return (a * mjd + b) * mjd + c, 2 * a * mjd + b
+
+
+class LinkedHistogram:
+    """Counts of linked and of all objects on uniform (r, rdot) bins.
+
+    Objects outside the edges are counted in `outside` instead of being dropped silently.
+    """
+
+    def __init__(self, r_edges: np.ndarray, rdot_edges: np.ndarray, linked: np.ndarray = None,
+                 total: np.ndarray = None, outside: int = 0) -> None:
+        self.r_edges = np.asarray(r_edges, dtype=np.double)
+        self.rdot_edges = np.asarray(rdot_edges, dtype=np.double)
+        shape = (len(self.r_edges) - 1, len(self.rdot_edges) - 1)
+        self.linked = np.zeros(shape, dtype=np.int64) if linked is None else np.asarray(linked)
+        self.total = np.zeros(shape, dtype=np.int64) if total is None else np.asarray(total)
+        self.outside = int(outside)
+
+    @classmethod
+    def from_range(cls, bins: int, r_range: tuple, rdot_range: tuple) -> "LinkedHistogram":
+        return cls(np.linspace(*r_range, bins + 1), np.linspace(*rdot_range, bins + 1))
+
+    def bin_index(self, edges: np.ndarray, x: np.ndarray) -> np.ndarray:
+        n = len(edges) - 1
+        i = np.floor((x - edges[0]) / (edges[-1] - edges[0]) * n)
+        # the last edge belongs to the last bin, like np.histogram2d
+        i[x == edges[-1]] = n - 1
+        return i
+
+    def add(self, r: np.ndarray, rdot: np.ndarray, linked: np.ndarray) -> None:
+        """Adds objects at (`r`, `rdot`), `linked` is True for the linked ones."""
+        i = self.bin_index(self.r_edges, r)
+        j = self.bin_index(self.rdot_edges, rdot)
+        inside = (i >= 0) & (i < self.total.shape[0]) & (j >= 0) & (j < self.total.shape[1])
+        self.outside += int(len(inside) - inside.sum())
+        flat = i[inside].astype(np.int64) * self.total.shape[1] + j[inside].astype(np.int64)
+        size = self.total.size
+        self.total += np.bincount(flat, minlength=size).reshape(self.total.shape)
+        self.linked += np.bincount(flat[linked[inside]], minlength=size).reshape(self.total.shape)
+
+    def __iadd__(self, other: "LinkedHistogram") -> "LinkedHistogram":
+        if not (np.array_equal(self.r_edges, other.r_edges) and np.array_equal(self.rdot_edges, other.rdot_edges)):
+            raise ValueError("Histograms with different bin edges cannot be summed")
+        self.linked += other.linked
+        self.total += other.total
+        self.outside += other.outside
+        return self
+
+    def fraction(self) -> np.ndarray:
+        """Linked / all objects per bin, 0 for empty bins."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.nan_to_num(self.linked / self.total, nan=0)
+
+    def save(self, path: Path) -> None:
+        np.savez(path, r_edges=self.r_edges, rdot_edges=self.rdot_edges,
+                 linked=self.linked, total=self.total, outside=self.outside)
+
+    @classmethod
+    def load(cls, path: Path) -> "LinkedHistogram":
+        with np.load(path) as f:
+            return cls(f['r_edges'], f['rdot_edges'], f['linked'], f['total'], int(f['outside']))
+
+    @classmethod
+    def combine(cls, paths: list[Path]) -> "LinkedHistogram":
+        """Sum of the saved histograms `paths`."""
+        paths = list(paths)
+        if not paths:
+            raise ValueError("No histograms to combine")
+        res = cls.load(paths[0])
+        for path in paths[1:]:
+            res += cls.load(path)
+        return res
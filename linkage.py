@@ -0,0 +1,140 @@
+"""Sparse object x hypothesis index of the heliolinc linkages.
+
+Objects (ObjID) and hypotheses (heliodist, heliovel) are encoded as integer codes, and
+every extracted cluster adds one to the (hypothesis, object) cell of a sparse matrix
+kept in compressed-row form for both orientations (plain numpy, no scipy). The objects
+linked by a hypothesis and the hypotheses that linked an object are contiguous slices,
+and per-hypothesis statistics are vectorized reductions over the stored cells.
+"""
+import numpy as np
+import pandas as pd
+
+# (u.km / u.s).to(u.au / u.day), spelled out to keep astropy out of the workers
+KM_PER_S_TO_AU_PER_DAY = 86400 / 149597870.7
+
+
+def hypothesis_keys(r, rdot, decimals: int = 3) -> pd.MultiIndex:
+    """(r, rdot) on the rounding of the guess grid (see create_helio_guess_grid's n_round)."""
+    return pd.MultiIndex.from_arrays([np.round(np.asarray(r, dtype=np.double), decimals),
+                                      np.round(np.asarray(rdot, dtype=np.double), decimals)],
+                                     names=['r', 'rdot'])
+
+
+def compress(rows: np.ndarray, cols: np.ndarray, n_rows: int):
+    """indptr, column indices and counts of the (rows, cols) cells, with repeated cells summed."""
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    starts = np.flatnonzero(first)
+    counts = np.diff(np.append(starts, len(rows)))
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[starts], minlength=n_rows), out=indptr[1:])
+    return indptr, cols[starts], counts
+
+
+class LinkageIndex:
+    """Clusters per (hypothesis, object), built from the extracted heliolinc output.
+
+    - obj_ids: ObjID of every object of the population (obj_table['ObjID'])
+    - hypotheses: MultiIndex of the (r, rdot) hypotheses, see `hypothesis_keys`
+    - indptr/objects/counts: hypothesis-major compressed rows
+    - obj_indptr/obj_hypotheses/obj_counts: object-major compressed rows of the same cells
+    - pure_clusters: clusters per hypothesis whose detections all belong to their object, None
+      if the extracted results have no `pure` column
+
+    Linked objects that are missing from `obj_ids` and hypotheses missing from the guess
+    table are appended to the codes, so no linkage is lost.
+    """
+
+    def __init__(self, obj_ids, hypotheses: pd.MultiIndex, hyp_codes: np.ndarray, obj_codes: np.ndarray,
+                 pure: np.ndarray = None) -> None:
+        self.obj_ids = np.asarray(obj_ids)
+        self.hypotheses = hypotheses
+        self.n_clusters = len(hyp_codes)
+        self.pure_clusters = None
+        if pure is not None:
+            self.pure_clusters = np.bincount(hyp_codes, weights=np.asarray(pure, dtype=bool),
+                                             minlength=len(hypotheses)).astype(np.int64)
+        self.indptr, self.objects, self.counts = compress(hyp_codes, obj_codes, len(hypotheses))
+        self.obj_indptr, self.obj_hypotheses, self.obj_counts = compress(obj_codes, hyp_codes, len(self.obj_ids))
+        self.obj_lookup = pd.Index(self.obj_ids)
+
+    @classmethod
+    def build(cls, helio_extracted: pd.DataFrame, obj_table: pd.DataFrame, guess_table: pd.DataFrame = None) -> "LinkageIndex":
+        ids = helio_extracted['ObjID'].to_numpy()
+        keys = hypothesis_keys(helio_extracted['heliodist'], helio_extracted['heliovel'] * KM_PER_S_TO_AU_PER_DAY)
+
+        obj_ids = pd.Index(obj_table['ObjID'].to_numpy())
+        obj_codes = obj_ids.get_indexer(ids)
+        if (obj_codes < 0).any():
+            extra = pd.Index(pd.unique(ids[obj_codes < 0]))
+            obj_ids = obj_ids.append(extra)
+            obj_codes = obj_ids.get_indexer(ids)
+
+        if guess_table is not None:
+            hypotheses = hypothesis_keys(guess_table['#r(AU)'], guess_table['rdot(AU/day)']).unique()
+        else:
+            hypotheses = keys[:0]
+        hyp_codes = hypotheses.get_indexer(keys)
+        if (hyp_codes < 0).any():
+            hypotheses = hypotheses.append(keys[hyp_codes < 0].unique())
+            hyp_codes = hypotheses.get_indexer(keys)
+        pure = helio_extracted['pure'].to_numpy() if 'pure' in helio_extracted else None
+        return cls(obj_ids.to_numpy(), hypotheses, hyp_codes, obj_codes, pure)
+
+    @property
+    def n_hypotheses(self) -> int:
+        return len(self.hypotheses)
+
+    @property
+    def n_objects(self) -> int:
+        return len(self.obj_ids)
+
+    def hypothesis_code(self, g) -> int:
+        """Code of a hypothesis given as its code or as an (r, rdot) tuple."""
+        if isinstance(g, tuple):
+            return self.hypotheses.get_loc((round(g[0], 3), round(g[1], 3)))
+        return g
+
+    def objects_linked_by(self, g) -> np.ndarray:
+        """ObjIDs linked by hypothesis `g`."""
+        g = self.hypothesis_code(g)
+        return self.obj_ids[self.objects[self.indptr[g]:self.indptr[g + 1]]]
+
+    def hypotheses_linking(self, obj_id) -> pd.MultiIndex:
+        """(r, rdot) of the hypotheses that linked object `obj_id`."""
+        o = self.obj_lookup.get_loc(obj_id)
+        return self.hypotheses[self.obj_hypotheses[self.obj_indptr[o]:self.obj_indptr[o + 1]]]
+
+    def linked_mask(self) -> np.ndarray:
+        """True for every object (in `obj_ids` order) linked by at least one hypothesis."""
+        return np.diff(self.obj_indptr) > 0
+
+    def stats(self) -> pd.DataFrame:
+        """Per-hypothesis linkage statistics.
+
+        - clusters: clusters found under the hypothesis
+        - objects: distinct objects they link
+        - completeness: fraction of all objects linked by the hypothesis
+        - purity: fraction of the clusters whose detections all belong to one object (NaN if unknown)
+        - objects_per_cluster: distinct objects per cluster, 1 without duplicate linkages
+        - unique: objects linked by this hypothesis only
+        """
+        objects = np.diff(self.indptr)
+        hyp_of_cell = np.repeat(np.arange(self.n_hypotheses), objects)
+        clusters = np.bincount(hyp_of_cell, weights=self.counts, minlength=self.n_hypotheses).astype(np.int64)
+        only_one = np.diff(self.obj_indptr)[self.objects] == 1
+        unique = np.bincount(hyp_of_cell[only_one], minlength=self.n_hypotheses)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return pd.DataFrame({
+                'r': self.hypotheses.get_level_values('r'),
+                'rdot': self.hypotheses.get_level_values('rdot'),
+                'clusters': clusters,
+                'objects': objects,
+                'completeness': objects / max(self.n_objects, 1),
+                'purity': (self.pure_clusters / clusters if self.pure_clusters is not None
+                           else np.full(self.n_hypotheses, np.nan)),
+                'objects_per_cluster': objects / clusters,
+                'unique': unique,
+            })
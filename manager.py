@@ -1,7 +1,18 @@
-from utils import create_observations_spacerocks, create_random_objects, create_helio_guess_grid, extract_heliolinc_results, extract_object_truth_values, timeit
-from destnosim import ElementPopulation
-from helio import run_make_tracklets, run_heliolinc
+from utils import DetectionSpool, DetectionWriter, interleave_spools, plan_dets_batches, create_observations_spacerocks, create_random_objects, create_helio_guess_grid, extract_heliolinc_results, extracted_schema, write_heliolinc_results, extract_object_truth_values
+from helio import run_make_tracklets, native_executable, NativeRunner
+from cache import ArtifactCache, file_hash
+from checkpoint import StageManifest
+from histogram import LinkedHistogram, truth_at
 from config import *
+from perf import instrumented, annotate, table_bytes
+from tiling import read_dets, run_tiled_make_tracklets
+from pairing import diff_pairs, run_kdtree_pairing
+from pairstats import write_pair_stats
+from sharding import run_sharded_heliolinc
+import asyncio
+import inspect
+import shutil
+import numpy as np
 import pandas as pd
 
 
@@ -9,48 +20,352 @@ class HelioManager():
 
     sharedConfig: HelioSharedConfig
     outputConfig: HelioOutputConfig
+    cache: ArtifactCache | None
+    stages: StageManifest
 
     def __init__(self, sharedConfig: HelioSharedConfig, outputConfig: HelioOutputConfig) -> None:
         self.sharedConfig = sharedConfig
         self.outputConfig = outputConfig
+        self.cache = None
+        if sharedConfig.cache_dir is not None:
+            self.cache = ArtifactCache(sharedConfig.cache_dir, sharedConfig.cache_max_bytes)
+        self.stages = StageManifest(outputConfig.output_dir)
 
-    @timeit
+    @property
+    def size(self) -> int:
+        """Number of objects of this chunk."""
+        if self.outputConfig.size is not None:
+            return self.outputConfig.size
+        return self.sharedConfig.size
+
+    def run_cached(self, stage: str, inputs: dict | None, files: list[Path], produce) -> bool:
+        """Calls `produce` to create `files` unless the cache already holds them for `inputs`.
+
+        `inputs` is None when the stage is not reproducible (e.g. unseeded detections).
+        Returns True if the files were restored from the cache.
+        """
+        if self.cache is None or inputs is None:
+            produce()
+            return False
+        key = self.cache.key(stage, inputs)
+        if self.cache.restore(key, files):
+            print(
+                f"[Task {self.outputConfig.startOidIndex}] {stage}: restored from cache {key[:12]}")
+            return True
+        produce()
+        self.cache.store(key, files)
+        return False
+
+    def stage_files(self, stage: str) -> tuple[list[Path], list[Path], dict]:
+        """Input files, output files and parameters of a chunk stage, as recorded in stages.json."""
+        if stage == "generate_dets":
+            return [], [self.outputConfig.dets_file, self.outputConfig.object_table_file], self.dets_params()
+        if stage == "run_helio":
+            # the earth, obscode and colformat files are static and only recorded by path
+            params = {'mjd': self.sharedConfig.mjd_ref, 'make_tracklets': self.sharedConfig.make_tracklets_options,
+                      'tile_deg': self.sharedConfig.tile_deg, 'heliolinc_shards': self.sharedConfig.heliolinc_shards,
+                      'earth': self.sharedConfig.earth_file, 'obscode': self.sharedConfig.obs_file,
+                      'colformat': self.sharedConfig.colformat_file}
+            if self.sharedConfig.pairing_backend != "make_tracklets":
+                params['pairing_backend'] = self.sharedConfig.pairing_backend
+            return [self.outputConfig.dets_file, self.sharedConfig.guess_file], self.helio_files(), params
+        if stage == "pair_diagnostics":
+            return [self.outputConfig.out_pairdets_file, self.outputConfig.out_pairs_file], \
+                [self.outputConfig.pair_stats_file], {'maxvel': self.maxvel()}
+        if stage == "extract_helio_results":
+            return [self.outputConfig.out_hl_file, self.outputConfig.out_hlsum_file, self.outputConfig.object_table_file], \
+                [self.outputConfig.out_hl_extracted_file, self.outputConfig.hist_file], \
+                {'hist_bins': self.sharedConfig.hist_bins, 'hist_r_range': self.sharedConfig.hist_r_range,
+                 'hist_rdot_range': self.sharedConfig.hist_rdot_range,
+                 'extracted_schema': extracted_schema(self.sharedConfig.derived_float32).to_string()}
+        raise ValueError(f"Unknown stage {stage}")
+
+    def resume_stage(self, stage: str) -> bool:
+        """With `resume`, True if `stage` already finished in this output dir and can be skipped.
+        Otherwise its record is dropped until `finish_stage` is called again.
+        """
+        if self.sharedConfig.resume and self.stages.is_complete(stage, *self.stage_files(stage)):
+            print(f"[Task {self.outputConfig.startOidIndex}] {stage}: already finished, skipped")
+            annotate(skipped=True)
+            return True
+        self.stages.invalidate(stage)
+        return False
+
+    def finish_stage(self, stage: str) -> None:
+        self.stages.record(stage, *self.stage_files(stage))
+
+    def guess_grid_inputs(self) -> dict:
+        params = inspect.signature(create_helio_guess_grid).bind(
+            None, **self.sharedConfig.guess_grid_options)
+        params.apply_defaults()
+        params = dict(params.arguments)
+        del params['out_filename']
+        return params
+
+    def dets_batches(self) -> list[tuple[int, int]]:
+        """(start, size) of the sub-batches of objects generated one after the other."""
+        return plan_dets_batches(self.size, len(self.sharedConfig.mjd_list) * len(self.sharedConfig.obscodes),
+                                 self.sharedConfig.dets_batch_size, self.sharedConfig.dets_memory_bytes)
+
+    def dets_params(self) -> dict:
+        params = {'size': self.size, 't': self.sharedConfig.t, 'mjd_list': self.sharedConfig.mjd_list,
+                  'seed': self.sharedConfig.seed, 'startOidIndex': self.outputConfig.startOidIndex,
+                  # dets.csv is written in the column layout of the colformat file
+                  'colformat': file_hash(self.sharedConfig.colformat_file)}
+        batches = self.dets_batches()
+        if len(batches) > 1:
+            # every sub-batch draws its objects from its own seed, a single batch keeps the chunk's
+            params['batches'] = batches
+        if self.sharedConfig.derived_float32:
+            params['derived_float32'] = True
+        if self.sharedConfig.obscodes != ['W84']:
+            params['obscodes'] = self.sharedConfig.obscodes
+        return params
+
+    def truth_dtype(self):
+        return np.float32 if self.sharedConfig.derived_float32 else np.double
+
+    def dets_inputs(self) -> dict | None:
+        if self.sharedConfig.seed is None:
+            return None
+        return self.dets_params()
+
+    def helio_inputs(self) -> dict:
+        inputs = {'dets': self.outputConfig.dets_file, 'earth': self.sharedConfig.earth_file,
+                  'obscode': self.sharedConfig.obs_file, 'colformat': self.sharedConfig.colformat_file,
+                  'guess': self.sharedConfig.guess_file, 'mjd': self.sharedConfig.mjd_ref,
+                  'make_tracklets': self.sharedConfig.make_tracklets_options, 'tile_deg': self.sharedConfig.tile_deg,
+                  'heliolinc_shards': self.sharedConfig.heliolinc_shards}
+        if self.sharedConfig.pairing_backend != "make_tracklets":
+            inputs['pairing_backend'] = self.sharedConfig.pairing_backend
+        inputs['executables'] = self.native_executables()
+        return inputs
+
+    def native_executables(self) -> dict:
+        """Resolved path and content hash of the executables the helio stage runs, so that outputs of
+        another build (e.g. the HELIO_PATH stand-ins) are never restored for this one."""
+        names = ['heliolinc']
+        if self.sharedConfig.pairing_backend != "kdtree":
+            names.insert(0, 'make_tracklets')
+        return {name: {'path': str(native_executable(name).resolve()), 'sha256': file_hash(native_executable(name))}
+                for name in names}
+
+    @instrumented("generate_guess_grid")
     def generate_guess_grid(self) -> None:
-        create_helio_guess_grid(self.sharedConfig.guess_file)
+        self.run_cached("guess_grid", self.guess_grid_inputs(), [self.sharedConfig.guess_file],
+                        lambda: create_helio_guess_grid(self.sharedConfig.guess_file, **self.sharedConfig.guess_grid_options))
 
-    @timeit
+    @instrumented("generate_dets")
     def generate_dets(self) -> None:
-        objs = create_random_objects(self.sharedConfig.size)
+        if self.resume_stage("generate_dets"):
+            return
+        self.run_cached("dets", self.dets_inputs(),
+                        [self.outputConfig.dets_file, self.outputConfig.object_table_file], self._generate_dets)
+        self.finish_stage("generate_dets")
+
+    def create_dets(self, writer: DetectionWriter = None, start: int = 0, size: int = None) -> pd.DataFrame:
+        """Generates the chunk's random population and its detections with spacerocks.
+        The detections are also streamed to `writer` epoch by epoch.
+
+        `start` and `size` select a sub-batch of the chunk's objects, which is generated
+        like a chunk of `size` objects starting at ObjID startOidIndex + `start`.
+        """
+        # imported here, spacerocks and destnosim are only needed by the workers that generate detections
+        from destnosim import ElementPopulation
+        from ephemeris import Ephemeris
+
+        size = self.size if size is None else size
+        startOidIndex = self.outputConfig.startOidIndex + start
+        seed = None
+        if self.sharedConfig.seed is not None:
+            seed = [self.sharedConfig.seed, startOidIndex]
+        objs = create_random_objects(size, seed=seed)
         pop = ElementPopulation(objs, self.sharedConfig.t)
-        dets = create_observations_spacerocks(
-            pop, self.sharedConfig.mjd_list, startOidIndex=self.outputConfig.startOidIndex)
-        dets.write(self.outputConfig.dets_file, overwrite=True)
+        ephemeris = None
+        if self.sharedConfig.ephemeris_dir is not None:
+            ephemeris = Ephemeris.load(self.sharedConfig.ephemeris_dir)
+        return create_observations_spacerocks(
+            pop, self.sharedConfig.mjd_list, startOidIndex=startOidIndex, output="pandas",
+            ephemeris=ephemeris, writer=writer, truth_dtype=self.truth_dtype(), obscodes=self.sharedConfig.obscodes)
+
+    def _generate_dets(self) -> None:
+        batches = self.dets_batches()
+        if len(batches) > 1:
+            self._generate_dets_batched(batches)
+            return
+        with DetectionWriter(self.outputConfig.dets_file, self.sharedConfig.colformat_file) as writer:
+            dets = self.create_dets(writer)
 
         # create object table
         obj_table = extract_object_truth_values(
-            dets.to_pandas(), self.sharedConfig.mjd_ref, len(self.sharedConfig.mjd_list))
-        obj_table.to_feather(self.outputConfig.object_table_file)
+            dets, self.sharedConfig.mjd_ref, len(self.sharedConfig.mjd_list))
+        annotate(rows_in=self.size, rows_out=len(dets), table_bytes=table_bytes(dets) + table_bytes(obj_table))
+        # uncompressed so that combine_output can memory-map it
+        obj_table.to_feather(self.outputConfig.object_table_file, compression='uncompressed')
 
-    @timeit
+    def _generate_dets_batched(self, batches: list[tuple[int, int]]) -> None:
+        """Generates the detections one sub-batch of objects at a time.
+
+        Each batch is spooled to batches_dir and its truth values are appended to the object
+        table as soon as it is done, so only one batch is in memory. The spools are then
+        interleaved by epoch into dets_file, in the row order of an unbatched run.
+        """
+        import pyarrow as pa
+
+        spool_dir = self.outputConfig.batches_dir
+        spool_dir.mkdir(parents=True, exist_ok=True)
+        spools = []
+        rows = 0
+        peak_bytes = 0
+        try:
+            with pa.OSFile(str(self.outputConfig.object_table_file), 'wb') as sink:
+                obj_writer = None
+                for k, (start, size) in enumerate(batches):
+                    spools.append(spool_dir / f"{k}.arrow")
+                    with DetectionSpool(spools[-1], self.sharedConfig.colformat_file) as spool:
+                        dets = self.create_dets(spool, start, size)
+                    obj_table = pa.Table.from_pandas(extract_object_truth_values(
+                        dets, self.sharedConfig.mjd_ref, len(self.sharedConfig.mjd_list)), preserve_index=False)
+                    rows += len(dets)
+                    peak_bytes = max(peak_bytes, table_bytes(dets) + table_bytes(obj_table))
+                    del dets
+                    # an uncompressed IPC file is a feather file that combine_output can memory-map
+                    if obj_writer is None:
+                        obj_writer = pa.ipc.new_file(sink, obj_table.schema)
+                    obj_writer.write_table(obj_table)
+                obj_writer.close()
+            with DetectionWriter(self.outputConfig.dets_file, self.sharedConfig.colformat_file) as writer:
+                interleave_spools(spools, writer)
+        finally:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+        annotate(rows_in=self.size, rows_out=rows, batches=len(batches), table_bytes=peak_bytes)
+
+    def helio_files(self) -> list[Path]:
+        return [self.outputConfig.out_pairdets_file, self.outputConfig.out_pairs_file,
+                self.outputConfig.out_hl_file, self.outputConfig.out_hlsum_file]
+
+    @instrumented("run_helio")
     def run_helio(self) -> None:
         """Runs make_tracklets and heliolinc using the provided config from the class instance.
         """
-        run_make_tracklets(self.outputConfig.dets_file, self.sharedConfig.earth_file, self.sharedConfig.obs_file,
-                           self.sharedConfig.colformat_file, out_pairdets=self.outputConfig.out_pairdets_file, out_pairs=self.outputConfig.out_pairs_file)
+        if self.resume_stage("run_helio"):
+            return
+        self.run_cached("helio", self.helio_inputs(), self.helio_files(), self._run_helio)
+        self.finish_stage("run_helio")
 
-        run_heliolinc(self.outputConfig.out_pairdets_file, self.outputConfig.out_pairs_file,
-                      self.sharedConfig.mjd_ref, self.sharedConfig.earth_file, self.sharedConfig.guess_file,
-                      out=self.outputConfig.out_hl_file, outsum=self.outputConfig.out_hlsum_file,
-                      stdout_file=self.outputConfig.output_dir / "heliolinc_stdout.txt")
+    @instrumented("run_helio")
+    async def run_helio_async(self, runner: NativeRunner) -> None:
+        """Same as `run_helio`, but the native runs are awaited on `runner` so that
+        the event loop can drive other chunks while the binaries run.
+        """
+        if self.resume_stage("run_helio"):
+            return
+        key = None
+        if self.cache is not None:
+            key = self.cache.key("helio", self.helio_inputs())
+            if self.cache.restore(key, self.helio_files()):
+                print(
+                    f"[Task {self.outputConfig.startOidIndex}] helio: restored from cache {key[:12]}")
+                self.finish_stage("run_helio")
+                return
+        await self.run_native_stages(runner)
+        if key is not None:
+            self.cache.store(key, self.helio_files())
+        self.finish_stage("run_helio")
 
-    @timeit
+    def native_runner(self) -> NativeRunner:
+        """Runner of the native runs of the synchronous `run_helio`."""
+        return NativeRunner(budgets=self.sharedConfig.native_budgets)
+
+    def run_kdtree_pairing(self, out_pairdets: Path, out_pairs: Path) -> None:
+        dets = read_dets(self.outputConfig.dets_file, self.sharedConfig.colformat_file)
+        run_kdtree_pairing(dets, out_pairdets=out_pairdets, out_pairs=out_pairs,
+                           **self.sharedConfig.make_tracklets_options)
+
+    def validate_pairing(self) -> None:
+        """Pairs the detections in process next to the make_tracklets output and writes the diff of both."""
+        self.run_kdtree_pairing(self.outputConfig.kdtree_pairdets_file, self.outputConfig.kdtree_pairs_file)
+        diff_pairs((self.outputConfig.out_pairdets_file, self.outputConfig.out_pairs_file),
+                   (self.outputConfig.kdtree_pairdets_file, self.outputConfig.kdtree_pairs_file),
+                   self.outputConfig.pairing_diff_file)
+
+    async def run_native_stages(self, runner: NativeRunner) -> None:
+        """Pairs the chunk's detections with the configured backend and links them with heliolinc,
+        the native runs awaited on `runner`. Shared by `run_helio` and `run_helio_async`."""
+        backend = self.sharedConfig.pairing_backend
+        if backend == "kdtree":
+            await asyncio.to_thread(self.run_kdtree_pairing, self.outputConfig.out_pairdets_file,
+                                    self.outputConfig.out_pairs_file)
+        elif self.sharedConfig.tile_deg is not None:
+            await run_tiled_make_tracklets(runner, self.outputConfig.dets_file, self.sharedConfig.earth_file,
+                                           self.sharedConfig.obs_file, self.sharedConfig.colformat_file,
+                                           self.sharedConfig.tile_deg, self.outputConfig.tiles_dir,
+                                           out_pairdets=self.outputConfig.out_pairdets_file,
+                                           out_pairs=self.outputConfig.out_pairs_file,
+                                           **self.sharedConfig.make_tracklets_options)
+        else:
+            await runner.make_tracklets(self.outputConfig.dets_file, self.sharedConfig.earth_file, self.sharedConfig.obs_file,
+                                        self.sharedConfig.colformat_file, out_pairdets=self.outputConfig.out_pairdets_file,
+                                        out_pairs=self.outputConfig.out_pairs_file,
+                                        stdout_file=self.outputConfig.output_dir / "make_tracklets_stdout.txt",
+                                        **self.sharedConfig.make_tracklets_options)
+        if backend == "validate":
+            await asyncio.to_thread(self.validate_pairing)
+        if self.sharedConfig.heliolinc_shards is not None:
+            await run_sharded_heliolinc(runner, self.sharedConfig.heliolinc_shards, self.outputConfig.shards_dir,
+                                        self.outputConfig.out_pairdets_file, self.outputConfig.out_pairs_file,
+                                        self.sharedConfig.mjd_ref, self.sharedConfig.earth_file, self.sharedConfig.guess_file,
+                                        out=self.outputConfig.out_hl_file, outsum=self.outputConfig.out_hlsum_file)
+        else:
+            await runner.heliolinc(self.outputConfig.out_pairdets_file, self.outputConfig.out_pairs_file,
+                                   self.sharedConfig.mjd_ref, self.sharedConfig.earth_file, self.sharedConfig.guess_file,
+                                   out=self.outputConfig.out_hl_file, outsum=self.outputConfig.out_hlsum_file,
+                                   stdout_file=self.outputConfig.output_dir / "heliolinc_stdout.txt")
+
+    def _run_helio(self) -> None:
+        with self.native_runner() as runner:
+            asyncio.run(self.run_native_stages(runner))
+
+    def maxvel(self) -> float:
+        """maxvel that make_tracklets runs with."""
+        return self.sharedConfig.make_tracklets_options.get(
+            'maxvel', inspect.signature(run_make_tracklets).parameters['maxvel'].default)
+
+    @instrumented("pair_diagnostics")
+    def diagnose_pairs(self) -> None:
+        """Saves the pair diagnostics of the chunk's make_tracklets output to `pair_stats_file`."""
+        if self.resume_stage("pair_diagnostics"):
+            return
+        stats = write_pair_stats(self.outputConfig.out_pairdets_file, self.outputConfig.out_pairs_file,
+                                 self.maxvel(), self.outputConfig.pair_stats_file)
+        annotate(rows_in=stats['pairs'], rows_out=stats['cross_pairs'])
+        self.finish_stage("pair_diagnostics")
+        print(f"[Task {self.outputConfig.startOidIndex}] {stats['pairs']} pairs, "
+              f"{stats['cross_fraction']:.1%} cross-object, {stats['pairs_per_object_max']} max per object")
+
+    @instrumented("extract_helio_results")
     def extract_helio_results(self) -> None:
-        helio_res_extracted = extract_heliolinc_results(
-            self.outputConfig.out_hl_file, self.outputConfig.out_hlsum_file)
-        helio_res_extracted.to_feather(self.outputConfig.out_hl_extracted_file)
+        if self.resume_stage("extract_helio_results"):
+            return
+        rows, nbytes = write_heliolinc_results(self.outputConfig.out_hl_file, self.outputConfig.out_hlsum_file,
+                                               self.outputConfig.out_hl_extracted_file,
+                                               derived_float32=self.sharedConfig.derived_float32)
+        annotate(rows_out=rows, table_bytes=nbytes)
+        self.update_histogram()
+        self.finish_stage("extract_helio_results")
         print(
             f"[Task {self.outputConfig.startOidIndex}] Extracted helio results saved to {self.outputConfig.out_hl_extracted_file}")
 
+    def update_histogram(self) -> None:
+        """Bins the chunk's objects, linked or not, at the reference epoch into `hist_file`."""
+        hist = LinkedHistogram.from_range(self.sharedConfig.hist_bins, self.sharedConfig.hist_r_range,
+                                          self.sharedConfig.hist_rdot_range)
+        obj_table = self.get_object_table()
+        linked_ids = pd.read_feather(self.outputConfig.out_hl_extracted_file, columns=['ObjID'])['ObjID']
+        linked = np.isin(obj_table['ObjID'].to_numpy(), linked_ids.unique())
+        hist.add(*truth_at(obj_table, self.sharedConfig.mjd_ref), linked)
+        hist.save(self.outputConfig.hist_file)
+
     def run(self) -> None:
 
         # create helio guess grid
@@ -63,8 +378,10 @@ class HelioManager():
 
         # run make_tracklets and heliolinc
         print(
-            f"Running make_tracklets and heliolinc on {self.sharedConfig.size} objects...")
+            f"Running make_tracklets and heliolinc on {self.size} objects...")
         self.run_helio()
+        if self.sharedConfig.pair_diagnostics:
+            self.diagnose_pairs()
 
         # extract heliolinc results
         print("Extracting heliolinc results...")
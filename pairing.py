@@ -0,0 +1,179 @@
+"""In-process tracklet pairing, an alternative to the make_tracklets executable.
+
+Detections are bucketed into images by (MJD, ObsCode), like make_tracklets' images, and
+every image gets a KD-tree over the unit vectors of its (RA, Dec), which avoids any special
+case at RA = 0/360 or at the poles. For every two images 0 < dt <= `maxtime` days apart
+(detections at the same MJD are never paired), the pairs are the detections
+whose chord is within the one of `maxvel` * dt degrees, found by a single tree-against-tree
+query. The results are written as make_tracklets' pairdets/pairs files (pairs only, no
+longer tracklets), so heliolinc reads them unchanged, without a subprocess and without
+a round trip of the detections through a CSV parser.
+
+scipy is only needed by this backend and is imported when it runs.
+
+`diff_pairs` compares both backends. Against the stand-in make_tracklets of benchmarks/ the
+differences are the stand-in's, not this backend's: the stand-in links each object only
+epoch to next epoch and adds STANDIN_CROSS_FRACTION random cross-object pairs that ignore
+maxvel and maxtime (the pairs found only by make_tracklets), and it finds none of the
+cross-object pairs within maxvel (the pairs found only in process). The report splits both
+differences into same-object and cross-object pairs.
+"""
+from pathlib import Path
+import json
+import numpy as np
+import pandas as pd
+import perf
+from pairstats import image_numbers, read_pairdets, read_pairs
+from tiling import PAIRDETS_ORIGINDEX
+from utils import write_csv
+
+# pairdets columns that make_tracklets fills from the trail, magnitude-error and astrometric-error
+# columns of the catalog; colformat.txt maps none of them, so they are the constants written for
+# such a catalog by the stand-in make_tracklets (0 trail, 0.1 mag, 1 arcsec), not computed values.
+# heliolinc does not use them to link.
+PAIRDETS_PLACEHOLDERS = {'trail_len': 0.0, 'trail_PA': 0.0, 'sigmag': 0.1, 'sig_across': 1.0, 'sig_along': 1.0}
+
+
+def unit_vectors(ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    """(n, 3) unit vectors of RA/Dec in degrees."""
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)])
+
+
+def find_pairs(mjd: np.ndarray, ra: np.ndarray, dec: np.ndarray, maxvel: float = 2, maxtime: float = 5,
+               obscode: np.ndarray = None):
+    """
+    Detection index pairs (i1, i2) with 0 < mjd[i2] - mjd[i1] <= `maxtime` and an angular rate
+    of at most `maxvel` deg/day, sorted by i1 then i2.
+
+    Parameters:
+    - mjd, ra, dec (np.ndarray): Epochs and positions in degrees of the detections.
+    - maxvel (float): Maximum angular velocity in deg/day.
+    - maxtime (float): Maximum time between the two detections in days.
+    - obscode (np.ndarray): Observatory of every detection, the images are split by observatory when given.
+    """
+    from scipy.spatial import cKDTree
+
+    image, images = image_numbers(mjd, obscode)
+    members = np.argsort(image, kind='stable')
+    bounds = np.searchsorted(image[members], np.arange(len(images) + 1))
+    xyz = unit_vectors(ra, dec)
+    trees = [cKDTree(xyz[members[lo:hi]]) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+    i1 = []
+    i2 = []
+    for a in range(len(images)):
+        # images are sorted by MJD, the ones of other observatories at the same MJD are skipped
+        first = np.searchsorted(images, images[a], side='right')
+        last = np.searchsorted(images, images[a] + maxtime, side='right')
+        for b in range(first, last):
+            theta = np.radians(min(maxvel * (images[b] - images[a]), 180))
+            cells = trees[a].sparse_distance_matrix(trees[b], 2 * np.sin(theta / 2), output_type='ndarray')
+            i1.append(members[bounds[a] + cells['i']])
+            i2.append(members[bounds[b] + cells['j']])
+    if not i1:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    i1 = np.concatenate(i1)
+    i2 = np.concatenate(i2)
+    order = np.lexsort((i2, i1))
+    return i1[order], i2[order]
+
+
+def write_pairs(out_pairs: Path, i1: np.ndarray, i2: np.ndarray) -> None:
+    """Writes make_tracklets' pair file, one "P i1 i2" line per pair of pairdets rows."""
+    with open(out_pairs, 'w') as f:
+        pd.DataFrame({'kind': 'P', 'i1': i1, 'i2': i2}).to_csv(f, sep=' ', header=False, index=False)
+
+
+def write_pairdets(out_pairdets: Path, dets: pd.DataFrame, used: np.ndarray, images: np.ndarray) -> None:
+    """Writes the pairdets rows of the catalog rows `used`, `images` is the image number of every catalog row."""
+    paired = dets.iloc[used]
+    n = len(paired)
+    write_csv(pd.DataFrame({
+        '#MJD': paired['FieldMJD'].to_numpy(), 'RA': paired['AstRA(deg)'].to_numpy(),
+        'Dec': paired['AstDec(deg)'].to_numpy(), 'mag': paired['Mag'].to_numpy(),
+        **{name: np.full(n, value) for name, value in PAIRDETS_PLACEHOLDERS.items()},
+        'image': images[used], 'idstring': paired['ObjID'].to_numpy(),
+        'band': paired['Band'].astype(str).to_numpy(), 'obscode': paired['ObsCode'].astype(str).to_numpy(),
+        'known_obj': np.zeros(n, dtype=np.int64), 'det_qual': np.zeros(n, dtype=np.int64), 'origindex': used,
+    }), out_pairdets)
+
+
+def run_kdtree_pairing(
+    dets: pd.DataFrame,
+    maxvel: float = 2,
+    maxtime: float = 5,
+    out_pairdets: str = "pairdetfile.csv",
+    out_pairs: str = "outpairfile",
+) -> tuple[int, int]:
+    """
+    Pairs the detection frame `dets` in process and writes the pairdets/pairs files of make_tracklets.
+
+    Parameters:
+    - dets (pd.DataFrame): Detection frame with the colformat columns, e.g. `tiling.read_dets` or the output of
+      `HelioManager.create_dets`; its row positions become the origindex of the pairdets.
+    - The other parameters are the ones of `helio.run_make_tracklets`.
+
+    Returns the number of paired detections and of pairs written.
+    """
+    with perf.measure("kdtree_pairing"):
+        mjd = dets['FieldMJD'].to_numpy()
+        obscode = dets['ObsCode'].to_numpy()
+        i1, i2 = find_pairs(mjd, dets['AstRA(deg)'].to_numpy(), dets['AstDec(deg)'].to_numpy(), maxvel, maxtime,
+                            obscode)
+        used = np.unique(np.concatenate([i1, i2]))
+        write_pairdets(out_pairdets, dets, used, image_numbers(mjd, obscode)[0])
+        # pairdets rows are sorted by catalog index, so a catalog index maps to its row by searchsorted
+        write_pairs(out_pairs, np.searchsorted(used, i1), np.searchsorted(used, i2))
+        perf.annotate(rows_in=len(dets), rows_out=len(used), pairs=len(i1))
+    return len(used), len(i1)
+
+
+def read_pair_keys(pairdets_file: Path, pairs_file: Path) -> tuple[pd.Index, pd.Series]:
+    """Pairs of a pairdets/pairs output as (origindex, origindex) tuples, lower index first,
+    and the idstring of the paired detections by origindex."""
+    pairdets = read_pairdets(pairdets_file, [PAIRDETS_ORIGINDEX, 'idstring'])
+    origindex = pairdets[PAIRDETS_ORIGINDEX].to_numpy()
+    pairs = origindex[read_pairs(pairs_file)]
+    pairs.sort(axis=1)
+    return (pd.MultiIndex.from_arrays([pairs[:, 0], pairs[:, 1]]).unique(),
+            pd.Series(pairdets['idstring'].to_numpy(), index=origindex))
+
+
+def same_object(pairs: pd.Index, idstring: pd.Series) -> int:
+    """Number of `pairs` whose two detections belong to the same object."""
+    if len(pairs) == 0:
+        return 0
+    first = idstring.reindex(pairs.get_level_values(0)).to_numpy()
+    second = idstring.reindex(pairs.get_level_values(1)).to_numpy()
+    return int((first == second).sum())
+
+
+def diff_pairs(native: tuple[Path, Path], inprocess: tuple[Path, Path], report_file: Path = None,
+               examples: int = 20) -> dict:
+    """Compares the pairs of two (pairdets, pairs) outputs by the catalog indices of their detections.
+
+    Returns the pair counts of both, the common ones, the ones found by one side only and up to
+    `examples` pairs of each difference, also saved as JSON to `report_file` if given.
+    """
+    a, ids_a = read_pair_keys(*native)
+    b, ids_b = read_pair_keys(*inprocess)
+    only_native = a.difference(b)
+    only_inprocess = b.difference(a)
+    report = {
+        'native': len(a), 'inprocess': len(b), 'common': len(a.intersection(b)),
+        'only_native': len(only_native), 'only_inprocess': len(only_inprocess),
+        'only_native_same_object': same_object(only_native, ids_a),
+        'only_inprocess_same_object': same_object(only_inprocess, ids_b),
+        'only_native_examples': [list(map(int, p)) for p in only_native[:examples]],
+        'only_inprocess_examples': [list(map(int, p)) for p in only_inprocess[:examples]],
+    }
+    if report_file is not None:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"Pairing diff: {report['common']} common pairs, {report['only_native']} only from make_tracklets "
+          f"({report['only_native_same_object']} of the same object), {report['only_inprocess']} only in process "
+          f"({report['only_inprocess_same_object']} of the same object)")
+    return report
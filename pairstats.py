@@ -0,0 +1,171 @@
+"""Fast readers of the make_tracklets outputs and per-chunk pair diagnostics.
+
+pairdets/pairs files are memory-mapped and parsed by Arrow's CSV reader with fixed
+column types, so the pair indices arrive as int64 arrays without a per-line Python
+step. The diagnostics join both ends of every pair to the ObjID of its detections:
+pairs of the same object are true pairs, the others are cross-object (spurious) pairs
+that only cost heliolinc time. They also give the angular rate of every pair, so the
+pair count at any maxvel below the one make_tracklets ran with is a cumulative count.
+Each chunk saves its diagnostics to pair_stats.json and the run's summary rows are
+collected by `combine_pair_stats`.
+"""
+from pathlib import Path
+import json
+import numpy as np
+import pandas as pd
+
+PAIR_STATS_FILE_NAME = "pair_stats.csv"
+# maxvel values, as fractions of the run's maxvel, at which the pair counts are reported
+MAXVEL_FRACTIONS = np.linspace(0.1, 1, 10)
+TOP_OBJECTS = 20
+
+PAIRDETS_DTYPES = {'#MJD': np.double, 'RA': np.double, 'Dec': np.double, 'image': np.int64,
+                   'idstring': np.int64, 'origindex': np.int64}
+
+
+def read_pairs(pairs_file: Path) -> np.ndarray:
+    """(n, 2) int64 pairdets indices of the "P i1 i2" lines of a pair file.
+
+    make_tracklets also writes "T" lines for tracklets of more than two detections; they are
+    skipped with a warning, so the pairs of a file with tracklets are only a subset of its links.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as csv
+
+    if Path(pairs_file).stat().st_size == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    # tracklet lines with more than two indices do not fit the three columns
+    invalid = []
+
+    def skip(row):
+        invalid.append(row)
+        return 'skip'
+
+    with pa.memory_map(str(pairs_file)) as source:
+        pairs = csv.read_csv(source, read_options=csv.ReadOptions(column_names=['kind', 'i1', 'i2']),
+                             parse_options=csv.ParseOptions(delimiter=' ', invalid_row_handler=skip),
+                             convert_options=csv.ConvertOptions(
+                                 column_types={'kind': pa.string(), 'i1': pa.int64(), 'i2': pa.int64()}))
+    is_pair = pc.equal(pairs['kind'], 'P')
+    skipped = len(invalid) + len(pairs) - (pc.sum(is_pair).as_py() or 0)
+    if skipped:
+        print(f"Warning: skipped {skipped} tracklet lines of {pairs_file}, only its pairs are read")
+        pairs = pairs.filter(is_pair)
+    res = np.empty((len(pairs), 2), dtype=np.int64)
+    res[:, 0] = pairs['i1'].to_numpy()
+    res[:, 1] = pairs['i2'].to_numpy()
+    return res
+
+
+def image_numbers(mjd: np.ndarray, obscode: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+    """Image number of every detection and the MJD of every image.
+
+    Like make_tracklets, an image is the set of detections of one observatory at one MJD;
+    images are numbered by MJD, then ObsCode. Without `obscode` the images are the MJDs.
+    """
+    mjd = np.asarray(mjd)
+    if obscode is None:
+        images, image = np.unique(mjd, return_inverse=True)
+        return image, images
+    site = pd.factorize(np.asarray(obscode).astype(str), sort=True)[0]
+    order = np.lexsort((site, mjd))
+    new = np.r_[True, (np.diff(mjd[order]) != 0) | (np.diff(site[order]) != 0)]
+    image = np.empty(len(mjd), dtype=np.int64)
+    image[order] = np.cumsum(new) - 1
+    return image, mjd[order][new]
+
+
+def read_pairdets(pairdets_file: Path, columns: list[str] = None) -> pd.DataFrame:
+    """`columns` of a pairdets file (all of PAIRDETS_DTYPES by default), parsed with fixed dtypes."""
+    import pyarrow as pa
+    import pyarrow.csv as csv
+
+    columns = list(PAIRDETS_DTYPES) if columns is None else columns
+    with pa.memory_map(str(pairdets_file)) as source:
+        table = csv.read_csv(source, convert_options=csv.ConvertOptions(
+            include_columns=columns,
+            column_types={name: pa.from_numpy_dtype(PAIRDETS_DTYPES[name]) for name in columns}))
+    return table.to_pandas()
+
+
+def pair_rates(pairdets: pd.DataFrame, pairs: np.ndarray) -> np.ndarray:
+    """Angular rate in deg/day of every pair, from the great-circle distance of its detections."""
+    ra = np.radians(pairdets['RA'].to_numpy())
+    dec = np.radians(pairdets['Dec'].to_numpy())
+    mjd = pairdets['#MJD'].to_numpy()
+    a, b = pairs[:, 0], pairs[:, 1]
+    # haversine, accurate at the small separations of pairs
+    h = np.sin((dec[b] - dec[a]) / 2) ** 2 + np.cos(dec[a]) * np.cos(dec[b]) * np.sin((ra[b] - ra[a]) / 2) ** 2
+    sep = np.degrees(2 * np.arcsin(np.sqrt(np.clip(h, 0, 1))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sep / np.abs(mjd[b] - mjd[a])
+
+
+def pair_stats(pairdets: pd.DataFrame, pairs: np.ndarray, maxvel: float) -> dict:
+    """
+    Diagnostics of one pairdets/pairs output.
+
+    Parameters:
+    - pairdets (pd.DataFrame): `read_pairdets` output, idstring holds the ObjID of each detection.
+    - pairs (np.ndarray): `read_pairs` output.
+    - maxvel (float): maxvel that make_tracklets ran with, the largest rate of the growth table.
+
+    Returns a JSON-serializable dict with the pair counts, the pairs per object, the objects with
+    the most cross-object pairs and the pair counts at increasing maxvel.
+    """
+    ids, obj = np.unique(pairdets['idstring'].to_numpy(), return_inverse=True)
+    ends = obj[pairs]
+    true = ends[:, 0] == ends[:, 1]
+    # a true pair counts once for its object, a cross pair once for each of its two objects
+    per_object = np.bincount(ends[:, 0], minlength=len(ids)) + np.bincount(ends[~true, 1], minlength=len(ids))
+    cross = np.bincount(ends[~true].ravel(), minlength=len(ids))
+    top = np.argsort(-cross, kind='stable')[:TOP_OBJECTS]
+    top = top[cross[top] > 0]
+
+    rates = pair_rates(pairdets, pairs)
+    # split by the pair-ordered mask before sorting, the growth table then only needs sorted rates
+    true_rates = np.sort(rates[true])
+    rates = np.sort(rates)
+    growth = []
+    for v in MAXVEL_FRACTIONS * maxvel:
+        n = int(np.searchsorted(rates, v, side='right'))
+        n_true = int(np.searchsorted(true_rates, v, side='right'))
+        growth.append({'maxvel': round(float(v), 6), 'pairs': n, 'true_pairs': n_true, 'cross_pairs': n - n_true})
+
+    n_true = int(true.sum())
+    return {
+        'pairdets': len(pairdets), 'pairs': len(pairs), 'true_pairs': n_true, 'cross_pairs': len(pairs) - n_true,
+        'cross_fraction': (len(pairs) - n_true) / max(len(pairs), 1),
+        'objects': len(ids), 'pairs_per_object_mean': float(per_object.mean()) if len(ids) else 0.0,
+        'pairs_per_object_median': float(np.median(per_object)) if len(ids) else 0.0,
+        'pairs_per_object_p99': float(np.percentile(per_object, 99)) if len(ids) else 0.0,
+        'pairs_per_object_max': int(per_object.max()) if len(ids) else 0,
+        'top_cross_objects': [{'ObjID': int(ids[k]), 'cross_pairs': int(cross[k]), 'pairs': int(per_object[k])}
+                              for k in top],
+        'maxvel_growth': growth,
+    }
+
+
+def write_pair_stats(pairdets_file: Path, pairs_file: Path, maxvel: float, out_file: Path) -> dict:
+    """Saves the `pair_stats` of a pairdets/pairs output to `out_file` as JSON and returns them."""
+    stats = pair_stats(read_pairdets(pairdets_file), read_pairs(pairs_file), maxvel)
+    with open(out_file, 'w') as f:
+        json.dump(stats, f, indent=2)
+    return stats
+
+
+def combine_pair_stats(stats_files: list[Path], output_dir: Path) -> pd.DataFrame:
+    """Collects the scalar diagnostics of the chunks into `output_dir`/pair_stats.csv, one row per chunk."""
+    rows = []
+    for path in stats_files:
+        path = Path(path)
+        if not path.exists():
+            continue
+        with open(path) as f:
+            stats = json.load(f)
+        rows.append({'chunk': path.parent.name,
+                     **{k: v for k, v in stats.items() if k not in ('top_cross_objects', 'maxvel_growth')}})
+    res = pd.DataFrame(rows)
+    res.to_csv(output_dir / PAIR_STATS_FILE_NAME, index=False)
+    return res
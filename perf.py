@@ -0,0 +1,197 @@
+"""Per-stage performance records.
+
+Every measured stage produces one JSON record with its wall time, CPU time, peak RSS, row
+counts and the in-memory size of its tables. Records are appended as JSON lines to the sink
+of the current context (usually `<chunk output_dir>/perf.jsonl`), which keeps lines from
+concurrent workers intact, and `report` aggregates them per stage.
+
+Python stages (`measure`) count the CPU time of this process only. Native runs get their own
+records (`record_child`) from the rusage of exactly their child process, so no child CPU is
+counted twice. The process CPU counter cannot tell apart stages that run at the same time in
+one process (pipelined asyncio chunks), so such records are flagged with `cpu_shared` and their
+cpu_s is an upper bound.
+"""
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+import contextvars
+import inspect
+import json
+import os
+import resource
+import time
+
+PERF_FILE_NAME = "perf.jsonl"
+
+current_chunk = contextvars.ContextVar('current_chunk', default=None)
+current_sink = contextvars.ContextVar('current_sink', default=None)
+current_record = contextvars.ContextVar('current_record', default=None)
+# ids of the records enclosing the current block, and every record being measured in the process
+current_stack = contextvars.ContextVar('current_stack', default=())
+active_records = {}
+
+
+def count_rows(path, header: bool = True) -> int:
+    """Number of data rows of a text file, without parsing it."""
+    n = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 22), b''):
+            n += block.count(b'\n')
+    return max(n - 1, 0) if header else n
+
+
+def table_bytes(table) -> int:
+    """In-memory size of a pandas frame (strings included) or of an Arrow table."""
+    if hasattr(table, 'memory_usage'):
+        return int(table.memory_usage(index=True, deep=True).sum())
+    return int(table.nbytes)
+
+
+def summary(record: dict) -> str:
+    chunk = f"[Task {record['chunk']}] " if record.get('chunk') is not None else ""
+    shared = " (shared)" if record.get('cpu_shared') else ""
+    text = f"{chunk}{record['stage']}: {record['wall_s']:.4f}s wall, {record['cpu_s']:.4f}s cpu{shared}, " \
+        f"{record['max_rss_mb']:.0f} MiB peak"
+    if record.get('rows_in') is not None:
+        text += f", {record['rows_in']} rows in"
+    if record.get('rows_out') is not None:
+        text += f", {record['rows_out']} rows out"
+    if record.get('table_bytes') is not None:
+        text += f", {record['table_bytes'] / 2**20:.1f} MiB tables"
+    if record.get('error'):
+        text += f", failed: {record['error']}"
+    return text
+
+
+def emit(record: dict, sink: Path = None) -> None:
+    """Appends `record` to `sink` (or the context's sink) and prints its summary."""
+    sink = sink or current_sink.get()
+    if sink is not None:
+        line = (json.dumps(record, default=str) + "\n").encode()
+        # a single O_APPEND write keeps lines from concurrent processes whole
+        fd = os.open(sink, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    print(summary(record))
+
+
+def annotate(**fields) -> None:
+    """Adds fields such as rows_in/rows_out/table_bytes to the record of the stage being measured."""
+    record = current_record.get()
+    if record is not None:
+        record.update(fields)
+
+
+@contextmanager
+def measure(stage: str, **fields):
+    """Measures the enclosed block and emits its record when it exits. CPU time and peak RSS are
+    the ones of this process, native children are recorded on their own by `record_child`."""
+    record = {'stage': stage, 'chunk': current_chunk.get(), 'pid': os.getpid(),
+              'start': time.time(), 'rows_in': None, 'rows_out': None, **fields, 'cpu_shared': False}
+    # any record running meanwhile that neither encloses this block nor is enclosed by it shares the CPU counter
+    stack = (*current_stack.get(), id(record))
+    for other in list(active_records.values()):
+        if id(other) not in stack:
+            other['cpu_shared'] = record['cpu_shared'] = True
+    active_records[id(record)] = record
+    token = current_record.set(record)
+    t_stack = current_stack.set(stack)
+    self0 = resource.getrusage(resource.RUSAGE_SELF)
+    wall0 = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        wall = time.perf_counter() - wall0
+        self1 = resource.getrusage(resource.RUSAGE_SELF)
+        current_stack.reset(t_stack)
+        current_record.reset(token)
+        del active_records[id(record)]
+        record.update(
+            wall_s=wall,
+            cpu_s=(self1.ru_utime - self0.ru_utime) + (self1.ru_stime - self0.ru_stime),
+            # ru_maxrss is in KiB on Linux and a high-water mark over the process lifetime
+            max_rss_mb=self1.ru_maxrss / 1024,
+        )
+        emit(record)
+
+
+def record_child(stage: str, wall: float, rusage, **fields) -> dict:
+    """Emits the record of one child process from its own resource usage (os.wait4)."""
+    record = {'stage': stage, 'chunk': current_chunk.get(), 'pid': os.getpid(),
+              'start': time.time() - wall, 'rows_in': None, 'rows_out': None, **fields, 'native': True,
+              'wall_s': wall, 'cpu_s': rusage.ru_utime + rusage.ru_stime, 'cpu_shared': False,
+              'max_rss_mb': rusage.ru_maxrss / 1024}
+    emit(record)
+    return record
+
+
+@contextmanager
+def chunk_context(chunk, output_dir: Path):
+    """Routes the records emitted inside the block to `output_dir`/perf.jsonl, tagged with `chunk`."""
+    t_chunk = current_chunk.set(chunk)
+    t_sink = current_sink.set(Path(output_dir) / PERF_FILE_NAME)
+    try:
+        yield
+    finally:
+        current_sink.reset(t_sink)
+        current_chunk.reset(t_chunk)
+
+
+def instrumented(stage: str):
+    """Decorator for HelioManager stages, measured under the manager's output dir."""
+    def decorator(method):
+        if inspect.iscoroutinefunction(method):
+            @wraps(method)
+            async def async_wrapper(self, *args, **kwargs):
+                with chunk_context(self.outputConfig.output_dir.name, self.outputConfig.output_dir):
+                    with measure(stage):
+                        return await method(self, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with chunk_context(self.outputConfig.output_dir.name, self.outputConfig.output_dir):
+                with measure(stage):
+                    return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def load_records(paths: list[Path]):
+    import pandas as pd
+    records = []
+    for path in paths:
+        if not Path(path).exists():
+            continue
+        with open(path) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame(records)
+
+
+def report(records):
+    """Per-stage aggregate of a frame of records: counts, time totals, peaks, row totals and
+    the largest in-memory table footprint of a run. A stage's CPU time is its own, the native
+    runs it started are the stages named after their executables."""
+    if len(records) == 0:
+        return records
+    if 'cpu_shared' not in records:
+        records = records.assign(cpu_shared=False)
+    agg = records.groupby('stage').agg(
+        runs=('wall_s', 'size'),
+        failed=('error', 'count') if 'error' in records else ('wall_s', lambda s: 0),
+        wall_s=('wall_s', 'sum'),
+        wall_max_s=('wall_s', 'max'),
+        cpu_s=('cpu_s', 'sum'),
+        cpu_shared_runs=('cpu_shared', lambda s: int(s.fillna(False).astype(bool).sum())),
+        peak_rss_mb=('max_rss_mb', 'max'),
+        rows_in=('rows_in', 'sum'),
+        rows_out=('rows_out', 'sum'),
+        table_mb=('table_bytes', lambda b: b.max() / 2**20) if 'table_bytes' in records else ('wall_s', lambda s: 0),
+    )
+    agg['rows_out_per_s'] = agg['rows_out'] / agg['wall_s']
+    return agg.sort_values('wall_s', ascending=False)
@@ -1,9 +1,11 @@
 # from start import *
 from config import *
+from dataset import read_combined
+from linkage import LinkageIndex
+from histogram import LinkedHistogram
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-import astropy.units as u
 from matplotlib.gridspec import GridSpec
 
 
@@ -13,6 +15,12 @@ def separate_linked(linked_id_list, obj_table):
     return linked_obj_list, not_linked_obj_list
 
 
+def separate_linked_index(index: LinkageIndex, obj_table):
+    """Same as `separate_linked` from a LinkageIndex built on `obj_table`, without a scan per query."""
+    linked = index.linked_mask()[:len(obj_table)]
+    return obj_table[linked], obj_table[~linked]
+
+
 def plot_parameter_grid_linked_diff(linked_obj_list, not_linked_obj_list, ax=None, c_linked="blue", c_not_linked="orange"):
     if not ax:
         ax = plt
@@ -61,14 +69,26 @@ def plot_hist2d(linked_obj_list, not_linked_obj_list):
     fig.show()
 
 
+def plot_linked_fraction(hist: LinkedHistogram):
+    """Linked / (linked + not linked) map of a combined histogram, see histogram.py."""
+    fig, ax = plt.subplots(layout="constrained", figsize=(8, 6))
+    extent = [hist.r_edges[0], hist.r_edges[-1], hist.rdot_edges[0], hist.rdot_edges[-1]]
+    img = ax.imshow(hist.fraction().T, origin='lower', extent=extent, aspect='auto', cmap='hot')
+    ax.set_title(f"Linked / (Linked + Not linked), {hist.total.sum()} objects")
+    ax.set_xlabel("r (AU)")
+    ax.set_ylabel("rdot (AU/day)")
+    fig.colorbar(img)
+    fig.show()
+
+
 if __name__ == "__main__":
     output_dir = Path("./temp/f2")
-    helio_extracted = pd.read_feather(output_dir / "extracted_output.feather")
-    obj_table = pd.read_feather(output_dir / "obj_table.feather")
+    helio_extracted = read_combined(output_dir, "extracted_output")
+    obj_table = read_combined(output_dir, "obj_table")
     guess_table = pd.read_csv("./temp/hypo.csv", delimiter=' ')
 
-    linked_id_list = set(helio_extracted['idstring'].unique())
-    l_obj_list, not_l_obj_list = separate_linked(linked_id_list, obj_table)
+    index = LinkageIndex.build(helio_extracted, obj_table, guess_table)
+    l_obj_list, not_l_obj_list = separate_linked_index(index, obj_table)
     # plot_parameter_grid_linked_diff(l_obj_list, not_l_obj_list)
     # plt.scatter(guess_table['#r(AU)'],
     #             guess_table['rdot(AU/day)'], s=2, c="black")
@@ -77,36 +97,17 @@ if __name__ == "__main__":
     print("Linked objects:", len(l_obj_list))
 
     # plot_hist2d(l_obj_list, not_l_obj_list)
+    # or from the combined per-chunk histograms, without the object tables
+    # plot_linked_fraction(LinkedHistogram.load(output_dir / HIST_FILE_NAME))
 
     # plt.show()
 
-    # start = time.time()
-
-    # # build guess-object relationship
-    # obj_to_guesses = {oid: set() for oid in obj_table['ObjID']}
-    # guess_to_objs = {}
-
-    # for i in range(len(guess_table)):
-    #     g = (guess_table['#r(AU)'][i], guess_table['rdot(AU/day)'][i])
-    #     guess_to_objs[g] = set()
-
-    # ho_id_list = helio_extracted['idstring'].values
-    # ho_dist_list = helio_extracted['heliodist'].values
-    # ho_vel_list = (helio_extracted['heliovel'].values * (u.km / u.s).to(u.au / u.day)).round(3)
-    # for i in range(len(helio_extracted)):
-    #     oid = ho_id_list[i]
-    #     g = (ho_dist_list[i], ho_vel_list[i])
-    #     guess_to_objs[g].add(oid)
-    #     obj_to_guesses[oid].add(g)
-
-    # # plot parameter grid with linked and not linked objects by one guess
-    # g1 = list(guess_to_objs.keys())[168]
-    # linked_id_list = guess_to_objs[(g1[0], g1[1])]
-    # plot_parameter_grid_linked_diff(linked_id_list, obj_table)
-
-    # end = time.time()
-    # duration = end - start
-    # print(f"Time to finish plotting: {duration:.2f} seconds")
+    # per-hypothesis completeness and purity
+    # print(index.stats().sort_values('completeness', ascending=False).head(20))
 
+    # plot parameter grid with linked and not linked objects by one guess
+    # g1 = index.hypotheses[168]
+    # linked_id_list = index.objects_linked_by(168)
+    # plot_parameter_grid_linked_diff(*separate_linked(linked_id_list, obj_table))
     # plt.scatter([g1[0]], [g1[1]], s=18, c='black')
     # plt.show()
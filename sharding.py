@@ -0,0 +1,155 @@
+"""Hypothesis-grid sharding for parallel heliolinc runs.
+
+heliolinc's runtime grows linearly with the number of hypotheses in its -heliodist guess
+file. The grid is split into shards that are linked concurrently against the same
+pairdets/pairs files, and the per-shard hl_out/hl_outsum outputs are merged: clusters
+are renumbered in shard order, and a linkage found more than once (the same set of
+pairdets rows, in one shard or in several) is kept only from its best-`metric` cluster.
+The merged output is therefore the same set of linkages for any number of shards.
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import perf
+from helio import NativeRunner, gather_native
+
+HL_OUT_CLUSTER = 'clusternum'
+HL_OUTSUM_CLUSTER = '#clusternum'
+
+
+def split_guess_file(guess_file: Path, n_shards: int, shards_dir: Path) -> list[Path]:
+    """Splits the rows of a guess file into `n_shards` files `shards_dir`/<shard>/hypo.csv.
+
+    Rows are dealt round-robin so that every shard covers the whole range of the grid,
+    which keeps the shards' runtimes close. Lines are copied verbatim under the header.
+    """
+    with open(guess_file) as f:
+        header, *rows = f.readlines()
+    n_shards = max(1, min(n_shards, len(rows)))
+    files = []
+    for k in range(n_shards):
+        shard_dir = Path(shards_dir) / f"{k}"
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        with open(shard_dir / "hypo.csv", 'w') as f:
+            f.write(header)
+            f.writelines(rows[k::n_shards])
+        files.append(shard_dir / "hypo.csv")
+    return files
+
+
+def read_shard_clusters(shard_dir: Path, columns: list[str] = None):
+    """The hl_out and hl_outsum tables of a shard, with hl_out's clusters as positions in hl_outsum.
+
+    Returns (hl_out, hl_outsum, cluster, order): `order` lists the hl_out rows by cluster, which
+    is the order heliolinc writes them in.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as csv
+
+    options = csv.ConvertOptions(column_types={'idstring': pa.string()}, include_columns=columns)
+    hl_out = csv.read_csv(shard_dir / "hl_out.csv", convert_options=options)
+    hl_outsum = csv.read_csv(shard_dir / "hl_outsum.csv")
+    # local cluster numbers are positions in the shard's hl_outsum
+    local = pd.Index(hl_outsum[HL_OUTSUM_CLUSTER].to_numpy())
+    cluster = local.get_indexer(hl_out[HL_OUT_CLUSTER].to_numpy())
+    if (cluster < 0).any():
+        raise KeyError(f"{shard_dir / 'hl_out.csv'} has clusters missing from hl_outsum.csv")
+    order = np.arange(len(cluster)) if (np.diff(cluster) >= 0).all() else np.argsort(cluster, kind='stable')
+    return hl_out, hl_outsum, cluster, order
+
+
+def best_linkages(shard_dirs: list[Path], metric: str = 'metric') -> list[np.ndarray]:
+    """Local numbers of the clusters kept from every shard.
+
+    A linkage is keyed on the sorted pairdets rows (index1) of its cluster; of the clusters with
+    the same key the one with the highest `metric` is kept, ties go to the earlier shard and cluster.
+    """
+    best = {}
+    for k, shard_dir in enumerate(shard_dirs):
+        hl_out, hl_outsum, cluster, _ = read_shard_clusters(shard_dir, [HL_OUT_CLUSTER, 'index1'])
+        rows = np.lexsort((hl_out['index1'].to_numpy(), cluster))
+        index1 = hl_out['index1'].to_numpy()[rows].astype(np.int64)
+        bounds = np.searchsorted(cluster[rows], np.arange(len(hl_outsum) + 1))
+        scores = hl_outsum[metric].to_numpy()
+        for c in range(len(hl_outsum)):
+            key = index1[bounds[c]:bounds[c + 1]].tobytes()
+            if key not in best or scores[c] > best[key][0]:
+                best[key] = (scores[c], k, c)
+    keep = [[] for _ in shard_dirs]
+    for _, k, c in best.values():
+        keep[k].append(c)
+    return [np.sort(np.asarray(c, dtype=np.int64)) for c in keep]
+
+
+def merge_shards(shard_dirs: list[Path], out: Path, outsum: Path) -> tuple[int, int]:
+    """Merges the hl_out.csv/hl_outsum.csv of every shard into `out`/`outsum`.
+
+    One cluster is kept per linkage (see `best_linkages`) and the kept clusters are numbered
+    0..n-1 in shard order. The shards are written one at a time, each shard's hl_out already being
+    in cluster order. Returns the number of clusters found and kept.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as csv
+
+    keep = best_linkages(shard_dirs)
+    options = csv.WriteOptions(include_header=False, quoting_style='none')
+    n_found = 0
+    offset = 0
+    ptnum = 0
+    with pa.output_stream(str(out)) as out_stream, pa.output_stream(str(outsum)) as outsum_stream:
+        for k, shard_dir in enumerate(shard_dirs):
+            hl_out, hl_outsum, cluster, order = read_shard_clusters(shard_dir)
+            if k == 0:
+                out_stream.write((",".join(hl_out.column_names) + "\n").encode())
+                outsum_stream.write((",".join(hl_outsum.column_names) + "\n").encode())
+            new_id = np.full(len(hl_outsum), -1, dtype=np.int64)
+            new_id[keep[k]] = np.arange(len(keep[k])) + offset
+            rows = order[new_id[cluster[order]] >= 0]
+            hl_out = hl_out.take(rows)
+            hl_out = hl_out.set_column(hl_out.column_names.index(HL_OUT_CLUSTER), HL_OUT_CLUSTER,
+                                       pa.array(new_id[cluster[rows]]))
+            hl_out = hl_out.set_column(0, hl_out.column_names[0], pa.array(np.arange(len(rows)) + ptnum))  # #ptnum
+            hl_outsum = hl_outsum.take(keep[k])
+            hl_outsum = hl_outsum.set_column(hl_outsum.column_names.index(HL_OUTSUM_CLUSTER), HL_OUTSUM_CLUSTER,
+                                             pa.array(np.arange(len(keep[k])) + offset))
+            csv.write_csv(hl_out, out_stream, write_options=options)
+            csv.write_csv(hl_outsum, outsum_stream, write_options=options)
+            n_found += len(new_id)
+            offset += len(keep[k])
+            ptnum += len(rows)
+    return n_found, offset
+
+
+async def run_sharded_heliolinc(
+    runner: NativeRunner,
+    n_shards: int,
+    shards_dir: Path,
+    dets: str,
+    pairs: str,
+    mjd: int,
+    obspos: str,
+    heliodist: str,
+    out: str,
+    outsum: str,
+) -> None:
+    """
+    Runs heliolinc once per shard of the guess grid on `runner` and merges the results.
+
+    Parameters:
+    - runner (NativeRunner): bounds the number of simultaneous heliolinc runs.
+    - n_shards (int): Number of shards of the guess grid.
+    - shards_dir (Path): Directory for the per-shard guess files and outputs.
+    - The other parameters are the ones of `helio.run_heliolinc`.
+    """
+    guess_files = split_guess_file(heliodist, n_shards, shards_dir)
+    shard_dirs = [g.parent for g in guess_files]
+    await gather_native(*(
+        runner.heliolinc(dets, pairs, mjd, obspos, guess_file, out=shard_dir / "hl_out.csv",
+                         outsum=shard_dir / "hl_outsum.csv", stdout_file=shard_dir / "heliolinc_stdout.txt")
+        for guess_file, shard_dir in zip(guess_files, shard_dirs)))
+
+    with perf.measure("shard_merge"):
+        n_found, n_kept = merge_shards(shard_dirs, out, outsum)
+        perf.annotate(rows_in=n_found, rows_out=n_kept, shards=len(shard_dirs))
+    print(f"Merged {len(shard_dirs)} heliolinc shards: {n_kept} of {n_found} clusters kept")
+
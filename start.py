@@ -1,8 +1,20 @@
-from utils import create_observations_spacerocks, create_random_objects, create_helio_guess_grid, extract_heliolinc_results, extract_object_truth_values, timeit
+from utils import timeit
 from manager import HelioManager
+from helio import NativeRunner, NativeRunAborted
+from perf import PERF_FILE_NAME, load_records, report
+from dataset import MANIFEST_FILE_NAME, concat_feather, write_manifest
+from histogram import HIST_FILE_NAME, LinkedHistogram
+from pairstats import combine_pair_stats
+from workers import process_pool
 from config import *
-import concurrent.futures
-import pandas as pd
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import traceback
+from concurrent.futures.process import BrokenProcessPool
+import pyarrow.feather as feather
 
 
 print("Library loaded")
@@ -17,6 +29,52 @@ def generate_helio_output_config_list(output_path: Path, chunck_count: int, chun
     ]
 
 
+def plan_chunk_sizes(population: int, workers: int, max_chunk_size: int, min_chunk_size: int = 100) -> list[int]:
+    """Splits `population` objects into chunks of decreasing size (guided self-scheduling).
+
+    Each chunk takes half of the remaining objects divided among the workers, bounded by
+    `min_chunk_size` and `max_chunk_size`. The large chunks start first and the small ones
+    fill the gaps at the end, so that the workers finish at about the same time.
+    """
+    sizes = []
+    remaining = population
+    while remaining > 0:
+        size = min(max_chunk_size, max(min_chunk_size, math.ceil(remaining / (2 * workers))))
+        size = min(size, remaining)
+        sizes.append(size)
+        remaining -= size
+    return sizes
+
+
+def generate_sized_output_config_list(output_path: Path, chunk_sizes: list[int]):
+    """Same as `generate_helio_output_config_list`, with one size per chunk."""
+    start = [0] + list(itertools.accumulate(chunk_sizes))[:-1]
+    return [
+        HelioOutputConfig(
+            output_dir=output_path / f"{i}",
+            startOidIndex=start[i - 1],
+            size=size
+        ) for i, size in enumerate(chunk_sizes, start=1)
+    ]
+
+
+def split_output_config(output_config: HelioOutputConfig, size: int) -> list[HelioOutputConfig]:
+    """The two halves of a chunk of `size` objects, in the sibling dirs <chunk>.1 and <chunk>.2.
+    Like the sub-batches of a chunk, each half draws its objects from the seed of its own first ObjID."""
+    half = size - size // 2
+    return [HelioOutputConfig(output_dir=output_config.output_dir.with_name(f"{output_config.output_dir.name}.{k}"),
+                              startOidIndex=output_config.startOidIndex + start, size=part)
+            for k, (start, part) in enumerate([(0, half), (half, size // 2)], start=1)]
+
+
+def leaf_chunks(output_config: HelioOutputConfig, result: dict) -> list[tuple[HelioOutputConfig, dict]]:
+    """(output config, result entry) of the chunks that a chunk ran as, its halves if it was split."""
+    if not result.get('parts'):
+        return [(output_config, result)]
+    return [leaf for half, part in zip(split_output_config(output_config, result['size']), result['parts'])
+            for leaf in leaf_chunks(half, part)]
+
+
 def chunck_task(shared_config: HelioSharedConfig, output_config: HelioOutputConfig, i: int):
     output_config.create_output_dir()
     print(f"Starting chunck task {i}...")
@@ -28,70 +86,279 @@ def chunck_task(shared_config: HelioSharedConfig, output_config: HelioOutputConf
     m.generate_dets()
     print(f"[Task {i}] Running make_tracklets and helio...")
     m.run_helio()
+    if shared_config.pair_diagnostics:
+        m.diagnose_pairs()
     print(f"[Task {i}] Extracting helio results...")
     m.extract_helio_results()
     print(f"Finished chunck task {i}")
 
 
-def combine_output(sharedConfig: HelioSharedConfig, output_config_list: list[HelioOutputConfig], output_dir: Path):
+def generate_dets_task(shared_config: HelioSharedConfig, output_config: HelioOutputConfig):
+    output_config.create_output_dir()
+    HelioManager(shared_config, output_config).generate_dets()
+
+
+def extract_task(shared_config: HelioSharedConfig, output_config: HelioOutputConfig):
+    m = HelioManager(shared_config, output_config)
+    if shared_config.pair_diagnostics:
+        m.diagnose_pairs()
+    m.extract_helio_results()
+
+
+async def pipelined_chunck_task(executor, runner: NativeRunner, shared_config: HelioSharedConfig, output_config: HelioOutputConfig, i: int):
+    """Runs one chunk with the Python stages in `executor` and the native runs awaited on `runner`."""
+    loop = asyncio.get_running_loop()
+    print(f"[Task {i}] Generating detections...")
+    await loop.run_in_executor(executor, generate_dets_task, shared_config, output_config)
+    print(f"[Task {i}] Running make_tracklets and helio...")
+    await HelioManager(shared_config, output_config).run_helio_async(runner)
+    print(f"[Task {i}] Extracting helio results...")
+    await loop.run_in_executor(executor, extract_task, shared_config, output_config)
+    print(f"Finished chunck task {i}")
+
+
+class WorkerPool:
+    """Process pool for the Python stages that is replaced when one of its workers dies.
+
+    A crashed worker breaks the whole ProcessPoolExecutor, every pending and later submission
+    then fails with BrokenProcessPool. `restart` swaps in a fresh executor, once per broken one.
+    Workers are forked from a preloaded forkserver (see workers.py), so a restart is cheap too.
+    """
+
+    def __init__(self, max_workers: int) -> None:
+        self.max_workers = max_workers
+        self.executor = process_pool(max_workers)
+        self.restarts = 0
+
+    def restart(self, broken) -> None:
+        if broken is not self.executor:
+            return  # another chunk already replaced it
+        print("Worker pool broken, restarting it...")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.executor = process_pool(self.max_workers)
+        self.restarts += 1
+
+    def shutdown(self) -> None:
+        self.executor.shutdown()
+
+
+async def scheduled_chunck_task(pool: WorkerPool, runner: NativeRunner, shared_config: HelioSharedConfig,
+                                output_config: HelioOutputConfig, i, retries: int, splits: int = 2) -> dict:
+    """Runs chunk `i` with up to `retries` retries and returns its result entry.
+
+    A chunk whose native run went over its budget is not retried as is, the same run would
+    only spend the budget again. The make_tracklets/heliolinc costs grow faster than the number
+    of objects, so it is split in two halves that are run as chunks of their own, up to `splits`
+    times in a row. The entry of a split chunk lists the entries of its halves under 'parts'
+    (see `leaf_chunks`) and only succeeds if both of them do.
+    """
+    size = output_config.size or shared_config.size
+    result = {'chunk': output_config.output_dir.name, 'size': size,
+              'startOidIndex': output_config.startOidIndex, 'status': 'failed', 'attempts': 0, 'error': None}
+    for attempt in range(1, retries + 2):
+        result['attempts'] = attempt
+        executor = pool.executor
+        try:
+            await pipelined_chunck_task(executor, runner, shared_config, output_config, i)
+        except Exception as e:
+            result['error'] = repr(e)
+            print(f"[Task {i}] Attempt {attempt} failed: {e!r}")
+            if isinstance(e, NativeRunAborted):
+                if e.kind != 'cancelled' and splits > 0 and size > 1:
+                    print(f"[Task {i}] Splitting the chunk of {size} objects in two")
+                    result['parts'] = await asyncio.gather(*(
+                        scheduled_chunck_task(pool, runner, shared_config, half, f"{i}.{k}", retries, splits - 1)
+                        for k, half in enumerate(split_output_config(output_config, size), start=1)))
+                    if all(part['status'] == 'succeeded' for part in result['parts']):
+                        result['status'] = 'succeeded'
+                break
+            if isinstance(e, BrokenProcessPool):
+                pool.restart(executor)
+            else:
+                traceback.print_exc()
+            continue
+        result['status'] = 'succeeded'
+        result['error'] = None
+        break
+    return result
+
+
+async def run_pipelined(shared_config: HelioSharedConfig, output_config_list: list[HelioOutputConfig], max_workers: int = 8,
+                        runner: NativeRunner = None, retries: int = 2, splits: int = 2) -> list[dict]:
+    """Runs all chunks so that detection generation of later chunks overlaps with the
+    make_tracklets/heliolinc runs of earlier ones.
+
+    `max_workers` bounds the Python-side processes, `runner` bounds the native runs per binary.
+    Chunks are submitted in order, so the large chunks of `plan_chunk_sizes` start first.
+    A failed chunk is retried up to `retries` times, a crashed worker process is replaced and
+    a chunk over its native budget is split up to `splits` times (see `scheduled_chunck_task`).
+    Returns one result entry per chunk with its status, number of attempts and last error.
+    """
+    own_runner = runner is None
+    runner = runner or NativeRunner()
+    pool = WorkerPool(max_workers)
+    try:
+        return await asyncio.gather(*(
+            scheduled_chunck_task(pool, runner, shared_config, output_config, i, retries, splits)
+            for i, output_config in enumerate(output_config_list, start=1)))
+    finally:
+        pool.shutdown()
+        if own_runner:
+            runner.close()
+
+
+def write_chunk_report(results: list[dict], output_dir: Path) -> None:
+    """Prints which chunks succeeded and saves the entries to `output_dir`/chunk_report.json."""
+    def show(res, indent=""):
+        text = f"{indent}Chunck {res['chunk']} ({res['size']} objects): {res['status']} after {res['attempts']} attempt(s)"
+        if res.get('parts'):
+            text += f", split in two after: {res['error']}"
+        elif res['error']:
+            text += f", last error: {res['error']}"
+        print(text)
+        for part in res.get('parts') or []:
+            show(part, indent + "  ")
+
+    for res in results:
+        show(res)
+    succeeded = sum(res['status'] == 'succeeded' for res in results)
+    print(f"{succeeded}/{len(results)} chuncks succeeded")
+    with open(output_dir / "chunk_report.json", "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def write_perf_report(output_config_list: list[HelioOutputConfig], output_dir: Path):
+    """Aggregates the perf records of all chunks into `output_dir`/perf_report.csv."""
+    records = load_records([con.output_dir / PERF_FILE_NAME for con in output_config_list])
+    if len(records) == 0:
+        print("No perf records found")
+        return
+    records.to_csv(output_dir / "perf_records.csv", index=False)
+    res = report(records)
+    res.to_csv(output_dir / "perf_report.csv")
+    print(res.to_string())
+
+
+def combine_output(sharedConfig: HelioSharedConfig, output_config_list: list[HelioOutputConfig], output_dir: Path, partitioned: bool = False):
     """Combine the object table and extracted output table from different chuncks into a single object table and extracted output.
+
+    The chunk files are memory-mapped and concatenated in a single pass. With `partitioned`,
+    no combined copy is written; output_dir/manifest.json lists the chunk files instead
+    so that they can be queried lazily as one dataset (see dataset.py).
     """
-    manager = HelioManager(sharedConfig, output_config_list[0])
-    obj_table = manager.get_object_table()
-    extracted_output = manager.get_extracted_output()
-    for con in output_config_list[1:]:
-        manager = HelioManager(sharedConfig, con)
-        obj_table = pd.concat([obj_table, manager.get_object_table()])
-        extracted_output = pd.concat(
-            [extracted_output, manager.get_extracted_output()])
-    obj_table.reset_index(inplace=True)
-    obj_table.to_feather(output_dir / "obj_table.feather")
+    obj_parts = [(con.output_dir.name, con.object_table_file) for con in output_config_list]
+    extracted_parts = [(con.output_dir.name, con.out_hl_extracted_file) for con in output_config_list]
+    if partitioned:
+        manifest = write_manifest(output_dir, {'obj_table': obj_parts, 'extracted_output': extracted_parts})
+        print(f"Partitioned dataset manifest saved to {manifest}")
+        return
+
+    # a manifest left by an earlier partitioned run would shadow the combined files
+    (output_dir / MANIFEST_FILE_NAME).unlink(missing_ok=True)
+    feather.write_feather(concat_feather([p for _, p in obj_parts]),
+                          str(output_dir / "obj_table.feather"), compression='uncompressed')
     print("Combined object table saved to obj_table.feather")
-    extracted_output.reset_index(inplace=True)
-    extracted_output.to_feather(output_dir / "extracted_output.feather")
+    feather.write_feather(concat_feather([p for _, p in extracted_parts]),
+                          str(output_dir / "extracted_output.feather"), compression='uncompressed')
     print("Combined extracted output saved to extracted_output.feather")
 
 
+def combine_histograms(output_config_list: list[HelioOutputConfig], output_dir: Path):
+    """Sums the (r, rdot) histograms of the chunks into `output_dir`/hist.npz for plot.py."""
+    hist = LinkedHistogram.combine([con.hist_file for con in output_config_list])
+    hist.save(output_dir / HIST_FILE_NAME)
+    print(f"Combined histogram saved to {HIST_FILE_NAME} ({hist.outside} objects outside the bins)")
+
+
 @timeit
-def main():
-    chunck_count = 12
-    chunk_size = 800
+def main(resume: bool = False, queue_dir: Path = None, local_workers: int = 0):
+    """Runs all chunks; with `resume`, the stages that finished in an earlier run of the
+    same output dir are skipped (see checkpoint.py). With `queue_dir`, the chunks are run by
+    workers on any node that pull them from that queue (see workqueue.py), `local_workers`
+    of them on this machine."""
+    population = 9600
+    max_workers = 8
+    max_chunk_size = 800
     output_dir = Path("./temp/f2")
     t = 25
     mjd_list = [t + 60676 for t in [0.5, 0.6, 7.5, 7.6, 13.5, 13.6]]
     sharedConfig = HelioSharedConfig(
-        size=chunk_size,
+        size=max_chunk_size,
         t=t,
         mjd_list=mjd_list,
         guess_file=Path("./temp/hypo.csv"),
         earth_file=HELIO_PATH / "tests/Earth1day2020s_02a.txt",
         obs_file=HELIO_PATH / "tests/ObsCodes.txt",
-        colformat_file=Path("./colformat.txt")
+        colformat_file=Path("./colformat.txt"),
+        seed=0,
+        cache_dir=Path("./temp/cache"),
+        resume=resume
     )
 
     print("Generating output config list...")
-    outputConfigList = generate_helio_output_config_list(
-        output_dir, chunck_count, chunk_size)
+    chunk_sizes = plan_chunk_sizes(population, max_workers, max_chunk_size, min_chunk_size=200)
+    outputConfigList = generate_sized_output_config_list(output_dir, chunk_sizes)
+    print(f"{len(chunk_sizes)} chuncks of sizes {chunk_sizes}")
+
+    if not resume:
+        for con in outputConfigList:
+            (con.output_dir / PERF_FILE_NAME).unlink(missing_ok=True)
+
+    print("Computing observer and perturber ephemeris...")
+    from ephemeris import Ephemeris
+    Ephemeris.compute(mjd_list, obscodes=sharedConfig.obscodes).save(output_dir / "ephemeris")
+    sharedConfig.ephemeris_dir = output_dir / "ephemeris"
 
     print("Generating helio guess grid...")
-    create_helio_guess_grid(sharedConfig.guess_file)
+    HelioManager(sharedConfig, outputConfigList[0]).generate_guess_grid()
+
+    # running with parallel, native runs of one chunk overlap with generation of the next
+    if queue_dir is not None:
+        # running distributed, workers on every node pull chunks from a shared queue
+        from workqueue import run_distributed
+        results = run_distributed(sharedConfig, outputConfigList, queue_dir, local_workers=local_workers)
+    else:
+        with NativeRunner(limits={'make_tracklets': 8, 'heliolinc': 8}, budgets=sharedConfig.native_budgets) as runner:
+            results = asyncio.run(run_pipelined(
+                sharedConfig, outputConfigList, max_workers=max_workers, runner=runner))
 
-    # running with parallel
-    with concurrent.futures.ProcessPoolExecutor(max_workers=8) as executor:
-        executor.map(chunck_task, [sharedConfig] * chunck_count, 
-                     outputConfigList, range(1, chunck_count + 1))
+    # running with parallel, one process per chunk
+    # with concurrent.futures.ProcessPoolExecutor(max_workers=8) as executor:
+    #     executor.map(chunck_task, [sharedConfig] * chunck_count,
+    #                  outputConfigList, range(1, chunck_count + 1))
 
     # running in series
     # for i, outputConfig in enumerate(outputConfigList):
     #     chunck_task(sharedConfig, outputConfig, i + 1)
 
     print("Finish chunck tasks")
+    write_chunk_report(results, output_dir)
+    # the halves of the chunks that were split (see scheduled_chunck_task) hold their outputs
+    chunks = [leaf for con, res in zip(outputConfigList, results) for leaf in leaf_chunks(con, res)]
+    succeeded = [con for con, res in chunks if res['status'] == 'succeeded']
+
+    if succeeded:
+        print("Combining output...")
+        combine_output(sharedConfig, succeeded, output_dir)
+        combine_histograms(succeeded, output_dir)
+        if sharedConfig.pair_diagnostics:
+            combine_pair_stats([con.pair_stats_file for con in succeeded], output_dir)
+    else:
+        print("No chunks succeeded, nothing to combine")
 
-    print("Combining output...")
-    combine_output(sharedConfig, outputConfigList, output_dir)
+    print("Performance report:")
+    write_perf_report(outputConfigList + [con for con, _ in chunks if con not in outputConfigList], output_dir)
 
     print("Fnished all tasks")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the chunk stages that finished in an earlier run")
+    parser.add_argument("--queue", type=Path, default=None,
+                        help="publish the chunks to this queue dir on a shared filesystem, see workqueue.py")
+    parser.add_argument("--local-workers", type=int, default=0,
+                        help="with --queue, queue workers started on this machine")
+    args = parser.parse_args()
+    main(resume=args.resume, queue_dir=args.queue, local_workers=args.local_workers)
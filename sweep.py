@@ -0,0 +1,220 @@
+"""Parameter sweeps over make_tracklets and heliolinc settings that reuse upstream artifacts.
+
+A sweep is a small dependency graph: the chunk's detections are generated once, through
+the chunk's stages.json and the artifact cache like any chunk (see checkpoint.py and
+cache.py), so a rerun neither integrates the population again nor changes the inputs of
+the downstream nodes. Each guess grid is written once per create_helio_guess_grid
+setting, each pair set is built once per make_tracklets setting, and every (pair set, guess grid) combination fans out
+into its own heliolinc run. Nodes are asyncio tasks memoized by their parameters, so a
+node starts as soon as its inputs exist and the native runs are bounded by the
+NativeRunner. Every node directory keeps a stages.json (see checkpoint.py), so a rerun
+of the sweep skips the nodes whose outputs are still valid.
+
+    python sweep.py --config sweep.json
+    python sweep.py --output-dir temp/sweep --maxvel 1 2 --maxtime 1.5 5
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import pandas as pd
+import perf
+from checkpoint import StageManifest
+from config import HELIO_PATH, HelioSharedConfig, HelioOutputConfig, SweepConfig
+from helio import NativeRunner
+from linkage import LinkageIndex
+from manager import HelioManager
+from utils import create_helio_guess_grid, write_heliolinc_results
+
+SWEEP_RESULTS_FILE_NAME = "sweep_results.csv"
+
+
+def expand_grid(grid: dict[str, list]) -> list[dict]:
+    """Every combination of the values of `grid`, a single empty combination for an empty grid."""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[n] for n in names))]
+
+
+def variant_name(options: dict) -> str:
+    """Short stable directory name of a parameter combination."""
+    return hashlib.sha256(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+class Sweep:
+    """Runs every combination of `sweep` for the chunk `output_config` of `shared_config`.
+
+    The options of each combination are applied on top of the shared config's
+    make_tracklets_options and guess_grid_options.
+    """
+
+    def __init__(self, shared_config: HelioSharedConfig, output_config: HelioOutputConfig, sweep_config: SweepConfig,
+                 runner: NativeRunner = None, executor=None) -> None:
+        self.shared_config = shared_config
+        self.output_config = output_config
+        self.sweep_config = sweep_config
+        self.runner = runner or NativeRunner(budgets=shared_config.native_budgets)
+        self.executor = executor
+        self.tasks = {}
+        if shared_config.seed is None:
+            print("Warning: the sweep's detections are unseeded, they cannot be restored from the cache and a rerun "
+                  "that has to regenerate them invalidates every pair set and linkage of the sweep")
+
+    def node(self, key: tuple, make):
+        """The task of node `key`, created by `make()` the first time it is requested."""
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.ensure_future(make())
+        return self.tasks[key]
+
+    async def in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def node_dir(self, kind: str, options: dict) -> Path:
+        path = Path(self.sweep_config.output_dir) / kind / variant_name(options)
+        path.mkdir(parents=True, exist_ok=True)
+        with open(path / "params.json", 'w') as f:
+            json.dump(options, f, indent=2, default=str)
+        return path
+
+    async def dets(self) -> None:
+        self.output_config.create_output_dir()
+        await self.in_executor(generate_dets, self.shared_config, self.output_config)
+
+    async def guess(self, options: dict) -> Path:
+        options = {**self.shared_config.guess_grid_options, **options}
+        path = self.node_dir("guess", options)
+        guess_file = path / "hypo.csv"
+        stages = StageManifest(path)
+        if not stages.is_complete("guess_grid", [], [guess_file], options):
+            await self.in_executor(create_helio_guess_grid_kwargs, guess_file, options)
+            stages.record("guess_grid", [], [guess_file], options)
+        return guess_file
+
+    async def pairs(self, options: dict) -> tuple[Path, Path]:
+        await self.node(("dets",), self.dets)
+        options = {**self.shared_config.make_tracklets_options, **options}
+        path = self.node_dir("pairs", options)
+        out = (path / "pairdets.csv", path / "pairs.csv")
+        inputs = [self.output_config.dets_file]
+        stages = StageManifest(path)
+        if not stages.is_complete("make_tracklets", inputs, list(out), options):
+            with perf.chunk_context(f"pairs/{path.name}", path):
+                await self.runner.make_tracklets(
+                    self.output_config.dets_file, self.shared_config.earth_file, self.shared_config.obs_file,
+                    self.shared_config.colformat_file, out_pairdets=out[0], out_pairs=out[1],
+                    stdout_file=path / "make_tracklets_stdout.txt", **options)
+            stages.record("make_tracklets", inputs, list(out), options)
+        return out
+
+    async def link(self, mt_options: dict, guess_options: dict) -> dict:
+        pairdets, pairs = await self.node(("pairs", variant_name(mt_options)), lambda: self.pairs(mt_options))
+        guess_file = await self.node(("guess", variant_name(guess_options)), lambda: self.guess(guess_options))
+        options = {'make_tracklets': mt_options, 'guess_grid': guess_options}
+        path = self.node_dir("link", options)
+        out = [path / "hl_out.csv", path / "hl_outsum.csv", path / "hl_extracted.feather"]
+        inputs = [pairdets, pairs, guess_file]
+        stages = StageManifest(path)
+        if not stages.is_complete("heliolinc", inputs, out, options):
+            with perf.chunk_context(f"link/{path.name}", path):
+                await self.runner.heliolinc(pairdets, pairs, self.shared_config.mjd_ref, self.shared_config.earth_file,
+                                            guess_file, out=out[0], outsum=out[1],
+                                            stdout_file=path / "heliolinc_stdout.txt")
+                await self.in_executor(write_heliolinc_results, out[0], out[1], out[2])
+            stages.record("heliolinc", inputs, out, options)
+        return await self.in_executor(recovery, self.output_config, guess_file, pairs, out[2], path,
+                                      mt_options, guess_options)
+
+    async def run(self) -> pd.DataFrame:
+        rows = await asyncio.gather(*(
+            self.link(mt_options, guess_options)
+            for mt_options in expand_grid(self.sweep_config.make_tracklets_grid)
+            for guess_options in expand_grid(self.sweep_config.guess_grid_grid)))
+        return pd.DataFrame(rows)
+
+
+def generate_dets(shared_config: HelioSharedConfig, output_config: HelioOutputConfig) -> None:
+    """The chunk's generate_dets stage, skipped while its stages.json record is valid, like the other sweep nodes."""
+    HelioManager(shared_config.model_copy(update={'resume': True}), output_config).generate_dets()
+
+
+def create_helio_guess_grid_kwargs(guess_file: Path, options: dict) -> None:
+    # configs read from JSON hold lists for the tuple options (e.g. ns)
+    create_helio_guess_grid(guess_file, **{k: tuple(v) if isinstance(v, list) else v for k, v in options.items()})
+
+
+def recovery(output_config: HelioOutputConfig, guess_file: Path, pairs_file: Path, extracted_file: Path, path: Path,
+             mt_options: dict, guess_options: dict) -> dict:
+    """Writes the per-hypothesis recovery table of one combination to `path`/recovery.csv
+    and returns its summary row."""
+    obj_table = pd.read_feather(output_config.object_table_file)
+    extracted = pd.read_feather(extracted_file)
+    guess_table = pd.read_csv(guess_file, delimiter=' ')
+    index = LinkageIndex.build(extracted, obj_table, guess_table)
+    index.stats().to_csv(path / "recovery.csv", index=False)
+    linked = int(index.linked_mask()[:len(obj_table)].sum())
+    return {**{f"make_tracklets.{k}": v for k, v in mt_options.items()},
+            **{f"guess_grid.{k}": v for k, v in guess_options.items()},
+            'hypotheses': len(guess_table), 'pairs': perf.count_rows(pairs_file, header=False),
+            'clusters': len(extracted), 'objects': len(obj_table), 'linked': linked,
+            'recovery': linked / max(len(obj_table), 1), 'dir': str(path)}
+
+
+def run_sweep(shared_config: HelioSharedConfig, output_config: HelioOutputConfig, sweep_config: SweepConfig,
+              runner: NativeRunner = None, executor=None) -> pd.DataFrame:
+    """Runs the sweep and saves one summary row per combination to `output_dir`/sweep_results.csv."""
+    sweep = Sweep(shared_config, output_config, sweep_config, runner, executor)
+    try:
+        results = asyncio.run(sweep.run())
+    finally:
+        if runner is None:
+            sweep.runner.close()
+    results.to_csv(Path(sweep_config.output_dir) / SWEEP_RESULTS_FILE_NAME, index=False)
+    print(results.to_string())
+    return results
+
+
+def main(sweep_config: SweepConfig, size: int = 800, seed: int = 0):
+    """Sweeps `sweep_config` over one chunk of `size` objects, with the cadence and files of start.main."""
+    t = 25
+    output_dir = Path(sweep_config.output_dir)
+    shared_config = HelioSharedConfig(
+        size=size,
+        t=t,
+        mjd_list=[t + 60676 for t in [0.5, 0.6, 7.5, 7.6, 13.5, 13.6]],
+        guess_file=output_dir / "hypo.csv",
+        earth_file=HELIO_PATH / "tests/Earth1day2020s_02a.txt",
+        obs_file=HELIO_PATH / "tests/ObsCodes.txt",
+        colformat_file=Path("./colformat.txt"),
+        seed=seed,
+        cache_dir=Path("./temp/cache"),
+    )
+    output_config = HelioOutputConfig(output_dir=output_dir / "dets", startOidIndex=0)
+    return run_sweep(shared_config, output_config, sweep_config)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", type=Path, default=None,
+                        help="JSON of a SweepConfig (output_dir, make_tracklets_grid, guess_grid_grid)")
+    parser.add_argument("--output-dir", type=Path, default=None, help="output dir, overrides the config's")
+    parser.add_argument("--maxvel", type=float, nargs="+", default=None, help="make_tracklets maxvel values in deg/day")
+    parser.add_argument("--maxtime", type=float, nargs="+", default=None, help="make_tracklets maxtime values in days")
+    parser.add_argument("--size", type=int, default=800, help="objects of the swept chunk")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = {}
+    if args.config is not None:
+        with open(args.config) as f:
+            config = json.load(f)
+    if args.output_dir is not None:
+        config['output_dir'] = args.output_dir
+    grid = dict(config.get('make_tracklets_grid', {}))
+    for name in ['maxvel', 'maxtime']:
+        if getattr(args, name) is not None:
+            grid[name] = getattr(args, name)
+    config['make_tracklets_grid'] = grid
+    if 'output_dir' not in config:
+        parser.error("an output dir is needed, from --config or --output-dir")
+    main(SweepConfig(**config), size=args.size, seed=args.seed)
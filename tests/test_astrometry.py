@@ -0,0 +1,48 @@
+import numpy as np
+
+from astrometry import ecliptic_to_equatorial, observe, observe_buffers, observe_reference
+
+EPSILON = 0.4090926
+
+
+def sky_diff_mas(ra, dec, ra_ref, dec_ref):
+    dra = np.abs((ra - ra_ref + 180) % 360 - 180) * np.cos(np.radians(dec_ref))
+    return max(dra.max(), np.abs(dec - dec_ref).max()) * 3.6e6
+
+
+def random_states(seed=0, n_epochs=5, n_objects=2000):
+    rng = np.random.default_rng(seed)
+    r = rng.uniform(1.5, 60, (n_epochs, n_objects))
+    direction = rng.normal(size=(3, n_epochs, n_objects))
+    position = direction / np.linalg.norm(direction, axis=0) * r
+    velocity = rng.normal(scale=0.01, size=(3, n_epochs, n_objects))
+    observer = rng.normal(scale=0.6, size=(2, n_epochs, 3))
+    return (*position, *velocity), observer
+
+
+def test_kernel_matches_former_spacerocks_path():
+    state, observer = random_states()
+    ra, dec = observe(*state, observer, ecliptic_to_equatorial(EPSILON))
+    ra_ref, dec_ref = observe_reference(*state, observer, EPSILON)
+    # within the 1e-6 day light-time tolerance of the former path
+    assert sky_diff_mas(ra, dec, ra_ref, dec_ref) < 10
+
+
+def test_comparison_detects_a_missing_light_time_correction():
+    state, observer = random_states()
+    ra, dec = observe(*state, observer, ecliptic_to_equatorial(EPSILON), ltt_iterations=0)
+    ra_ref, dec_ref = observe_reference(*state, observer, EPSILON)
+    assert sky_diff_mas(ra, dec, ra_ref, dec_ref) > 1000
+
+
+def test_blocks_with_reused_buffers_match_the_whole_cadence():
+    state, observer = random_states(n_epochs=7, n_objects=300)
+    state = np.stack(state)
+    rotation = ecliptic_to_equatorial(EPSILON)
+    ra, dec = observe(*state, observer, rotation)
+    buffers = observe_buffers(2, 3, 300)
+    for first in range(0, 7, 3):
+        block = slice(first, first + 3)
+        ra_block, dec_block = observe(*state[:, block], observer[:, block], rotation, buffers=buffers)
+        np.testing.assert_array_equal(ra_block, ra[:, block])
+        np.testing.assert_array_equal(dec_block, dec[:, block])
@@ -0,0 +1,63 @@
+import cache
+import manager
+from cache import ArtifactCache, file_hash
+from config import HelioOutputConfig, HelioSharedConfig
+
+
+def make_manager(tmp_path, **shared) -> manager.HelioManager:
+    """A chunk manager whose input files and executables are small files of `tmp_path`."""
+    for name in ("guess.csv", "earth.txt", "obs.txt", "colformat.txt", "out/dets.csv", "bin/make_tracklets",
+                 "bin/heliolinc"):
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text(name)
+    shared = HelioSharedConfig(size=1, t=0, mjd_list=[0.0], guess_file=tmp_path / "guess.csv",
+                               earth_file=tmp_path / "earth.txt", obs_file=tmp_path / "obs.txt",
+                               colformat_file=tmp_path / "colformat.txt", **shared)
+    return manager.HelioManager(shared, HelioOutputConfig(startOidIndex=0, output_dir=tmp_path / "out"))
+
+
+def test_store_then_restore(tmp_path):
+    store = ArtifactCache(tmp_path / "cache")
+    out = tmp_path / "out.csv"
+    out.write_text("a,b\n1,2\n")
+    key = ArtifactCache.key("stage", {'x': 1})
+    assert not store.restore(key, [out])
+    store.store(key, [out])
+    out.unlink()
+    assert store.restore(key, [out])
+    assert out.read_text() == "a,b\n1,2\n"
+
+
+def test_second_run_is_a_cache_hit(tmp_path):
+    hm = make_manager(tmp_path, cache_dir=tmp_path / "cache")
+    out = tmp_path / "out.csv"
+    runs = []
+
+    def produce():
+        runs.append(1)
+        out.write_text("done\n")
+
+    assert not hm.run_cached("stage", {'input': tmp_path / "guess.csv"}, [out], produce)
+    out.unlink()
+    assert hm.run_cached("stage", {'input': tmp_path / "guess.csv"}, [out], produce)
+    assert len(runs) == 1
+    assert out.read_text() == "done\n"
+
+
+def test_file_hash_follows_rewrites(tmp_path):
+    f = tmp_path / "f"
+    f.write_text("one")
+    first = file_hash(f)
+    assert file_hash(f) == first
+    f.write_text("three")
+    assert file_hash(f) != first
+    assert cache._content_hash.cache_info().currsize <= cache._content_hash.cache_info().maxsize
+
+
+def test_helio_key_changes_with_an_executable(tmp_path, monkeypatch):
+    monkeypatch.setattr(manager, 'native_executable', lambda name: tmp_path / "bin" / name)
+    hm = make_manager(tmp_path)
+    before = ArtifactCache.key("helio", hm.helio_inputs())
+    assert ArtifactCache.key("helio", hm.helio_inputs()) == before
+    (tmp_path / "bin" / "heliolinc").write_text("another build")
+    assert ArtifactCache.key("helio", hm.helio_inputs()) != before
@@ -0,0 +1,59 @@
+import manager
+from config import HelioOutputConfig, HelioSharedConfig
+
+
+def make_manager(tmp_path, monkeypatch, runs: list[str]) -> manager.HelioManager:
+    """A resumable chunk whose stages write small placeholder outputs and log their runs to `runs`."""
+    def write(stage, *files):
+        runs.append(stage)
+        for f in files:
+            f.write_text(f"{stage} {len(runs)}\n")
+
+    for name in ("guess.csv", "earth.txt", "obs.txt", "colformat.txt", "make_tracklets", "heliolinc"):
+        (tmp_path / name).write_text(name)
+    monkeypatch.setattr(manager, 'native_executable', lambda name: tmp_path / name)
+    shared = HelioSharedConfig(size=1, t=0, mjd_list=[0.0], guess_file=tmp_path / "guess.csv",
+                               earth_file=tmp_path / "earth.txt", obs_file=tmp_path / "obs.txt",
+                               colformat_file=tmp_path / "colformat.txt", resume=True)
+    output = HelioOutputConfig(startOidIndex=0, output_dir=tmp_path / "out")
+    output.create_output_dir()
+    hm = manager.HelioManager(shared, output)
+    # the guess grid is shared by the chunks and not a chunk stage
+    hm.generate_guess_grid = lambda: None
+    hm._generate_dets = lambda: write("generate_dets", output.dets_file, output.object_table_file)
+    hm._run_helio = lambda: write("run_helio", *hm.helio_files())
+
+    def pair_stats(pairdets, pairs, maxvel, out):
+        write("pair_diagnostics", out)
+        return {'pairs': 0, 'cross_pairs': 0, 'cross_fraction': 0.0, 'pairs_per_object_max': 0}
+    monkeypatch.setattr(manager, 'write_pair_stats', pair_stats)
+
+    def extract(hl, hlsum, out, derived_float32):
+        write("extract_helio_results", out)
+        return 0, 0
+    monkeypatch.setattr(manager, 'write_heliolinc_results', extract)
+    hm.update_histogram = lambda: output.hist_file.write_text("hist\n")
+    return hm
+
+
+def test_a_finished_chunk_is_skipped_on_resume(tmp_path, monkeypatch):
+    runs = []
+    hm = make_manager(tmp_path, monkeypatch, runs)
+    hm.run()
+    assert runs == ["generate_dets", "run_helio", "pair_diagnostics", "extract_helio_results"]
+
+    runs.clear()
+    hm.run()
+    assert runs == []
+
+
+def test_only_the_stage_with_a_deleted_output_runs_again(tmp_path, monkeypatch):
+    runs = []
+    hm = make_manager(tmp_path, monkeypatch, runs)
+    hm.run()
+    assert runs == ["generate_dets", "run_helio", "pair_diagnostics", "extract_helio_results"]
+
+    runs.clear()
+    hm.outputConfig.out_hl_extracted_file.unlink()
+    hm.run()
+    assert runs == ["extract_helio_results"]
@@ -0,0 +1,47 @@
+from pathlib import Path
+import numpy as np
+
+from utils import DetectionSpool, DetectionWriter, interleave_spools
+
+COLFORMAT = Path(__file__).resolve().parent.parent / "colformat.txt"
+
+
+def epoch_columns(mjd: float, oid: list[int]) -> dict:
+    """Detections of objects `oid` (0 or 1) at `mjd`, with more decimals than the CSV keeps."""
+    oid = np.array(oid)
+    return {'AstRA(deg)': np.array([10.123456789, 350.5])[oid], 'AstDec(deg)': np.array([-5.000000004, 2.25])[oid],
+            'ObjID': oid + 3, 'FieldMJD': np.full(len(oid), mjd), 'Mag': 20, 'Band': 'r',
+            'ObsCode': np.array(['W84', 'I11'])[oid]}
+
+
+def test_columns_follow_colformat(tmp_path):
+    with DetectionWriter(tmp_path / "dets.csv", COLFORMAT) as writer:
+        writer.write_columns(epoch_columns(60676.123456789, [0, 1]))
+    assert (tmp_path / "dets.csv").read_text().splitlines() == [
+        "AstRA(deg),AstDec(deg),ObjID,FieldMJD,Mag,Band,ObsCode",
+        "10.12345679,-5,3,60676.12345679,20,r,W84",
+        "350.5,2.25,4,60676.12345679,20,r,I11",
+    ]
+
+
+def test_column_order_of_another_colformat(tmp_path):
+    (tmp_path / "colformat.txt").write_text("IDCOL 1\nMJDCOL 2\nRACOL 3\nDECCOL 4\nMAGCOL 5\nBANDCOL 6\nOBSCODECOL 7\n")
+    with DetectionWriter(tmp_path / "dets.csv", tmp_path / "colformat.txt") as writer:
+        writer.write_columns(epoch_columns(60676.5, [0]))
+    assert (tmp_path / "dets.csv").read_text().splitlines() == [
+        "ObjID,FieldMJD,AstRA(deg),AstDec(deg),Mag,Band,ObsCode",
+        "3,60676.5,10.12345679,-5,20,r,W84",
+    ]
+
+
+def test_spools_are_written_back_in_epoch_order(tmp_path):
+    with DetectionWriter(tmp_path / "direct.csv", COLFORMAT) as writer:
+        for mjd in (1.0, 2.0):
+            writer.write_columns(epoch_columns(mjd, [0, 1]))
+    for batch, oid in enumerate(([0], [1])):
+        with DetectionSpool(tmp_path / f"{batch}.arrow", COLFORMAT) as spool:
+            for mjd in (1.0, 2.0):
+                spool.write_columns(epoch_columns(mjd, oid))
+    with DetectionWriter(tmp_path / "spooled.csv", COLFORMAT) as writer:
+        assert interleave_spools([tmp_path / "0.arrow", tmp_path / "1.arrow"], writer) == 4
+    assert (tmp_path / "spooled.csv").read_text() == (tmp_path / "direct.csv").read_text()
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("rebound", reason="needs spacerocks and its SPICE kernels")
+
+
+def test_memmapped_ephemeris_integrates_like_spice(tmp_path):
+    from spacerocks.model import PerturberModel, builtin_models
+    from spacerocks.simulation import Simulation
+    from ephemeris import Ephemeris, simulation_units
+
+    mjd = [60000.0, 60001.0, 60030.0]
+    Ephemeris.compute(mjd).save(tmp_path)
+    ephemeris = Ephemeris.load(tmp_path)
+    spiceids, kernel, masses = builtin_models['ORBITSPP']
+    sims = [ephemeris.create_simulation(),
+            Simulation(model=PerturberModel(spiceids=spiceids, masses=masses), epoch=ephemeris.jd[0],
+                       units=simulation_units())]
+    res = []
+    for sim in sims:
+        # a test particle at 40 au, integrated like the population of create_observations_spacerocks
+        sim.add(x=40., y=0., z=1., vx=0., vy=0.0027, vz=0., m=0, hash='rock')
+        sim.integrator = 'leapfrog'
+        sim.integrate(ephemeris.jd[-1], exact_finish_time=1)
+        xyz = np.zeros((sim.N, 3), dtype=np.double)
+        vxvyvz = np.zeros((sim.N, 3), dtype=np.double)
+        sim.serialize_particle_data(xyz=xyz, vxvyvz=vxvyvz)
+        res.append(xyz)
+        assert sim.N_active == len(ephemeris.perturber_names)
+        assert list(sim.perturber_names) == ephemeris.perturber_names
+    np.testing.assert_allclose(res[0], res[1], rtol=0, atol=1e-12)
@@ -0,0 +1,24 @@
+import pandas as pd
+
+from utils import extract_heliolinc_results
+
+
+def test_extraction_marks_mixed_clusters_across_chunks(tmp_path):
+    # cluster 1 is split over hl_out chunks of 2 rows and mixes objects 7 and 8
+    pd.DataFrame({'clusternum': [0, 0, 1, 1, 1, 2], 'idstring': [5, 5, 7, 7, 8, 9]}).to_csv(tmp_path / "out.csv", index=False)
+    pd.DataFrame({'#clusternum': [0, 1, 2], 'heliodist': [1., 2., 3.], 'heliovel': [0., 0., 0.],
+                  'helioacc': [0., 0., 0.]}).to_csv(tmp_path / "sum.csv", index=False)
+    res = extract_heliolinc_results(tmp_path / "out.csv", tmp_path / "sum.csv", chunksize=2)
+    assert res['ObjID'].tolist() == [5, 8, 9]
+    assert res['pure'].tolist() == [True, False, True]
+
+
+def test_clusters_across_chunks_match_a_single_read(tmp_path):
+    pd.DataFrame({'clusternum': [0, 0, 1, 1, 1, 2, 3], 'idstring': [5, 5, 7, 7, 7, 9, 4]}).to_csv(tmp_path / "out.csv", index=False)
+    pd.DataFrame({'#clusternum': [0, 1, 2, 3], 'heliodist': [1., 2., 3., 4.], 'heliovel': [0., 0., 0., 0.],
+                  'helioacc': [0., 0., 0., 0.]}).to_csv(tmp_path / "sum.csv", index=False)
+    whole = extract_heliolinc_results(tmp_path / "out.csv", tmp_path / "sum.csv")
+    assert len(whole) == 4
+    for chunksize in (1, 2, 3):
+        pd.testing.assert_frame_equal(
+            extract_heliolinc_results(tmp_path / "out.csv", tmp_path / "sum.csv", chunksize=chunksize), whole)
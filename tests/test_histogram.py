@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from histogram import LinkedHistogram, truth_at
+
+
+def test_counts_match_histogram2d():
+    rng = np.random.default_rng(0)
+    r = rng.uniform(-10, 110, 5000)
+    rdot = rng.uniform(-0.06, 0.06, 5000)
+    linked = rng.random(5000) < 0.3
+    hist = LinkedHistogram.from_range(20, (0, 100), (-0.05, 0.05))
+    hist.add(r, rdot, linked)
+    edges = (hist.r_edges, hist.rdot_edges)
+    np.testing.assert_array_equal(hist.total, np.histogram2d(r, rdot, edges)[0])
+    np.testing.assert_array_equal(hist.linked, np.histogram2d(r[linked], rdot[linked], edges)[0])
+    assert hist.outside == 5000 - hist.total.sum()
+
+
+def test_saved_chunks_combine_to_their_sum(tmp_path):
+    rng = np.random.default_rng(1)
+    whole = LinkedHistogram.from_range(10, (0, 100), (-0.05, 0.05))
+    paths = []
+    for k in range(3):
+        r, rdot, linked = rng.uniform(0, 120, 100), rng.uniform(-0.05, 0.05, 100), rng.random(100) < 0.5
+        chunk = LinkedHistogram.from_range(10, (0, 100), (-0.05, 0.05))
+        chunk.add(r, rdot, linked)
+        chunk.save(tmp_path / f"{k}.npz")
+        paths.append(tmp_path / f"{k}.npz")
+        whole.add(r, rdot, linked)
+    combined = LinkedHistogram.combine(paths)
+    np.testing.assert_array_equal(combined.total, whole.total)
+    np.testing.assert_array_equal(combined.linked, whole.linked)
+    assert combined.outside == whole.outside > 0
+
+
+def test_other_edges_cannot_be_summed():
+    hist = LinkedHistogram.from_range(10, (0, 100), (-0.05, 0.05))
+    with pytest.raises(ValueError):
+        hist += LinkedHistogram.from_range(12, (0, 100), (-0.05, 0.05))
+
+
+def test_truth_is_evaluated_at_the_epoch():
+    # r(t) = 0.001 t^2 + 0.5 t + 30 in raw MJD, like the np.polyfit coefficients of the object table
+    obj_table = pd.DataFrame({'helioAcc': [0.001], 'helioVel': [0.5], 'helioDist': [30.]})
+    r, rdot = truth_at(obj_table, 10.)
+    np.testing.assert_allclose(r, [35.1])
+    np.testing.assert_allclose(rdot, [0.52])
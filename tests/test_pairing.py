@@ -0,0 +1,35 @@
+import numpy as np
+
+from pairing import find_pairs
+from pairstats import image_numbers
+
+
+def test_images_are_split_by_observatory():
+    mjd = np.array([0.0, 0.0, 1.0, 1.0])
+    image, images = image_numbers(mjd, np.array(['I11', 'X05', 'X05', 'I11']))
+    assert image.tolist() == [0, 1, 3, 2]
+    assert images.tolist() == [0.0, 0.0, 1.0, 1.0]
+
+
+def test_detections_of_two_sites_at_one_mjd_are_not_paired():
+    # two observatories see the same field at MJD 0 and one of them again at MJD 1
+    mjd = np.array([0.0, 0.0, 1.0])
+    ra = np.array([10.0, 10.1, 10.2])
+    dec = np.zeros(3)
+    i1, i2 = find_pairs(mjd, ra, dec, maxvel=1, maxtime=2, obscode=np.array(['I11', 'X05', 'I11']))
+    assert list(zip(i1.tolist(), i2.tolist())) == [(0, 2), (1, 2)]
+
+
+def test_pairs_match_a_brute_force_search():
+    rng = np.random.default_rng(1)
+    mjd = rng.choice([0.0, 0.5, 1.0, 3.0, 7.0], 300)
+    ra = rng.uniform(10, 14, 300)
+    dec = rng.uniform(-2, 2, 300)
+    i1, i2 = find_pairs(mjd, ra, dec, maxvel=1, maxtime=5)
+    a, b = np.meshgrid(np.arange(300), np.arange(300), indexing='ij')
+    dt = mjd[b] - mjd[a]
+    cos_sep = (np.sin(np.radians(dec[a])) * np.sin(np.radians(dec[b]))
+               + np.cos(np.radians(dec[a])) * np.cos(np.radians(dec[b])) * np.cos(np.radians(ra[b] - ra[a])))
+    rate = np.degrees(np.arccos(np.clip(cos_sep, -1, 1))) / np.where(dt > 0, dt, 1)
+    expected = np.argwhere((dt > 0) & (dt <= 5) & (rate <= 1))
+    np.testing.assert_array_equal(np.column_stack([i1, i2]), expected)
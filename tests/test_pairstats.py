@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from pairstats import pair_stats, read_pairs
+
+
+def make_pairdets(rows):
+    return pd.DataFrame(rows, columns=['#MJD', 'RA', 'Dec', 'idstring'])
+
+
+def test_slow_cross_pair_is_not_counted_as_true():
+    # a fast true pair (rate 1 deg/day) and a slow cross-object pair (rate 0.1 deg/day)
+    pairdets = make_pairdets([
+        (0.0, 10.0, 0.0, 1), (1.0, 11.0, 0.0, 1),
+        (0.0, 50.0, 0.0, 2), (1.0, 50.1, 0.0, 3),
+    ])
+    pairs = np.array([[0, 1], [2, 3]])
+    stats = pair_stats(pairdets, pairs, maxvel=2)
+    assert stats['true_pairs'] == 1
+    assert stats['cross_pairs'] == 1
+    growth = {row['maxvel']: row for row in stats['maxvel_growth']}
+    # at maxvel 0.2 only the slow cross pair is in reach
+    assert growth[0.2] == {'maxvel': 0.2, 'pairs': 1, 'true_pairs': 0, 'cross_pairs': 1}
+    assert growth[2.0] == {'maxvel': 2.0, 'pairs': 2, 'true_pairs': 1, 'cross_pairs': 1}
+
+
+def test_single_slow_cross_pair():
+    pairdets = make_pairdets([(0.0, 50.0, 0.0, 2), (1.0, 50.1, 0.0, 3)])
+    stats = pair_stats(pairdets, np.array([[0, 1]]), maxvel=0.2)
+    assert stats['true_pairs'] == 0
+    assert stats['cross_pairs'] == 1
+    assert stats['maxvel_growth'][-1]['cross_pairs'] == 1
+    assert [o['ObjID'] for o in stats['top_cross_objects']] == [2, 3]
+
+
+def test_no_pairs():
+    pairdets = make_pairdets([(0.0, 50.0, 0.0, 2)])
+    stats = pair_stats(pairdets, np.empty((0, 2), dtype=np.int64), maxvel=1)
+    assert stats['pairs'] == 0
+    assert all(row['pairs'] == 0 for row in stats['maxvel_growth'])
+
+
+def test_read_pairs_skips_tracklet_lines(tmp_path):
+    path = tmp_path / "pairs.csv"
+    path.write_text("P 0 1\nT 2 3 4\nP 2 3\nT 5 6 7 8 9\nP 4 5\n")
+    np.testing.assert_array_equal(read_pairs(path), [[0, 1], [2, 3], [4, 5]])
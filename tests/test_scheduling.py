@@ -0,0 +1,74 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+
+import start
+from config import HelioOutputConfig, HelioSharedConfig
+from helio import NativeRunAborted
+from start import leaf_chunks, plan_chunk_sizes, scheduled_chunck_task
+
+
+@pytest.mark.parametrize("population, workers, max_size, min_size", [
+    (9600, 8, 800, 200), (1000, 4, 1000, 100), (150, 8, 800, 200), (12345, 3, 500, 50)])
+def test_chunk_sizes_cover_the_population_largest_first(population, workers, max_size, min_size):
+    sizes = plan_chunk_sizes(population, workers, max_size, min_size)
+    assert sum(sizes) == population
+    assert sizes == sorted(sizes, reverse=True)
+    assert max(sizes) <= max_size
+    # only the last chunk takes the remainder below the minimum
+    assert min(sizes[:-1], default=min_size) >= min_size
+
+
+class Pool:
+    executor = None
+
+    def restart(self, broken) -> None:
+        pass
+
+
+def run_chunk(monkeypatch, tmp_path, fail, size=100, retries=2, splits=2) -> tuple[dict, list, HelioOutputConfig]:
+    """Schedules one chunk whose attempts raise `fail(output_config)` unless it returns None."""
+    attempts = []
+
+    async def attempt(executor, runner, shared_config, output_config, i):
+        attempts.append((output_config.output_dir.name, output_config.startOidIndex, output_config.size))
+        error = fail(output_config)
+        if error is not None:
+            raise error
+
+    monkeypatch.setattr(start, 'pipelined_chunck_task', attempt)
+    shared = HelioSharedConfig(size=size, t=0, mjd_list=[0.0], guess_file=Path("guess.csv"), earth_file=Path("earth"),
+                               obs_file=Path("obs"), colformat_file=Path("colformat.txt"))
+    output = HelioOutputConfig(startOidIndex=1000, output_dir=tmp_path / "3", size=size)
+    result = asyncio.run(scheduled_chunck_task(Pool(), None, shared, output, 3, retries, splits))
+    return result, attempts, output
+
+
+def test_failed_attempts_are_retried(monkeypatch, tmp_path):
+    errors = [RuntimeError("flaky"), None]
+    result, attempts, _ = run_chunk(monkeypatch, tmp_path, lambda con: errors.pop(0))
+    assert (result['status'], result['attempts'], result['error']) == ('succeeded', 2, None)
+    assert len(attempts) == 2
+
+
+def test_a_chunk_over_its_budget_is_split(monkeypatch, tmp_path):
+    def fail(con):
+        if con.size > 30:
+            return NativeRunAborted(["make_tracklets"], 'memory', "over 1 GiB")
+    result, attempts, output = run_chunk(monkeypatch, tmp_path, fail)
+    # 100 objects, then halves of 50 and quarters of 25; an aborted run is never retried as is
+    assert [a[2] for a in attempts] == [100, 50, 50, 25, 25, 25, 25]
+    assert result['status'] == 'succeeded'
+    leaves = leaf_chunks(output, result)
+    assert [(con.output_dir.name, con.startOidIndex, con.size) for con, _ in leaves] == [
+        ("3.1.1", 1000, 25), ("3.1.2", 1025, 25), ("3.2.1", 1050, 25), ("3.2.2", 1075, 25)]
+    assert all(res['status'] == 'succeeded' for _, res in leaves)
+
+
+def test_splits_are_bounded(monkeypatch, tmp_path):
+    result, attempts, _ = run_chunk(
+        monkeypatch, tmp_path, lambda con: NativeRunAborted(["heliolinc"], 'cpu', "over 60 s"), splits=1)
+    assert [a[2] for a in attempts] == [100, 50, 50]
+    assert result['status'] == 'failed'
+    assert [part['status'] for part in result['parts']] == ['failed', 'failed']
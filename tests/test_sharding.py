@@ -0,0 +1,39 @@
+import pandas as pd
+
+from sharding import merge_shards, split_guess_file
+
+
+def write_shard(shard_dir, clusters: list[list[int]], metric: list[float]) -> None:
+    """A shard's hl_out/hl_outsum with one cluster per list of pairdets rows."""
+    shard_dir.mkdir(parents=True)
+    rows = [(c, i) for c, cluster in enumerate(clusters) for i in cluster]
+    pd.DataFrame({'#ptnum': range(len(rows)), 'idstring': [str(i) for _, i in rows],
+                  'index1': [i for _, i in rows], 'clusternum': [c for c, _ in rows]}).to_csv(
+        shard_dir / "hl_out.csv", index=False)
+    pd.DataFrame({'#clusternum': range(len(clusters)), 'metric': metric}).to_csv(
+        shard_dir / "hl_outsum.csv", index=False)
+
+
+def test_a_linkage_found_by_several_shards_is_kept_once(tmp_path):
+    # rows {1, 2, 3} are linked by both shards (in another order by the second), and twice by the first
+    write_shard(tmp_path / "0", [[1, 2, 3], [4, 5, 6], [1, 2, 3]], [1., 5., 2.])
+    write_shard(tmp_path / "1", [[7, 8, 9], [3, 2, 1]], [1., 3.])
+    n_found, n_kept = merge_shards([tmp_path / "0", tmp_path / "1"], tmp_path / "out.csv", tmp_path / "sum.csv")
+    assert (n_found, n_kept) == (5, 3)
+    hl_out = pd.read_csv(tmp_path / "out.csv")
+    hl_outsum = pd.read_csv(tmp_path / "sum.csv")
+    assert hl_outsum['#clusternum'].tolist() == [0, 1, 2]
+    # the best-metric copy of {1, 2, 3} is the second shard's
+    assert hl_outsum['metric'].tolist() == [5., 1., 3.]
+    assert hl_out['#ptnum'].tolist() == list(range(9))
+    assert hl_out['clusternum'].tolist() == [0] * 3 + [1] * 3 + [2] * 3
+    assert hl_out['index1'].tolist() == [4, 5, 6, 7, 8, 9, 3, 2, 1]
+
+
+def test_guess_rows_are_dealt_to_the_shards_once(tmp_path):
+    (tmp_path / "hypo.csv").write_text("#r rdot\n" + "".join(f"{r} 0.0\n" for r in range(7)))
+    files = split_guess_file(tmp_path / "hypo.csv", 3, tmp_path / "shards")
+    shards = [f.read_text().splitlines() for f in files]
+    assert all(lines[0] == "#r rdot" for lines in shards)
+    assert [len(lines) - 1 for lines in shards] == [3, 2, 2]
+    assert sorted(line for lines in shards for line in lines[1:]) == [f"{r} 0.0" for r in range(7)]
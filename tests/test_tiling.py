@@ -0,0 +1,52 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from tiling import SkyTiling, merge_tiles
+from utils import write_csv
+
+PAIRDETS_HEADER = ['#MJD', 'RA', 'Dec', 'mag', 'trail_len', 'trail_PA', 'sigmag', 'sig_across',
+                   'sig_along', 'image', 'idstring', 'band', 'obscode', 'known_obj', 'det_qual', 'origindex']
+
+
+def write_tile(tile_dir: Path, mjd: list[float], origindex: list[int], pairs: list[tuple[int, int]]) -> None:
+    tile_dir.mkdir(parents=True)
+    n = len(mjd)
+    frame = pd.DataFrame({name: np.zeros(n, dtype=np.int64) for name in PAIRDETS_HEADER})
+    frame['#MJD'] = mjd
+    # make_tracklets numbers the images of each run on its own
+    frame['image'] = np.unique(mjd, return_inverse=True)[1]
+    frame['idstring'] = [str(i) for i in origindex]
+    frame['origindex'] = origindex
+    write_csv(frame, tile_dir / "pairdets.csv")
+    with open(tile_dir / "pairs.csv", 'w') as f:
+        f.writelines(f"P {i} {j}\n" for i, j in pairs)
+
+
+def test_merged_images_are_numbered_over_all_tiles(tmp_path):
+    # tile 0 sees epochs 1 and 2, tile 1 sees epochs 0 and 2
+    write_tile(tmp_path / "0", [1.0, 2.0], [0, 1], [(0, 1)])
+    write_tile(tmp_path / "1", [0.0, 2.0], [0, 1], [(0, 1)])
+    core = np.array([0, 0, 1, 1])
+    tiles = [(0, tmp_path / "0", np.array([0, 1])), (1, tmp_path / "1", np.array([2, 3]))]
+    n_pairdets, n_pairs = merge_tiles(core, tiles, tmp_path / "pairdets.csv", tmp_path / "pairs.csv")
+    assert (n_pairdets, n_pairs) == (4, 2)
+    merged = pd.read_csv(tmp_path / "pairdets.csv")
+    assert merged['origindex'].tolist() == [0, 1, 2, 3]
+    assert merged['image'].tolist() == [1, 2, 0, 2]
+
+
+def test_tiles_hold_the_margin_around_their_core():
+    rng = np.random.default_rng(0)
+    ra = rng.uniform(0, 360, 2000)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, 2000)))
+    tiling = SkyTiling(tile_deg=15, margin=4)
+    core = tiling.core_tile(ra, dec)
+    members = tiling.members(ra, dec)
+    assert len(members) == len(tiling)
+    xyz = np.column_stack([np.cos(np.radians(dec)) * np.cos(np.radians(ra)),
+                           np.cos(np.radians(dec)) * np.sin(np.radians(ra)), np.sin(np.radians(dec))])
+    near = xyz @ xyz.T >= np.cos(np.radians(tiling.margin))
+    for t, idx in enumerate(members):
+        # every detection within the margin of one of the tile's own detections is in its input
+        assert set(np.flatnonzero(near[core == t].any(axis=0))) <= set(idx)
@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+
+from utils import extract_object_truth_values, extract_object_truth_values_polyfit
+
+
+def test_two_observatories_at_two_epochs_do_not_break_the_batch():
+    # object 1 has 4 detections but only 2 distinct epochs (2 obscodes x 2 epochs)
+    dets = pd.DataFrame({'ObjID': [1, 1, 1, 1, 2, 2, 2, 2],
+                         'FieldMJD': [0., 0., 1., 1., 0., 1., 2., 3.],
+                         'd': [1., 1.1, 2., 2.1, 1., 2., 5., 10.]})
+    res = extract_object_truth_values(dets, 0, 4).set_index('ObjID')
+    assert res.loc[1].isna().all()
+    ref = extract_object_truth_values_polyfit(dets[dets['ObjID'] == 2], 0, 4).set_index('ObjID')
+    np.testing.assert_allclose(res.loc[[2]].to_numpy(), ref.to_numpy(), atol=1e-9)
+
+
+def test_batch_matches_polyfit_for_complete_and_missing_epochs():
+    rng = np.random.default_rng(0)
+    mjd = np.arange(6.)
+    dets = pd.DataFrame({'ObjID': np.repeat(np.arange(50), 6), 'FieldMJD': np.tile(mjd, 50),
+                         'd': rng.uniform(5, 50, 300) + rng.normal(scale=0.01, size=300)})
+    # a few objects miss some of the epochs
+    dets = dets.drop(index=[3, 10, 11, 40]).reset_index(drop=True)
+    res = extract_object_truth_values(dets, 0, 6)
+    ref = extract_object_truth_values_polyfit(dets, 0, 6)
+    np.testing.assert_allclose(res.to_numpy(), ref.to_numpy(), rtol=1e-7, atol=1e-9)
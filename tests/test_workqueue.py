@@ -0,0 +1,80 @@
+from pathlib import Path
+
+from config import HelioOutputConfig, HelioSharedConfig
+from workqueue import WorkQueue, run_item
+
+TASK = f"{__name__}:write_marker"
+FAILING_TASK = f"{__name__}:fail"
+EARLY_FAILING_TASK = f"{__name__}:fail_early"
+
+
+def write_marker(shared_config: HelioSharedConfig, output_config: HelioOutputConfig, i: int) -> None:
+    """Chunk task that records which attempt dir it ran in."""
+    output_config.create_output_dir()
+    (output_config.output_dir / "marker").write_text(output_config.output_dir.name)
+
+
+def fail(shared_config: HelioSharedConfig, output_config: HelioOutputConfig, i: int) -> None:
+    """Chunk task that fails after it started writing its output."""
+    output_config.create_output_dir()
+    raise RuntimeError("failed attempt")
+
+
+def fail_early(shared_config: HelioSharedConfig, output_config: HelioOutputConfig, i: int) -> None:
+    """Chunk task that fails before it writes anything."""
+    raise RuntimeError("failed before writing")
+
+
+def publish(tmp_path, n: int = 1, retries: int = 1) -> tuple[WorkQueue, list[str]]:
+    shared = HelioSharedConfig(size=10, t=0, mjd_list=[0.0], guess_file=Path("guess.csv"), earth_file=Path("earth"),
+                               obs_file=Path("obs"), colformat_file=Path("colformat.txt"))
+    queue = WorkQueue(tmp_path / "queue")
+    ids = queue.publish(shared, [HelioOutputConfig(startOidIndex=10 * i, output_dir=tmp_path / f"{i}", size=10)
+                                 for i in range(n)], retries)
+    return queue, ids
+
+
+def test_items_are_claimed_once_and_retried(tmp_path):
+    queue, ids = publish(tmp_path, n=2)
+    first, second = queue.claim(), queue.claim()
+    assert (first['id'], second['id']) == tuple(ids)
+    assert queue.claim() is None
+    queue.release(first, run_item(queue, first, "a", task=FAILING_TASK))
+    # back in tasks/ for its retry
+    retry = queue.claim()
+    assert (retry['id'], retry['attempts']) == (first['id'], 2)
+    queue.release(retry, run_item(queue, retry, "a", task=FAILING_TASK))
+    queue.release(second, run_item(queue, second, "b", task=TASK))
+    results = queue.results(ids)
+    assert [results[i]['status'] for i in ids] == ['failed', 'succeeded']
+    assert results[ids[0]]['attempts'] == 2
+
+
+def test_an_attempt_that_lost_its_lease_leaves_the_output_dir_alone(tmp_path):
+    queue, ids = publish(tmp_path)
+    stale = queue.claim()
+    # the coordinator sees no heartbeat and puts the item back, another worker runs it
+    queue.reclaim_expired(lease_timeout=0)
+    queue.reclaim_expired(lease_timeout=0)
+    current = queue.claim()
+    assert current['attempts'] == 2
+    queue.release(current, run_item(queue, current, "current", task=TASK))
+
+    # the first worker only finishes now
+    result = run_item(queue, stale, "stale", task=TASK)
+    queue.release(stale, result)
+    assert (tmp_path / "0" / "marker").read_text().endswith("current")
+    assert queue.results(ids)[ids[0]]['worker'] == "current"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["0", "queue"]
+
+
+def test_an_attempt_that_wrote_nothing_keeps_the_earlier_output(tmp_path):
+    queue, ids = publish(tmp_path)
+    first = queue.claim()
+    queue.release(first, run_item(queue, first, "a", task=FAILING_TASK))
+    retry = queue.claim()
+    result = run_item(queue, retry, "b", task=EARLY_FAILING_TASK)
+    assert result['status'] == 'failed'
+    queue.release(retry, result)
+    # the output dir of the first attempt stays in place
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["0", "queue"]
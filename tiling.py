@@ -0,0 +1,207 @@
+"""Sky tiling of a detection catalog for parallel make_tracklets runs.
+
+The sky is cut into declination bands of `tile_deg` and every band into RA cells of
+about `tile_deg` on the sky. Each detection has one core tile; a tile's make_tracklets
+input also holds the detections within `margin` degrees of its core, with the margin
+set to the largest distance a pair can span (maxvel * maxtime). A pair whose first
+detection lies in the core of a tile therefore has both detections in that tile's
+input, so keeping each pair only in the tile that owns its first detection gives every
+pair exactly once when the tiles are merged into one global pairdets/pairs set.
+"""
+from pathlib import Path
+import math
+import numpy as np
+import pandas as pd
+import perf
+from helio import NativeRunner, gather_native
+from pairstats import image_numbers, read_pairs
+from utils import DETS_DTYPES, DetectionWriter, read_colformat, write_csv
+
+PAIRDETS_ORIGINDEX = 'origindex'
+
+
+def tile_margin(maxvel: float, maxtime: float) -> float:
+    """Overlap margin in degrees for make_tracklets' -maxvel (deg/day) and -maxtime (days)."""
+    return maxvel * maxtime
+
+
+class SkyTiling:
+    """Declination bands of `tile_deg`, each split into RA cells at least `tile_deg` wide."""
+
+    def __init__(self, tile_deg: float, margin: float) -> None:
+        self.tile_deg = tile_deg
+        self.margin = margin
+        n_bands = max(1, math.ceil(180 / tile_deg))
+        self.dec_edges = np.linspace(-90, 90, n_bands + 1)
+        self.n_ra = []
+        for lo, hi in zip(self.dec_edges[:-1], self.dec_edges[1:]):
+            widest = 0 if lo < 0 < hi else min(abs(lo), abs(hi))
+            self.n_ra.append(max(1, int(360 * math.cos(math.radians(widest)) // tile_deg)))
+        self.band_offset = np.concatenate([[0], np.cumsum(self.n_ra)])
+
+    def __len__(self):
+        return int(self.band_offset[-1])
+
+    def core_tile(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        """Index of the tile that owns each detection."""
+        band = np.clip(np.searchsorted(self.dec_edges, dec, side='right') - 1, 0, len(self.n_ra) - 1)
+        n_ra = np.asarray(self.n_ra)[band]
+        cell = np.minimum((np.mod(ra, 360) / 360 * n_ra).astype(np.int64), n_ra - 1)
+        return self.band_offset[band] + cell
+
+    def ra_margin(self, lo: float, hi: float) -> float:
+        """RA half-width that covers `margin` on the sky for declinations in [lo, hi], 180 for all RAs."""
+        cos_dec = math.cos(math.radians(min(90, max(abs(lo), abs(hi)))))
+        s = math.sin(math.radians(self.margin))
+        if s >= cos_dec:
+            return 180.0
+        return math.degrees(math.asin(s / cos_dec))
+
+    def members(self, ra: np.ndarray, dec: np.ndarray) -> list[np.ndarray]:
+        """Sorted detection indices of every tile, its core plus the overlap margin."""
+        ra = np.mod(ra, 360)
+        res = []
+        for b, (lo, hi) in enumerate(zip(self.dec_edges[:-1], self.dec_edges[1:])):
+            lo_m, hi_m = lo - self.margin, hi + self.margin
+            in_band = np.flatnonzero((dec >= lo_m) & (dec <= hi_m))
+            order = np.argsort(ra[in_band], kind='stable')
+            band_idx = in_band[order]
+            band_ra = ra[band_idx]
+            half = self.ra_margin(lo_m, hi_m)
+            width = 360 / self.n_ra[b]
+            for k in range(self.n_ra[b]):
+                start, stop = k * width - half, (k + 1) * width + half
+                if stop - start >= 360:
+                    idx = band_idx
+                else:
+                    # up to two RA ranges when the cell with its margin wraps around 0
+                    ranges = [(max(start, 0), min(stop, 360))]
+                    if start < 0:
+                        ranges.append((start + 360, 360))
+                    if stop > 360:
+                        ranges.append((0, stop - 360))
+                    idx = np.concatenate([band_idx[np.searchsorted(band_ra, a, side='left'):
+                                                   np.searchsorted(band_ra, z, side='right')] for a, z in ranges])
+                res.append(np.unique(idx))
+        return res
+
+
+def read_dets(dets_file: Path, colformat_file: Path) -> pd.DataFrame:
+    """Reads the colformat columns of a detection CSV under the names used by DetectionWriter."""
+    names = read_colformat(colformat_file)
+    dets = pd.read_csv(dets_file, usecols=range(len(names)), dtype={name: DETS_DTYPES[name] for name in names})
+    dets.columns = names
+    return dets
+
+
+def write_tiles(dets: pd.DataFrame, tiling: SkyTiling, tiles_dir: Path, colformat_file: Path):
+    """Writes the input of every tile that owns detections to `tiles_dir`/<tile>/dets.csv.
+
+    Returns the global core tile of each detection and (tile, dir, member indices) per written tile.
+    """
+    ra = dets['AstRA(deg)'].to_numpy()
+    dec = dets['AstDec(deg)'].to_numpy()
+    core = tiling.core_tile(ra, dec)
+    owned = np.bincount(core, minlength=len(tiling))
+    tiles = []
+    for t, idx in enumerate(tiling.members(ra, dec)):
+        if owned[t] == 0:
+            continue
+        tile_dir = Path(tiles_dir) / f"{t}"
+        tile_dir.mkdir(parents=True, exist_ok=True)
+        with DetectionWriter(tile_dir / "dets.csv", colformat_file) as writer:
+            writer.write_frame(dets.iloc[idx])
+        tiles.append((t, tile_dir, idx))
+    return core, tiles
+
+
+def merge_tiles(core: np.ndarray, tiles: list, out_pairdets: Path, out_pairs: Path) -> tuple[int, int]:
+    """Merges the per-tile make_tracklets outputs into global pairdets/pairs files.
+
+    Each pair is kept only by the tile that owns its first detection, the paired detections
+    are deduplicated by their global catalog index, which becomes their origindex. The
+    per-tile image numbers are replaced by the ones of the merged detections (see
+    `pairstats.image_numbers`), like make_tracklets numbers the images of an untiled catalog.
+    The tracklet lines of the tile pair files are not carried over, see `pairstats.read_pairs`.
+    Returns the number of paired detections and of pairs written.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as csv
+
+    tables = []
+    origindex = []
+    pair_parts = []
+    for t, tile_dir, idx in tiles:
+        table = csv.read_csv(tile_dir / "pairdets.csv",
+                             convert_options=csv.ConvertOptions(column_types={'idstring': pa.string()}))
+        # index of every paired detection in the global catalog
+        glob = idx[table[PAIRDETS_ORIGINDEX].to_numpy()]
+        pairs = glob[read_pairs(tile_dir / "pairs.csv")]
+        pair_parts.append(pairs[core[pairs[:, 0]] == t])
+        tables.append(table)
+        origindex.append(glob)
+
+    pairs = np.concatenate(pair_parts or [np.empty((0, 2), dtype=np.int64)])
+    # unique pairs through one int64 key per pair, much faster than np.unique(axis=0)
+    keys = np.unique(pairs[:, 0] * len(core) + pairs[:, 1])
+    pairs = np.column_stack([keys // len(core), keys % len(core)])
+    if tables:
+        table = pa.concat_tables(tables)
+        origindex = np.concatenate(origindex)
+        # first row of every paired detection, in global index order
+        used, first = np.unique(origindex, return_index=True)
+        first = first[np.isin(used, pairs)]
+        table = table.take(first)
+        pairdets = table.to_pandas()
+        pairdets[PAIRDETS_ORIGINDEX] = origindex[first]
+        mjd = pairdets[pairdets.columns[0]].to_numpy()  # #MJD
+        pairdets['image'] = image_numbers(mjd, pairdets['obscode'].to_numpy())[0]
+    else:
+        pairdets = pd.DataFrame()
+    write_csv(pairdets, out_pairdets)
+
+    # pairdets rows are sorted by global index, so a global index maps to its row by searchsorted
+    rows = np.searchsorted(pairdets[PAIRDETS_ORIGINDEX].to_numpy(), pairs) if len(pairs) else pairs
+    with open(out_pairs, 'w') as f:
+        pd.DataFrame({'kind': 'P', 'i1': rows[:, 0], 'i2': rows[:, 1]}).to_csv(f, sep=' ', header=False, index=False)
+    return len(pairdets), len(pairs)
+
+
+async def run_tiled_make_tracklets(
+    runner: NativeRunner,
+    dets: str, earth: str,
+    obscode: str,
+    colformat: str,
+    tile_deg: float,
+    tiles_dir: Path,
+    maxvel: float = 2,
+    maxtime: float = 5,
+    out_pairdets: str = "pairdetfile.csv",
+    out_pairs: str = "outpairfile",
+) -> None:
+    """
+    Runs make_tracklets once per sky tile on `runner` and merges the results.
+
+    Parameters:
+    - runner (NativeRunner): bounds the number of simultaneous make_tracklets runs.
+    - tile_deg (float): Size of the sky tiles in degrees, should be well above maxvel * maxtime.
+    - tiles_dir (Path): Directory for the per-tile inputs and outputs.
+    - The other parameters are the ones of `helio.run_make_tracklets`.
+    """
+    with perf.measure("tile_split"):
+        catalog = read_dets(dets, colformat)
+        tiling = SkyTiling(tile_deg, tile_margin(maxvel, maxtime))
+        core, tiles = write_tiles(catalog, tiling, tiles_dir, colformat)
+        perf.annotate(rows_in=len(catalog), rows_out=sum(len(idx) for _, _, idx in tiles), tiles=len(tiles))
+    print(f"Split {len(catalog)} detections into {len(tiles)} sky tiles of {tile_deg} deg")
+
+    await gather_native(*(
+        runner.make_tracklets(tile_dir / "dets.csv", earth, obscode, colformat, maxvel=maxvel, maxtime=maxtime,
+                              out_pairdets=tile_dir / "pairdets.csv", out_pairs=tile_dir / "pairs.csv",
+                              stdout_file=tile_dir / "make_tracklets_stdout.txt")
+        for _, tile_dir, _ in tiles))
+
+    with perf.measure("tile_merge"):
+        n_pairdets, n_pairs = merge_tiles(core, tiles, out_pairdets, out_pairs)
+        perf.annotate(rows_out=n_pairdets, pairs=n_pairs)
+
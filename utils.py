@@ -1,23 +1,14 @@
 import numpy as np
 import pandas as pd
 import subprocess
-import matplotlib.pyplot as plt
-from timeit import default_timer as time
+from functools import wraps
+from perf import measure
 
-import astropy.table as tb
-from astropy.time import Time
-from astropy import units as u
-from astropy import constants as c
+# matplotlib, astropy and spacerocks take over a second to import, they are imported by the
+# functions that use them so that workers which only extract results never load them
 
-from spacerocks.units import Units
-from spacerocks.simulation import Simulation
-from spacerocks.model import PerturberModel, builtin_models
-from spacerocks.cbindings import correct_for_ltt_destnosim
-from spacerocks.observer import Observer
-from spacerocks.constants import epsilon
 
-
-def create_random_objects(size: int):
+def create_random_objects(size: int, seed=None):
     # a, e, i, lan, aop, M
     # a : 1.1 -  50
     # e : 0.0 - 0.99
@@ -35,30 +26,394 @@ def create_random_objects(size: int):
     - Longitude of perihelion: provide as 'varpi' or 'lop' (degrees)
     - Time of perihelion passage: provide as 'top' or 'T_p' (years)
     - Mean anomaly: provide as 'man' or 'M' (degrees)
+
+    `seed` (an int or a sequence of ints) makes the population reproducible,
+    otherwise the global numpy random state is used.
     """
+    import astropy.table as tb
+
+    rng = np.random if seed is None else np.random.default_rng(seed)
 
     table = tb.Table(
         data=[
-            np.random.uniform(1.1, 50, size=size),
-            np.random.uniform(0, 0.99, size=size),
-            np.random.uniform(0, 180, size=size),
-            np.random.uniform(0, 360, size=size),
-            np.random.uniform(0, 360, size=size),
-            np.random.uniform(0, 360, size=size)
+            rng.uniform(1.1, 50, size=size),
+            rng.uniform(0, 0.99, size=size),
+            rng.uniform(0, 180, size=size),
+            rng.uniform(0, 360, size=size),
+            rng.uniform(0, 360, size=size),
+            rng.uniform(0, 360, size=size)
         ],
         names=['a', 'e', 'i', 'Omega', 'omega', 'M']
     )
     return table
 
 
-def create_observations_spacerocks(population, mjd: list[float], progress: bool = False, startOidIndex: int = 0):
+def constant_category(value: str, size: int) -> pd.Categorical:
+    """`size` rows of the string `value`, stored as one-byte codes."""
+    return pd.Categorical.from_codes(np.zeros(size, dtype=np.int8), [value])
+
+
+class DetectionBuilder:
+    """Column buffers for a detection catalog of `n_epochs * len(obscodes) * n_objects` rows.
+
+    All columns are allocated once up front and every epoch is written in place
+    into its own slice, so building the catalog never copies earlier epochs.
+    Within an epoch, rows go by observatory and then by object.
+    The truth columns d/x/y/z are stored as `truth_dtype`; positions and epochs
+    always stay float64, float32 would round MJDs to minutes.
+    """
+
+    def __init__(self, n_epochs: int, n_objects: int, startOidIndex: int = 0, truth_dtype=np.double,
+                 obscodes: list[str] = ('W84',)):
+        self.n_epochs = n_epochs
+        self.n_objects = n_objects
+        self.obscodes = list(obscodes)
+        self.n_sites = len(self.obscodes)
+        if not 0 < self.n_sites <= np.iinfo(np.int8).max:
+            raise ValueError(f"Between 1 and {np.iinfo(np.int8).max} observatories are supported")
+        size = n_epochs * self.n_sites * n_objects
+        self.ra = np.empty(size, dtype=np.double)
+        self.dec = np.empty(size, dtype=np.double)
+        self.mjd = np.empty(size, dtype=np.double)
+        self.d = np.empty(size, dtype=truth_dtype)
+        self.x = np.empty(size, dtype=truth_dtype)
+        self.y = np.empty(size, dtype=truth_dtype)
+        self.z = np.empty(size, dtype=truth_dtype)
+        self.oid = np.tile(np.arange(startOidIndex, startOidIndex + n_objects, dtype=np.int64), n_epochs * self.n_sites)
+        # observatory code of every row, only stored with several observatories
+        self.site = None
+        if self.n_sites > 1:
+            self.site = np.tile(np.repeat(np.arange(self.n_sites, dtype=np.int8), n_objects), n_epochs)
+
+    def __len__(self):
+        return self.n_epochs * self.n_sites * self.n_objects
+
+    def epoch_slice(self, i: int) -> slice:
+        block = self.n_sites * self.n_objects
+        return slice(i * block, (i + 1) * block)
+
+    def add_epoch(self, i: int, mjd: float, ra, dec, x, y, z) -> None:
+        """Writes the detections of epoch `i` into their slice of the column buffers.
+
+        `ra` and `dec` are (n_objects,) or (n_sites, n_objects) arrays, the heliocentric
+        truth `x`, `y`, `z` is (n_objects,) and the same for every observatory.
+        """
+        s = self.epoch_slice(i)
+        self.ra[s] = np.ravel(ra)
+        self.dec[s] = np.ravel(dec)
+        self.mjd[s] = mjd
+        shape = (self.n_sites, self.n_objects)
+        self.x[s].reshape(shape)[:] = x
+        self.y[s].reshape(shape)[:] = y
+        self.z[s].reshape(shape)[:] = z
+        d = self.d[s].reshape(shape)
+        np.multiply(x, x, out=d[0])
+        d[0] += y * y
+        d[0] += z * z
+        np.sqrt(d[0], out=d[0])
+        d[1:] = d[0]
+
+    def obscode_column(self, s: slice = slice(None)):
+        """ObsCode of the rows `s`, a plain string when there is a single observatory."""
+        if self.site is None:
+            return self.obscodes[0]
+        return pd.Categorical.from_codes(self.site[s], self.obscodes)
+
+    def columns(self) -> dict:
+        """Columns in the order expected by colformat.txt, followed by the truth columns.
+        Band and ObsCode are categoricals, see DETS_DTYPES."""
+        size = len(self)
+        return {
+            'AstRA(deg)': self.ra,
+            'AstDec(deg)': self.dec,
+            'ObjID': self.oid,
+            'FieldMJD': self.mjd,
+            'Mag': np.full(size, 20, dtype=np.int64),
+            'Band': constant_category('r', size),
+            'ObsCode': constant_category(self.obscodes[0], size) if self.site is None else self.obscode_column(),
+            'd': self.d,
+            'x': self.x,
+            'y': self.y,
+            'z': self.z,
+        }
+
+    def to_table(self):
+        import astropy.table as tb
+        return tb.Table({name: np.asarray(values) for name, values in self.columns().items()}, copy=False)
+
+    def to_pandas(self) -> pd.DataFrame:
+        return pd.DataFrame(self.columns(), copy=False)
+
+    def to_arrow(self):
+        import pyarrow as pa
+        return pa.table(self.columns())
+
+    def to_output(self, output: str = "table"):
+        if output == "table":
+            return self.to_table()
+        if output == "pandas":
+            return self.to_pandas()
+        if output == "arrow":
+            return self.to_arrow()
+        raise ValueError(f"Unknown output type: {output}")
+
+
+# colformat.txt keyword of each detection column written for make_tracklets
+COLFORMAT_COLUMNS = {
+    'RACOL': 'AstRA(deg)',
+    'DECCOL': 'AstDec(deg)',
+    'IDCOL': 'ObjID',
+    'MJDCOL': 'FieldMJD',
+    'MAGCOL': 'Mag',
+    'BANDCOL': 'Band',
+    'OBSCODECOL': 'ObsCode',
+}
+
+# compact in-memory types of the detection columns: integer object ids and categorical
+# (one-byte codes) band and observatory strings instead of one Python string per row
+DETS_DTYPES = {
+    'AstRA(deg)': np.double,
+    'AstDec(deg)': np.double,
+    'ObjID': np.int64,
+    'FieldMJD': np.double,
+    'Mag': np.int64,
+    'Band': 'category',
+    'ObsCode': 'category',
+}
+
+# decimals written per column: 1e-8 deg is 0.036 mas and 1e-8 day is under a millisecond
+DETS_PRECISION = {'AstRA(deg)': 8, 'AstDec(deg)': 8, 'FieldMJD': 8}
+
+
+def read_colformat(colformat_file) -> list[str]:
+    """Detection column names in the order given by a colformat file (1-based column numbers)."""
+    positions = {}
+    with open(colformat_file) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) != 2:
+                continue
+            key, col = parts[0], int(parts[1])
+            if key not in COLFORMAT_COLUMNS:
+                raise ValueError(f"No detection column for {key} in {colformat_file}")
+            positions[col] = COLFORMAT_COLUMNS[key]
+    if sorted(positions) != list(range(1, len(positions) + 1)):
+        raise ValueError(f"Columns of {colformat_file} must be numbered 1 to {len(positions)}")
+    return [positions[col] for col in sorted(positions)]
+
+
+class DetectionWriter:
+    """Writes the make_tracklets detection CSV, with only the columns listed in the colformat file.
+
+    Blocks of rows are rounded to `precision` decimals and formatted by Arrow's CSV writer
+    into a buffered stream, so that no value goes through Python string formatting and
+    the constant Band/ObsCode strings are dictionary-encoded. Blocks can be written as they
+    are produced, e.g. one epoch at a time while the detections are generated.
+
+    Use as a context manager:
+
+        with DetectionWriter(dets_file, colformat_file) as writer:
+            for i in range(builder.n_epochs):
+                ...
+                writer.write_epoch(builder, i)
+    """
+
+    def __init__(self, path, colformat_file, precision: dict = None, buffer_size: int = 1 << 24) -> None:
+        self.path = path
+        self.names = read_colformat(colformat_file)
+        self.precision = {**DETS_PRECISION, **(precision or {})}
+        self.rows = 0
+        self.stream = self.open_stream(buffer_size)
+        self.schema = None
+        self.writer = None
+
+    def open_stream(self, buffer_size: int):
+        """The output stream of `path`, with the CSV header already written."""
+        import pyarrow as pa
+
+        stream = pa.output_stream(str(self.path), buffer_size=buffer_size)
+        # written by hand, the CSV writer would quote the column names
+        stream.write((",".join(self.names) + "\n").encode())
+        return stream
+
+    def __enter__(self) -> "DetectionWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def block(self, columns: dict, rows: int):
+        import pyarrow as pa
+
+        arrays = []
+        for name in self.names:
+            values = columns[name]
+            if isinstance(values, str):
+                # a constant string is written from a one-entry dictionary
+                values = pa.DictionaryArray.from_arrays(np.zeros(rows, dtype=np.int32), [values])
+            elif isinstance(values, pd.Categorical):
+                values = pa.DictionaryArray.from_arrays(values.codes.astype(np.int32), values.categories.astype(str))
+            elif np.ndim(values) == 0:
+                values = np.full(rows, values)
+            elif isinstance(values, np.ndarray) and values.dtype.kind in 'UO':
+                codes, uniques = pd.factorize(values)
+                values = pa.DictionaryArray.from_arrays(codes.astype(np.int32), uniques.astype(str))
+            elif name in self.precision:
+                values = np.round(values, self.precision[name])
+            arrays.append(values)
+        return pa.table(arrays, names=self.names)
+
+    def write_columns(self, columns: dict, rows: int = None) -> None:
+        """Appends a block of detections. `columns` maps the column names to equal-length arrays
+        or to scalars repeated on all `rows` rows (by default the length of the first array).
+        """
+        if rows is None:
+            rows = next(len(v) for v in columns.values() if np.ndim(v) > 0 and not isinstance(v, str))
+        self.write_table(self.block(columns, rows))
+
+    def write_table(self, table) -> None:
+        """Appends an Arrow table with the colformat columns, already rounded (see `block`)."""
+        import pyarrow.csv as csv
+
+        if self.writer is None:
+            self.schema = table.schema
+            self.writer = csv.CSVWriter(self.stream, self.schema, write_options=csv.WriteOptions(
+                include_header=False, quoting_style='none', batch_size=1 << 16))
+        self.writer.write_table(table.cast(self.schema))
+        self.rows += table.num_rows
+
+    def write_frame(self, dets: pd.DataFrame) -> None:
+        # .values keeps categoricals, which are written from their codes
+        self.write_columns({name: dets[name].values for name in self.names}, len(dets))
+
+    def write_epoch(self, builder: DetectionBuilder, i: int) -> None:
+        """Appends epoch `i` of `builder`, once `builder.add_epoch(i, ...)` has been called."""
+        s = builder.epoch_slice(i)
+        self.write_columns({
+            'AstRA(deg)': builder.ra[s],
+            'AstDec(deg)': builder.dec[s],
+            'ObjID': builder.oid[s],
+            'FieldMJD': builder.mjd[s],
+            'Mag': 20,
+            'Band': 'r',
+            'ObsCode': builder.obscode_column(s),
+        }, s.stop - s.start)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.stream.close()
+
+
+class DetectionSpool(DetectionWriter):
+    """DetectionWriter that appends every block to an Arrow IPC file instead of the CSV.
+
+    A spool holds the detections of one sub-batch of objects, one record batch per written
+    epoch, so that `interleave_spools` can write the sub-batches back in epoch-major order.
+    """
+
+    def open_stream(self, buffer_size: int):
+        import pyarrow as pa
+
+        # no header and no buffering, the IPC file writer writes whole record batches
+        return pa.OSFile(str(self.path), 'wb')
+
+    def write_table(self, table) -> None:
+        import pyarrow as pa
+
+        if self.writer is None:
+            # dictionaries may differ between blocks, which the IPC file format does not allow
+            self.schema = pa.schema([pa.field(f.name, f.type.value_type if pa.types.is_dictionary(f.type) else f.type)
+                                     for f in table.schema])
+            self.writer = pa.ipc.new_file(self.stream, self.schema)
+        self.writer.write_table(table.cast(self.schema))
+        self.rows += table.num_rows
+
+
+def interleave_spools(spool_files: list, writer: DetectionWriter) -> int:
+    """Writes the epochs of every spool to `writer`: epoch 0 of all spools, then epoch 1, ...
+
+    Each step reads a single record batch (plain reads, mapped pages of the whole spools would
+    count towards the RSS), so the detections of a chunk are written in the order a single-batch
+    run writes them while memory stays bounded by one epoch of one sub-batch. Returns the rows written.
+    """
+    import pyarrow as pa
+
+    sources = [pa.OSFile(str(path)) for path in spool_files]
+    try:
+        readers = [pa.ipc.open_file(source) for source in sources]
+        rows = 0
+        for i in range(max((r.num_record_batches for r in readers), default=0)):
+            for reader in readers:
+                if i < reader.num_record_batches:
+                    batch = reader.get_batch(i)
+                    writer.write_table(pa.Table.from_batches([batch]))
+                    rows += batch.num_rows
+        return rows
+    finally:
+        for source in sources:
+            source.close()
+
+
+# rough peak memory of create_observations_spacerocks and the truth fit: the spacerocks
+# particle, its orbital elements and the integrator state per object, plus the states and
+# astrometry buffers of one EPOCH_BLOCK (about 400 bytes with one observatory), and per
+# detection the DetectionBuilder columns, the detection frame and the (objects x epochs) fit
+# matrices, 155 bytes measured with tracemalloc (20k-40k objects, 6-12 epochs, 1-2 observatories)
+DETS_OBJECT_BYTES = 2048
+DETS_DETECTION_BYTES = 160
+
+
+def plan_dets_batches(size: int, n_epochs: int, batch_size: int = None, memory_bytes: int = None) -> list[tuple[int, int]]:
+    """(start, size) of the sub-batches of a chunk of `size` objects.
+
+    Batches hold at most `batch_size` objects and at most the number of objects whose
+    estimated peak memory (see DETS_OBJECT_BYTES) fits in `memory_bytes`; one batch when neither is set.
+    """
+    limit = size
+    if batch_size is not None:
+        limit = min(limit, batch_size)
+    if memory_bytes is not None:
+        limit = min(limit, memory_bytes // (DETS_OBJECT_BYTES + n_epochs * DETS_DETECTION_BYTES))
+    limit = max(1, limit)
+    return [(start, min(limit, size - start)) for start in range(0, size, limit)] or [(0, 0)]
+
+
+def write_csv(frame: pd.DataFrame, path) -> None:
+    """Writes a frame with Arrow's CSV writer, with the unquoted header heliolinc2 writes and reads."""
+    import pyarrow as pa
+    import pyarrow.csv as csv
+
+    with pa.output_stream(str(path)) as stream:
+        stream.write((",".join(frame.columns) + "\n").encode())
+        csv.write_csv(pa.Table.from_pandas(frame, preserve_index=False), stream,
+                      write_options=csv.WriteOptions(include_header=False, quoting_style='none'))
+
+
+def create_observations_spacerocks(population, mjd: list[float], progress: bool = False, startOidIndex: int = 0, output: str = "table", ephemeris=None, writer: DetectionWriter = None, truth_dtype=np.double, obscodes: list[str] = ('W84',)):
     '''
     Calls the Spacerocks backend to generate observations for the input population
 
 
     Arguments:
     - population: Population object for the input orbits
+    - output: 'table' for an astropy Table, 'pandas' for a DataFrame or 'arrow' for a pyarrow Table
+    - ephemeris: precomputed `ephemeris.Ephemeris` for `mjd`, used instead of querying
+      the observer and perturber states again
+    - writer: `DetectionWriter` that receives the detections of every epoch once they are computed
+    - truth_dtype: dtype of the truth columns d/x/y/z, np.float32 halves their memory
+    - obscodes: observatories that all observe every epoch, the catalog gets one detection per
+      object, epoch and observatory
     '''
+    from astropy.time import Time
+    from astropy import units as u
+    from spacerocks.units import Units
+    from spacerocks.simulation import Simulation
+    from spacerocks.model import PerturberModel, builtin_models
+    from spacerocks.constants import epsilon
+    from astrometry import EPOCH_BLOCK, ecliptic_to_equatorial, observe, observe_buffers
+    from ephemeris import observatory_positions
+
     # first set up times and do spacerock stuff
 
     # self.createEarthSpaceRock()
@@ -70,22 +425,28 @@ def create_observations_spacerocks(population, mjd: list[float], progress: bool
     units.timeformat = 'jd'
     units.mass = u.M_sun
 
-    spiceids, kernel, masses = builtin_models['ORBITSPP']
-    model = PerturberModel(spiceids=spiceids, masses=masses)
-
-    sim = Simulation(model=model, epoch=times.jd[0], units=units)
+    if ephemeris is not None:
+        if not np.allclose(ephemeris.jd, times.jd, rtol=0, atol=1e-9):
+            raise ValueError("The ephemeris was computed for different epochs")
+        sim = ephemeris.create_simulation(units)
+        observer = ephemeris.observer_positions(obscodes)
+    else:
+        spiceids, kernel, masses = builtin_models['ORBITSPP']
+        model = PerturberModel(spiceids=spiceids, masses=masses)
+        sim = Simulation(model=model, epoch=times.jd[0], units=units)
+        observer = observatory_positions(times.jd, obscodes)
     sim.add_spacerocks(rocks)
     sim.integrator = 'leapfrog'
 
-    ras = np.array([])
-    decs = np.array([])
-    orbitid = np.array([])
-    mjds = np.array([])
-    oidlist = np.arange(startOidIndex, len(population) + startOidIndex)
-    xList = np.array([])
-    yList = np.array([])
-    zList = np.array([])
-    dList = np.array([])
+    builder = DetectionBuilder(len(times.jd), len(population), startOidIndex=startOidIndex, truth_dtype=truth_dtype,
+                               obscodes=obscodes)
+    a = np.zeros((sim.N, 3), dtype=np.double)
+    b = np.zeros((sim.N, 3), dtype=np.double)
+    # heliocentric states of a block of epochs and the astrometry buffers, reused for every block
+    block = min(EPOCH_BLOCK, len(times.jd))
+    state = np.empty((6, block, len(population)), dtype=np.double)
+    buffers = observe_buffers(len(obscodes), block, len(population))
+    rotation = ecliptic_to_equatorial(epsilon)
 
     if progress == True:
         from rich.progress import track
@@ -94,81 +455,35 @@ def create_observations_spacerocks(population, mjd: list[float], progress: bool
         epochs = range(len(times.jd))
 
     for i in epochs:
+        j = i % block
         sim.integrate(times.jd[i], exact_finish_time=1)
-        a = np.zeros((sim.N, 3), dtype=np.double)
-        b = np.zeros((sim.N, 3), dtype=np.double)
         sim.serialize_particle_data(xyz=a, vxvyvz=b)
-        x, y, z = a.T
-        vx, vy, vz = b.T
-
-        x = np.ascontiguousarray(x)[sim.N_active:]
-        y = np.ascontiguousarray(y)[sim.N_active:]
-        z = np.ascontiguousarray(z)[sim.N_active:]
-        vx = np.ascontiguousarray(vx)[sim.N_active:]
-        vy = np.ascontiguousarray(vy)[sim.N_active:]
-        vz = np.ascontiguousarray(vz)[sim.N_active:]
-
-        xList = np.append(xList, x)
-        yList = np.append(yList, y)
-        zList = np.append(zList, z)
-        dList = np.append(dList, np.sqrt(x**2 + y**2 + z**2))
-
-        # observer = Observer(epoch=times.jd[i], obscode='W84', units=units)
-        observer = Observer.from_obscode('W84').at(times.jd[i])
-        ox = observer.x.au.astype(np.double)
-        oy = observer.y.au.astype(np.double)
-        oz = observer.z.au.astype(np.double)
-        ovx = observer.vx.value.astype(np.double)
-        ovy = observer.vy.value.astype(np.double)
-        ovz = observer.vz.value.astype(np.double)
-
-        # Compute ltt-corrected topocentroc Ecliptic coordinates
-        xt, yt, zt = correct_for_ltt_destnosim(
-            x, y, z, vx, vy, vz, ox, oy, oz, ovx, ovy, ovz)
-        lon = np.arctan2(yt, xt)
-        lat = np.arcsin(zt / np.sqrt(xt**2 + yt**2 + zt**2))
-        dec = np.degrees(np.arcsin(np.sin(lat) * np.cos(epsilon) +
-                         np.cos(lat) * np.sin(lon) * np.sin(epsilon)))
-        ra = np.degrees(np.arctan2((np.cos(lat) * np.cos(epsilon) * np.sin(lon) -
-                        np.sin(lat) * np.sin(epsilon)), np.cos(lon) * np.cos(lat)))
-
-        ra[ra > 180] -= 360
-
-        orbitid = np.append(orbitid, oidlist)
-        mjds = np.append(mjds, len(oidlist) * [mjd[i]])
-
-        ras = np.append(ras, ra)
-        decs = np.append(decs, dec)
-
-    del x, y, z, vx, vy, vz, a, b, sim, xt, yt, zt, ox, oy, oz, observer
-    # gather data into something useable
-    t = tb.Table()
-    t['AstRA(deg)'] = ras
-    del ras
-    # t['RA'][t['RA'] > 180] -= 360
-    t['AstDec(deg)'] = decs
-    del decs
-    t['ObjID'] = orbitid.astype('int64')
-    del orbitid
-
-    t['FieldMJD'] = mjds
-    t['Mag'] = 20
-    t['Band'] = 'r'
-    t['ObsCode'] = 'W84'
-
-    t['d'] = dList
-    t['x'] = xList
-    t['y'] = yList
-    t['z'] = zList
+        state[:3, j] = a[sim.N_active:].T
+        state[3:, j] = b[sim.N_active:].T
+        if j < block - 1 and i < len(times.jd) - 1:
+            continue
+        # ltt-corrected topocentric positions of the block, rotated from ecliptic to equatorial
+        first = i - j
+        ra, dec = observe(*state[:, :j + 1], observer[:, first:i + 1], rotation, buffers=buffers)
+        for k in range(j + 1):
+            builder.add_epoch(first + k, mjd[first + k], ra[:, k], dec[:, k], *state[:3, k])
+            if writer is not None:
+                writer.write_epoch(builder, first + k)
+
+    del a, b, sim, state, buffers
 
     # ObjID,FieldID,FieldMJD,AstRange(km),AstRangeRate(km/s),AstRA(deg),AstRARate(deg/day),AstDec(deg),AstDecRate(deg/day),Ast-Sun(J2000x)(km),Ast-Sun(J2000y)(km),Ast-Sun(J2000z)(km),Ast-Sun(J2000vx)(km/s),Ast-Sun(J2000vy)(km/s),Ast-Sun(J2000vz)(km/s),Obs-Sun(J2000x)(km),Obs-Sun(J2000y)(km),Obs-Sun(J2000z)(km),Obs-Sun(J2000vx)(km/s),Obs-Sun(J2000vy)(km/s),Obs-Sun(J2000vz)(km/s),Sun-Ast-Obs(deg),V,V(H=0),fiveSigmaDepth,filter,MaginFilterTrue,AstrometricSigma(mas),PhotometricSigma(mag),SNR,AstrometricSigma(deg),MaginFilter,dmagDetect,dmagVignet,AstRATrue(deg),AstDecTrue(deg),detector,OBSCODE,NA
 
-    return t
+    return builder.to_output(output)
 
 
 # Creates a helio guess grid and writes it to out_filename
 
 def create_helio_guess_grid(out_filename, r_range=(1.1, 50), r_dot_range=(-1, 1), r_dot_dot_range=(0, 0), geometric_r=False, ns=(50, 5, 1), n_round=3):
+    import astropy.table as tb
+    from astropy import units as u
+    from astropy import constants as c
+
     r = np.linspace(r_range[0], r_range[1], ns[0])
     if geometric_r:
         r = np.logspace(r_range[0], r_range[1], ns[0])
@@ -186,45 +501,199 @@ def create_helio_guess_grid(out_filename, r_range=(1.1, 50), r_dot_range=(-1, 1)
     tab.write(out_filename, delimiter=' ', overwrite=True)
 
 
-def extract_heliolinc_results(hl_out_file, hl_outsum_file):
-    out = pd.read_csv(hl_out_file)
-    outs = pd.read_csv(hl_outsum_file)
-    cn_list = outs['#clusternum']
-    os_ids = out['idstring']
-    os_cn = out['clusternum']
-    cn_to_idstring = {}
-    for i in range(len(os_ids)):
-        cn = os_cn[i]
-        cn_to_idstring[cn] = os_ids[i]
-    idstring_list = [cn_to_idstring[cn] for cn in cn_list]
-    return pd.DataFrame({'idstring': idstring_list, 'clusternum': cn_list,
-                         'heliodist': outs['heliodist'], 'heliovel': outs['heliovel'], 'helioacc': outs['helioacc']})
+HL_CHUNKSIZE = 1_000_000
+# idstring is the ObjID column of the detections, parsed to int64 once here
+HL_OUT_DTYPES = {'clusternum': np.int64, 'idstring': np.int64}
+HL_OUTSUM_DTYPES = {'#clusternum': np.int64, 'heliodist': np.double,
+                    'heliovel': np.double, 'helioacc': np.double}
 
 
-def extract_object_truth_values(dets: pd.DataFrame, mjdRef: float, mjdListLen: int):
-    # dets = dets[['ObjID', 'd', 'FieldMJD']]
-    # dets = dets.sort_values('ObjID')
-    # dList = dets['d']
-    # objIdList = dets['ObjID'].unique()
-    # mjdList = dets['FieldMJD'].values
-    # mjdListLen = 6
-    # helioTruth = []
-
-    # for oid in objIdList:
-    #     x = mjdList[oid * mjdListLen: (oid + 1) * mjdListLen]  # day
-    #     y = dList[oid * mjdListLen: (oid + 1) * mjdListLen]  # AU
-    #     fit = np.polyfit(x, y, 2)
-    #     helioTruth.append(fit)
-    helioTruth = {}
+def extracted_schema(derived_float32: bool = False):
+    """Arrow schema of the extracted heliolinc results (hl_extracted.feather).
+
+    The linked object is the integer ObjID, `pure` is True when every detection of the cluster
+    belongs to that object, heliodist/heliovel/helioacc are float32 with `derived_float32`
+    (the grid values they hold have 3 decimals).
+    """
+    import pyarrow as pa
+    real = pa.float32() if derived_float32 else pa.float64()
+    return pa.schema([('ObjID', pa.int64()), ('clusternum', pa.int64()), ('pure', pa.bool_()), ('heliodist', real),
+                      ('heliovel', real), ('helioacc', real)])
+
+
+def cluster_ids(out: pd.DataFrame) -> pd.DataFrame:
+    """First and last idstring of every cluster of a chunk of hl_out rows sorted by cluster, and
+    whether all its rows share one idstring, indexed by cluster number."""
+    cn = out['clusternum'].to_numpy()
+    ids = out['idstring'].to_numpy()
+    if len(cn) == 0:
+        return pd.DataFrame({'first': ids, 'last': ids, 'pure': np.empty(0, dtype=bool)}, index=cn)
+    same_cluster = cn[1:] == cn[:-1]
+    starts = np.flatnonzero(np.r_[True, ~same_cluster])
+    ends = np.r_[starts[1:], len(cn)]
+    mixed = np.r_[False, same_cluster & (ids[1:] != ids[:-1])]
+    pure = ~np.logical_or.reduceat(mixed, starts)
+    return pd.DataFrame({'first': ids[starts], 'last': ids[ends - 1], 'pure': pure}, index=cn[starts])
+
+
+def iter_heliolinc_results(hl_out_file, hl_outsum_file, chunksize: int = HL_CHUNKSIZE):
+    """Yields the extracted heliolinc results one hl_outsum chunk at a time.
+
+    Both files are read in chunks of `chunksize` rows with fixed dtypes. heliolinc writes
+    clusters in increasing cluster number, so every hl_outsum chunk is resolved against
+    the hl_out rows read so far with a vectorized lookup and only the clusters that are
+    still ahead are kept, which bounds memory independently of the file sizes.
+    Like before, a cluster gets the idstring of its last row in hl_out, as an int64 ObjID,
+    and it is pure if all its rows have that idstring.
+    """
+    out_reader = pd.read_csv(hl_out_file, usecols=list(HL_OUT_DTYPES), dtype=HL_OUT_DTYPES, chunksize=chunksize)
+    sum_reader = pd.read_csv(hl_outsum_file, usecols=list(HL_OUTSUM_DTYPES), dtype=HL_OUTSUM_DTYPES, chunksize=chunksize)
+    pending = cluster_ids(pd.DataFrame({name: np.empty(0, dtype=dtype) for name, dtype in HL_OUT_DTYPES.items()}))
+    out_exhausted = False
+    last_cn = None
+
+    for outs in sum_reader:
+        cn_list = outs['#clusternum'].to_numpy()
+        if len(cn_list) == 0:
+            continue
+        if np.any(np.diff(cn_list) < 0) or (last_cn is not None and cn_list[0] < last_cn):
+            raise ValueError(f"{hl_outsum_file} is not sorted by cluster number")
+        last_cn = cn_list[-1]
+
+        # read hl_out until it is past the last cluster of this chunk, a cluster may span chunks
+        while not out_exhausted and (len(pending) == 0 or pending.index[-1] <= last_cn):
+            out = next(out_reader, None)
+            if out is None:
+                out_exhausted = True
+                break
+            cn = out['clusternum'].to_numpy()
+            if np.any(np.diff(cn) < 0) or (len(pending) and len(cn) and cn[0] < pending.index[-1]):
+                raise ValueError(f"{hl_out_file} is not sorted by cluster number")
+            chunk_ids = cluster_ids(out)
+            if len(pending) and len(chunk_ids) and chunk_ids.index[0] == pending.index[-1]:
+                # the cluster continues from the previous chunk
+                prev = pending.iloc[-1]
+                chunk_ids.iloc[0, chunk_ids.columns.get_loc('pure')] = \
+                    prev['pure'] and chunk_ids['pure'].iloc[0] and prev['last'] == chunk_ids['first'].iloc[0]
+                chunk_ids.iloc[0, chunk_ids.columns.get_loc('first')] = prev['first']
+                pending = pending.iloc[:-1]
+            pending = pd.concat([pending, chunk_ids])
+
+        rows = pending.index.get_indexer(cn_list)
+        missing = rows < 0
+        if missing.any():
+            raise KeyError(cn_list[missing][0])
+        obj_ids = pending['last'].to_numpy()[rows]
+        pure = pending['pure'].to_numpy()[rows]
+        pending = pending[pending.index > last_cn]
+
+        yield pd.DataFrame({'ObjID': obj_ids, 'clusternum': cn_list, 'pure': pure,
+                            'heliodist': outs['heliodist'].to_numpy(), 'heliovel': outs['heliovel'].to_numpy(),
+                            'helioacc': outs['helioacc'].to_numpy()})
+
+
+def extract_heliolinc_results(hl_out_file, hl_outsum_file, chunksize: int = HL_CHUNKSIZE):
+    frames = list(iter_heliolinc_results(hl_out_file, hl_outsum_file, chunksize))
+    if not frames:
+        return extracted_schema().empty_table().to_pandas()
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_heliolinc_results(hl_out_file, hl_outsum_file, out_file, chunksize: int = HL_CHUNKSIZE,
+                            derived_float32: bool = False) -> tuple[int, int]:
+    """Streams the extracted heliolinc results into the feather file `out_file`, see `extracted_schema`.
+
+    Each chunk is appended as its own record batch, so memory stays bounded by `chunksize`.
+    Returns the number of rows and of table bytes written.
+    """
+    import pyarrow as pa
+    schema = extracted_schema(derived_float32)
+    rows = 0
+    nbytes = 0
+    with pa.ipc.new_file(str(out_file), schema) as writer:
+        for df in iter_heliolinc_results(hl_out_file, hl_outsum_file, chunksize):
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            writer.write_table(table)
+            rows += len(df)
+            nbytes += table.nbytes
+    return rows, nbytes
+
+
+def fit_quadratics(x: np.ndarray, y: np.ndarray, mask: np.ndarray = None):
+    """Least-squares quadratic fit of every row of the (objects x epochs) matrices `x` and `y`.
+
+    All rows are solved at once through their 3x3 normal equations. `mask` marks the
+    valid entries of ragged rows; rows with fewer than 3 distinct valid epochs, whose normal
+    matrix is singular, get NaN coefficients.
+    Returns the coefficients (a, b, c) of a * x**2 + b * x + c, highest power first like np.polyfit.
+    """
+    if mask is None:
+        mask = np.ones(x.shape, dtype=bool)
+    w = mask.astype(np.double)
+    n = w.sum(axis=1)
+    # several observatories see an object at the same epoch, so count distinct epochs, not points
+    xs = np.sort(np.where(mask, x, np.nan), axis=1)
+    epochs = (~np.isnan(xs[:, :1])).sum(axis=1) + ((xs[:, 1:] != xs[:, :-1]) & ~np.isnan(xs[:, 1:])).sum(axis=1)
+    deficient = epochs < 3
+
+    # center each row on its mean epoch to keep the normal equations well conditioned
+    mid = (w * x).sum(axis=1) / np.where(n > 0, n, 1)
+    u = (x - mid[:, None]) * w
+    yw = y * w
+    u2 = u * u
+    s1 = u.sum(axis=1)
+    s2 = u2.sum(axis=1)
+    s3 = (u2 * u).sum(axis=1)
+    s4 = (u2 * u2).sum(axis=1)
+    t0 = yw.sum(axis=1)
+    t1 = (u * yw).sum(axis=1)
+    t2 = (u2 * yw).sum(axis=1)
+
+    lhs = np.stack([np.stack([s4, s3, s2], axis=-1),
+                    np.stack([s3, s2, s1], axis=-1),
+                    np.stack([s2, s1, n], axis=-1)], axis=1)
+    rhs = np.stack([t2, t1, t0], axis=-1)
+    lhs[deficient] = np.eye(3)
+    rhs[deficient] = np.nan
+    a, b, c = np.linalg.solve(lhs, rhs[..., None])[..., 0].T
+
+    # shift back from the centered epoch to the original x
+    return a, b - 2 * a * mid, c - b * mid + a * mid * mid
 
-    def item(row):
-        oid = row['ObjID'].values[0]
-        x = row['FieldMJD'].values
-        y = row['d'].values
-        fit = np.polyfit(x, y, 2)
-        helioTruth[oid] = fit
 
-    dets.groupby("ObjID", group_keys=True).apply(item)
+def extract_object_truth_values(dets: pd.DataFrame, mjdRef: float, mjdListLen: int):
+    """Fits d(FieldMJD) with a quadratic for every object in `dets`.
+
+    Detections are scattered into an (objects x epochs) matrix so that all objects are
+    fitted in one batched solve; objects with missing detections are handled through a mask.
+    """
+    oid = dets['ObjID'].to_numpy()
+    codes, objIds = pd.factorize(oid, sort=True)
+    counts = np.bincount(codes, minlength=len(objIds))
+    width = max(int(counts.max()) if len(counts) else 0, mjdListLen)
+
+    # column of each detection inside its object's row
+    order = np.argsort(codes, kind='stable')
+    starts = np.cumsum(counts) - counts
+    col = np.empty(len(codes), dtype=np.int64)
+    col[order] = np.arange(len(codes)) - np.repeat(starts, counts)
+
+    x = np.zeros((len(objIds), width), dtype=np.double)
+    y = np.zeros((len(objIds), width), dtype=np.double)
+    mask = np.zeros((len(objIds), width), dtype=bool)
+    x[codes, col] = dets['FieldMJD'].to_numpy()
+    y[codes, col] = dets['d'].to_numpy()
+    mask[codes, col] = True
+
+    ha, hv, hd = fit_quadratics(x, y, mask)
+    return pd.DataFrame({'ObjID': objIds, 'helioDist': hd, 'helioVel': hv, 'helioAcc': ha})
+
+
+def extract_object_truth_values_polyfit(dets: pd.DataFrame, mjdRef: float, mjdListLen: int):
+    """Reference implementation of `extract_object_truth_values` with one np.polyfit per object."""
+    helioTruth = {}
+    for oid, group in dets.groupby("ObjID"):
+        helioTruth[oid] = np.polyfit(group['FieldMJD'].values, group['d'].values, 2)
 
     helioTruthNdArray = np.array(list(helioTruth.values()))
     ha, hv, hd = helioTruthNdArray.T
@@ -237,7 +706,9 @@ def count_lines(filename: str):
 
 
 def plot_hypo_diff_grid(helio_extracted, obj_table, ax=None, c_linked="blue", c_not_linked="orange"):
-    linked_id_list = set(helio_extracted['idstring'].unique())
+    import matplotlib.pyplot as plt
+
+    linked_id_list = set(helio_extracted['ObjID'].unique())
     linked_obj_list = obj_table[obj_table['ObjID'].isin(linked_id_list)]
     not_linked_obj_list = obj_table[~obj_table['ObjID'].isin(linked_id_list)]
     if ax:
@@ -253,10 +724,9 @@ def plot_hypo_diff_grid(helio_extracted, obj_table, ax=None, c_linked="blue", c_
 
 
 def timeit(func):
+    """Measures every call of `func` as a perf stage named after the function."""
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        start = time()
-        res = func(*args, **kwargs)
-        end = time()
-        print(f"Time elapsed: {end - start:.4f}s")
-        return res
+        with measure(func.__qualname__):
+            return func(*args, **kwargs)
     return wrapper
@@ -0,0 +1,87 @@
+"""Worker processes for the Python stages, started from a preloaded forkserver.
+
+numpy, pandas, pyarrow, astropy, spacerocks and destnosim take seconds to import, and
+every process of a ProcessPoolExecutor pays that again with the spawn start method
+(macOS, Windows), while fork copies a parent that runs an asyncio loop and threads.
+The forkserver start method forks every worker from a single-threaded server process;
+its preload list is imported once by the server, so a new worker starts with all of it
+loaded and only pays for the fork.
+
+`import_times` profiles what importing a module costs in a fresh interpreter, see
+`python bench.py imports`.
+"""
+from timeit import default_timer as time
+import concurrent.futures
+import multiprocessing
+import re
+import subprocess
+import sys
+
+# heavy libraries imported once by the forkserver; the pipeline's own modules are cheap and
+# are imported by each worker with the first task that needs them
+WORKER_PRELOAD = [
+    "numpy", "pandas", "pyarrow", "pyarrow.csv", "pyarrow.feather",
+    "astropy.table", "astropy.time", "astropy.units", "astropy.constants",
+    "spacerocks.simulation", "spacerocks.observer", "spacerocks.model", "spacerocks.cbindings",
+    "destnosim",
+]
+
+
+def preloaded_context(preload: list[str] = WORKER_PRELOAD):
+    """forkserver multiprocessing context whose server imports `preload`, None where forkserver is unavailable.
+
+    Modules that fail to import are skipped by the server and imported by each worker on first use.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return None
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(list(preload))
+    return context
+
+
+def process_pool(max_workers: int, preload: list[str] = WORKER_PRELOAD) -> concurrent.futures.ProcessPoolExecutor:
+    """ProcessPoolExecutor whose workers are forked from a server that preloaded `preload`."""
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=preloaded_context(preload))
+
+
+def ready() -> None:
+    """Empty task, its round trip through a new pool measures the worker startup."""
+
+
+def worker_startup(executor: concurrent.futures.ProcessPoolExecutor, tasks: int = 1) -> float:
+    """Seconds until `tasks` empty tasks have run on `executor`, including the start of its workers."""
+    start = time()
+    for future in [executor.submit(ready) for _ in range(tasks)]:
+        future.result()
+    return time() - start
+
+
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_times(module: str, python: str = sys.executable):
+    """Cumulative import time in seconds of `module` and of each top-level package it pulls in.
+
+    The module is imported in a fresh interpreter with `-X importtime`, so the numbers do not
+    depend on what the caller has already imported. Returns (total, {package: seconds}).
+    """
+    res = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"],
+                         capture_output=True, text=True, check=True)
+    packages = {}
+    total = 0.0
+    # children are listed before their parent, two spaces deeper
+    children = {}
+    for line in res.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is None:
+            continue
+        cumulative = int(match.group(2)) / 1e6
+        depth, name = len(match.group(3)), match.group(4)
+        if depth == 1:
+            if name == module:
+                total, packages = cumulative, children
+            children = {}
+        elif depth == 3:
+            package = name.split(".")[0]
+            children[package] = children.get(package, 0.0) + cumulative
+    return total, dict(sorted(packages.items(), key=lambda item: -item[1]))
@@ -0,0 +1,355 @@
+"""Distributed execution of chunk tasks through a lease directory on a shared filesystem.
+
+The coordinator publishes one work item per chunk, the serialized HelioSharedConfig and
+HelioOutputConfig, and any number of workers on any node that mounts the queue and the
+output dirs pull items and run the chunk stages:
+
+    <queue_dir>/tasks/<id>.json     items waiting for a worker
+    <queue_dir>/leases/<id>.json    items a worker is running, its mtime is the heartbeat
+    <queue_dir>/results/<id>.json   result entries (status, attempts, error, worker, timings)
+    <queue_dir>/closed              written by the coordinator once every chunk has a result
+
+A worker claims an item by renaming it from tasks/ to leases/, which exactly one of
+several racing workers wins, and touches its lease while the chunk runs. A failed
+attempt goes back to tasks/ until its retries are used up. The coordinator puts back
+the leases whose heartbeat stopped for `lease_timeout` seconds (a dead worker or node);
+staleness is judged by the coordinator's own clock, so the nodes' clocks need not agree.
+Every path in the configs must resolve on every node.
+
+An attempt writes into its own hidden sibling of the chunk's output dir and renames it
+into place only if it still holds the lease when it ends, so a worker whose lease was
+taken back never writes into the output dir of the attempt that replaced it.
+
+On one box, `python workqueue.py worker --queue DIR --workers 4` or `start.py --queue DIR
+--local-workers 4` stand in for several nodes.
+"""
+from pathlib import Path
+import argparse
+import importlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from config import HelioSharedConfig, HelioOutputConfig
+from helio import NativeRunAborted
+
+LEASE_TIMEOUT = 120.0
+HEARTBEAT_INTERVAL = 10.0
+# "module:function" run for every item, called as function(shared_config, output_config, chunk number)
+CHUNK_TASK = "start:chunck_task"
+
+
+def write_json(path: Path, data: dict) -> None:
+    # written to a temporary file and renamed, readers never see a partial item
+    tmp = path.with_name(f".{path.name}.{socket.gethostname()}.{os.getpid()}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+def read_json(path: Path) -> dict | None:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class WorkQueue:
+    """The task, lease and result directories of one queue."""
+
+    def __init__(self, queue_dir: Path) -> None:
+        self.dir = Path(queue_dir)
+        self.tasks_dir = self.dir / "tasks"
+        self.leases_dir = self.dir / "leases"
+        self.results_dir = self.dir / "results"
+        for d in (self.tasks_dir, self.leases_dir, self.results_dir):
+            d.mkdir(parents=True, exist_ok=True)
+        # lease name -> (stat signature, local time it last changed), for the coordinator
+        self.heartbeats = {}
+
+    @property
+    def closed_file(self) -> Path:
+        return self.dir / "closed"
+
+    def publish(self, shared_config: HelioSharedConfig, output_configs: list[HelioOutputConfig],
+                retries: int = 2) -> list[str]:
+        """Adds one item per chunk and returns their ids. Items are claimed in this order."""
+        self.closed_file.unlink(missing_ok=True)
+        ids = []
+        for i, output_config in enumerate(output_configs, start=1):
+            task_id = f"{i:06d}"
+            name = f"{task_id}.json"
+            # leftovers of an earlier run on the same queue
+            (self.results_dir / name).unlink(missing_ok=True)
+            (self.leases_dir / name).unlink(missing_ok=True)
+            write_json(self.tasks_dir / name, {
+                'id': task_id, 'chunk': i, 'attempts': 0, 'retries': retries, 'error': None,
+                'shared_config': shared_config.model_dump(mode='json'),
+                'output_config': output_config.model_dump(mode='json')})
+            ids.append(task_id)
+        print(f"Published {len(ids)} chunk tasks to {self.tasks_dir}")
+        return ids
+
+    def claim(self) -> dict | None:
+        """Moves the first waiting item to leases/ and returns it, None if there is none."""
+        for name in sorted(os.listdir(self.tasks_dir)):
+            if not name.endswith(".json") or name.startswith("."):
+                continue
+            try:
+                os.rename(self.tasks_dir / name, self.leases_dir / name)
+            except FileNotFoundError:
+                continue  # another worker was faster
+            item = read_json(self.leases_dir / name)
+            if item is None:
+                continue  # already reclaimed by the coordinator
+            item['attempts'] += 1
+            write_json(self.leases_dir / name, item)
+            return item
+        return None
+
+    def heartbeat(self, task_id: str) -> bool:
+        """Touches the lease of `task_id`, False if it was taken away."""
+        try:
+            os.utime(self.leases_dir / f"{task_id}.json")
+            return True
+        except FileNotFoundError:
+            return False
+
+    def owns(self, item: dict) -> bool:
+        """True if the lease of `item` is still the one of its current attempt."""
+        lease = read_json(self.leases_dir / f"{item['id']}.json")
+        return lease is not None and lease['attempts'] == item['attempts']
+
+    def release(self, item: dict, result: dict) -> None:
+        """Ends the lease of `item`: back to tasks/ while retries are left after a failure that
+        was not a budget abort, otherwise `result` is written. Nothing is done if the lease was
+        reclaimed meanwhile."""
+        name = f"{item['id']}.json"
+        if not self.owns(item):
+            print(f"Chunk task {item['id']} attempt {item['attempts']} lost its lease, its result is dropped")
+            return
+        if result['status'] != 'succeeded' and not result.get('aborted') and item['attempts'] <= item['retries']:
+            write_json(self.leases_dir / name, {**item, 'error': result['error']})
+            try:
+                os.rename(self.leases_dir / name, self.tasks_dir / name)
+            except FileNotFoundError:
+                pass
+            return
+        write_json(self.results_dir / name, result)
+        (self.leases_dir / name).unlink(missing_ok=True)
+
+    def reclaim_expired(self, lease_timeout: float = LEASE_TIMEOUT) -> None:
+        """Puts back the leases whose heartbeat has not changed for `lease_timeout` seconds."""
+        now = time.monotonic()
+        names = set()
+        for name in os.listdir(self.leases_dir):
+            if not name.endswith(".json") or name.startswith("."):
+                continue
+            names.add(name)
+            try:
+                st = os.stat(self.leases_dir / name)
+            except FileNotFoundError:
+                continue
+            signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+            seen = self.heartbeats.get(name)
+            if seen is None or seen[0] != signature:
+                self.heartbeats[name] = (signature, now)
+                continue
+            if now - seen[1] < lease_timeout:
+                continue
+            item = read_json(self.leases_dir / name)
+            if item is None:
+                continue
+            print(f"Lease of chunk task {item['id']} expired in attempt {item['attempts']}")
+            error = f"lease expired after {lease_timeout:.0f}s without heartbeat"
+            self.release(item, {**result_entry(item), 'error': error})
+            del self.heartbeats[name]
+        for name in set(self.heartbeats) - names:
+            del self.heartbeats[name]
+
+    def results(self, ids: list[str]) -> dict[str, dict]:
+        res = {}
+        for task_id in ids:
+            result = read_json(self.results_dir / f"{task_id}.json")
+            if result is not None:
+                res[task_id] = result
+        return res
+
+    def wait(self, ids: list[str], lease_timeout: float = LEASE_TIMEOUT, poll: float = 2.0,
+             workers: list[subprocess.Popen] = ()) -> list[dict]:
+        """Waits for a result of every item in `ids` and returns them in order, reclaiming
+        expired leases meanwhile; `lease_timeout` must be well above the workers' heartbeat
+        interval. Stops early if all local `workers` exited."""
+        done = 0
+        while True:
+            res = self.results(ids)
+            if len(res) != done:
+                done = len(res)
+                print(f"{done}/{len(ids)} chunk tasks done")
+            if done == len(ids):
+                break
+            if workers and all(w.poll() is not None for w in workers):
+                raise RuntimeError(f"All local workers exited with {len(ids) - done} chunk tasks left")
+            self.reclaim_expired(lease_timeout)
+            time.sleep(poll)
+        self.closed_file.touch()
+        return [res[task_id] for task_id in ids]
+
+
+def result_entry(item: dict) -> dict:
+    output_config = item['output_config']
+    return {'chunk': Path(output_config['output_dir']).name, 'size': output_config['size'],
+            'startOidIndex': output_config['startOidIndex'], 'status': 'failed', 'attempts': item['attempts'],
+            'error': item.get('error'), 'worker': None, 'host': None, 'seconds': None, 'stages': {}}
+
+
+def stage_timings(output_dir: Path, since: float) -> dict:
+    """Wall seconds per stage of the perf records this process wrote to `output_dir` since `since`."""
+    from perf import PERF_FILE_NAME, load_records
+    records = load_records([Path(output_dir) / PERF_FILE_NAME])
+    if len(records) == 0:
+        return {}
+    records = records[(records['pid'] == os.getpid()) & (records['start'] >= since)]
+    return {stage: float(wall) for stage, wall in records.groupby('stage')['wall_s'].sum().items()}
+
+
+def attempt_dir(item: dict, worker: str) -> Path:
+    """Output dir of one attempt of `item`, next to the chunk's output dir on the same filesystem."""
+    output_dir = Path(item['output_config']['output_dir'])
+    tag = f"{item['id']}.{item['attempts']}.{worker}".replace(os.sep, "_").replace(":", "_")
+    return output_dir.with_name(f".{output_dir.name}.{tag}")
+
+
+def publish_output(attempt: Path, output_dir: Path) -> None:
+    """Moves the finished `attempt` dir to `output_dir`, replacing the one of an earlier attempt."""
+    old = attempt.with_name(f"{attempt.name}.old")
+    if output_dir.exists():
+        os.rename(output_dir, old)
+    os.rename(attempt, output_dir)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def load_task(task: str):
+    module, function = task.split(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def run_item(queue: WorkQueue, item: dict, worker: str, heartbeat: float = HEARTBEAT_INTERVAL,
+             task: str = CHUNK_TASK) -> dict:
+    """Runs the chunk of `item` with `task` while touching its lease and returns its result entry.
+
+    The task writes into the `attempt_dir` of the item, which replaces the chunk's output dir
+    if the attempt still holds the lease when it ends, failed or not, and is removed otherwise.
+    """
+    shared_config = HelioSharedConfig.model_validate(item['shared_config'])
+    output_config = HelioOutputConfig.model_validate(item['output_config'])
+    result = {**result_entry(item), 'worker': worker, 'host': socket.gethostname()}
+    attempt = attempt_dir(item, worker)
+    shutil.rmtree(attempt, ignore_errors=True)
+    if shared_config.resume and output_config.output_dir.is_dir():
+        # the stages a previous attempt published are skipped, see checkpoint.py
+        shutil.copytree(output_config.output_dir, attempt)
+    attempt_config = output_config.model_copy(update={'output_dir': attempt})
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(heartbeat):
+            if not queue.heartbeat(item['id']):
+                print(f"[{worker}] Lost the lease of chunk task {item['id']}")
+                return
+
+    beater = threading.Thread(target=beat, daemon=True)
+    beater.start()
+    since = time.time()
+    start = time.perf_counter()
+    try:
+        load_task(task)(shared_config, attempt_config, item['chunk'])
+        result['status'] = 'succeeded'
+        result['error'] = None
+    except Exception as e:
+        result['error'] = repr(e)
+        if isinstance(e, NativeRunAborted):
+            result['aborted'] = e.kind
+        print(f"[{worker}] Chunk task {item['id']} attempt {item['attempts']} failed: {e!r}")
+        traceback.print_exc()
+    finally:
+        stop.set()
+        beater.join()
+    result['seconds'] = time.perf_counter() - start
+    result['stages'] = stage_timings(attempt, since)
+    # a task that failed before writing anything leaves no attempt dir to publish
+    if queue.owns(item) and attempt.is_dir():
+        publish_output(attempt, output_config.output_dir)
+    else:
+        shutil.rmtree(attempt, ignore_errors=True)
+    return result
+
+
+def run_worker(queue_dir: Path, worker: str = None, poll: float = 1.0, heartbeat: float = HEARTBEAT_INTERVAL,
+               idle_timeout: float = None, task: str = CHUNK_TASK) -> int:
+    """Runs chunk tasks of the queue until it is closed and empty, or for `idle_timeout` seconds
+    without work. Returns the number of items run."""
+    queue = WorkQueue(queue_dir)
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    n = 0
+    idle_since = time.monotonic()
+    while True:
+        item = queue.claim()
+        if item is None:
+            if queue.closed_file.exists() or (idle_timeout is not None and time.monotonic() - idle_since > idle_timeout):
+                break
+            time.sleep(poll)
+            continue
+        print(f"[{worker}] Claimed chunk task {item['id']} (attempt {item['attempts']})")
+        queue.release(item, run_item(queue, item, worker, heartbeat, task))
+        n += 1
+        idle_since = time.monotonic()
+    print(f"[{worker}] {n} chunk tasks run, exiting")
+    return n
+
+
+def start_local_workers(queue_dir: Path, n: int, idle_timeout: float = None,
+                        task: str = CHUNK_TASK) -> list[subprocess.Popen]:
+    """Starts `n` worker processes on this machine, each stands in for a node."""
+    argv = [sys.executable, str(Path(__file__).resolve()), "worker", "--queue", str(queue_dir), "--task", task]
+    if idle_timeout is not None:
+        argv += ["--idle-timeout", str(idle_timeout)]
+    return [subprocess.Popen(argv) for _ in range(n)]
+
+
+def run_distributed(shared_config: HelioSharedConfig, output_config_list: list[HelioOutputConfig], queue_dir: Path,
+                    local_workers: int = 0, retries: int = 2, lease_timeout: float = LEASE_TIMEOUT,
+                    task: str = CHUNK_TASK) -> list[dict]:
+    """Publishes the chunks to `queue_dir`, optionally starts `local_workers` workers here, and
+    returns one result entry per chunk once workers on any node have run them all."""
+    queue = WorkQueue(queue_dir)
+    ids = queue.publish(shared_config, output_config_list, retries)
+    workers = start_local_workers(queue_dir, local_workers, task=task)
+    try:
+        return queue.wait(ids, lease_timeout, workers=workers)
+    finally:
+        queue.closed_file.touch()
+        for w in workers:
+            w.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    worker = sub.add_parser("worker", help="run chunk tasks from a queue")
+    worker.add_argument("--queue", type=Path, required=True)
+    worker.add_argument("--workers", type=int, default=1, help="worker processes on this node")
+    worker.add_argument("--idle-timeout", type=float, default=None,
+                        help="exit after this many seconds without work, by default once the queue is closed")
+    worker.add_argument("--task", default=CHUNK_TASK, help="module:function run for every chunk")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        sys.exit(max(w.wait() for w in start_local_workers(args.queue, args.workers, args.idle_timeout, args.task)))
+    run_worker(args.queue, idle_timeout=args.idle_timeout, task=args.task)